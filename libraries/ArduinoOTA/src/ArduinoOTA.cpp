@@ -16,6 +16,7 @@
 #define LWIP_OPEN_SRC
 #endif
 #include <functional>
+#include <new>
 #include "ArduinoOTA.h"
 #include "NetworkClient.h"
 #include "ESPmDNS.h"
@@ -23,12 +24,165 @@
 #include "SHA2Builder.h"
 #include "PBKDF2_HMACBuilder.h"
 #include "Update.h"
+#include "esp_ota_ops.h"
+#if __has_include("rom/miniz.h")
+#include "rom/miniz.h"
+#define OTA_ZLIB_SUPPORTED 1
+#endif
 
 // #define OTA_DEBUG Serial
 
+// Where a decoding stage of the OTA payload hands over its output, eventually Update.write()
+typedef std::function<bool(uint8_t *, size_t)> OTASink;
+
+#define OTA_PATCH_COPY        0x01
+#define OTA_PATCH_DATA        0x02
+#define OTA_PATCH_COPY_BUFFER 1024
+
+// Rebuilds the new app image from a patch made by espota.py against the running app.
+// The patch is a sequence of operations, integers being little endian uint32:
+//   0x01 <offset> <length>  copy length bytes at offset of the running app partition
+//   0x02 <length> <data>    insert length bytes of literal data
+// Operations may be split anywhere across calls to write().
+class OTAPatcher {
+public:
+  OTAPatcher() : _base(NULL), _buf(NULL), _header_len(0), _literal(0) {}
+
+  ~OTAPatcher() {
+    free(_buf);
+  }
+
+  bool begin(const esp_partition_t *base, OTASink out) {
+    _base = base;
+    _out = out;
+    _buf = (uint8_t *)malloc(OTA_PATCH_COPY_BUFFER);
+    return _base && _buf;
+  }
+
+  // Returns false if the patch is corrupted or the output could not be written
+  bool write(uint8_t *data, size_t len) {
+    while (len) {
+      if (_literal) {
+        size_t n = len < _literal ? len : _literal;
+        if (!_out(data, n)) {
+          return false;
+        }
+        data += n;
+        len -= n;
+        _literal -= n;
+        continue;
+      }
+      _header[_header_len++] = *data++;
+      len--;
+      if (_header[0] != OTA_PATCH_COPY && _header[0] != OTA_PATCH_DATA) {
+        log_e("Bad patch operation: %u", _header[0]);
+        return false;
+      }
+      if (_header_len < (_header[0] == OTA_PATCH_COPY ? 9 : 5)) {
+        continue;
+      }
+      _header_len = 0;
+      if (_header[0] == OTA_PATCH_DATA) {
+        _literal = _read32(_header + 1);
+      } else if (!_copy(_read32(_header + 1), _read32(_header + 5))) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+private:
+  static uint32_t _read32(const uint8_t *p) {
+    return p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t)p[3] << 24);
+  }
+
+  bool _copy(uint32_t offset, uint32_t len) {
+    if (offset > _base->size || len > _base->size - offset) {
+      log_e("Patch copy out of range: %u + %u", offset, len);
+      return false;
+    }
+    while (len) {
+      size_t n = len < OTA_PATCH_COPY_BUFFER ? len : OTA_PATCH_COPY_BUFFER;
+      if (esp_partition_read(_base, offset, _buf, n) != ESP_OK) {
+        log_e("Failed to read the running app at %u", offset);
+        return false;
+      }
+      if (!_out(_buf, n)) {
+        return false;
+      }
+      offset += n;
+      len -= n;
+    }
+    return true;
+  }
+
+  const esp_partition_t *_base;
+  OTASink _out;
+  uint8_t *_buf;
+  uint8_t _header[9];
+  size_t _header_len;
+  uint32_t _literal;
+};
+
+#ifdef OTA_ZLIB_SUPPORTED
+// Inflates a zlib compressed OTA payload as it arrives, using the inflater in ROM.
+// The 32KB dictionary doubles as output buffer, so no copy of the image is ever held in RAM.
+class OTAInflater {
+public:
+  OTAInflater() : _inflator(NULL), _dict(NULL), _dict_ofs(0), _done(false) {}
+
+  ~OTAInflater() {
+    free(_inflator);
+    free(_dict);
+  }
+
+  bool begin(OTASink out) {
+    _out = out;
+    _inflator = (tinfl_decompressor *)malloc(sizeof(tinfl_decompressor));
+    _dict = (uint8_t *)malloc(TINFL_LZ_DICT_SIZE);
+    if (!_inflator || !_dict) {
+      return false;
+    }
+    tinfl_init(_inflator);
+    return true;
+  }
+
+  // Returns false if the stream is corrupted or the output could not be written
+  bool write(const uint8_t *data, size_t len) {
+    tinfl_status status = TINFL_STATUS_HAS_MORE_OUTPUT;
+    // Keep going while there is input left or the dictionary was too full to flush everything
+    while (!_done && (len || status == TINFL_STATUS_HAS_MORE_OUTPUT)) {
+      size_t in_bytes = len;
+      size_t out_bytes = TINFL_LZ_DICT_SIZE - _dict_ofs;
+      status = tinfl_decompress(_inflator, data, &in_bytes, _dict, _dict + _dict_ofs, &out_bytes, TINFL_FLAG_PARSE_ZLIB_HEADER | TINFL_FLAG_HAS_MORE_INPUT);
+      data += in_bytes;
+      len -= in_bytes;
+      if (out_bytes && !_out(_dict + _dict_ofs, out_bytes)) {
+        return false;
+      }
+      _dict_ofs = (_dict_ofs + out_bytes) & (TINFL_LZ_DICT_SIZE - 1);
+      if (status < TINFL_STATUS_DONE) {
+        log_e("Inflate failed: %d", status);
+        return false;
+      }
+      _done = status == TINFL_STATUS_DONE;
+    }
+    return true;
+  }
+
+private:
+  OTASink _out;
+  tinfl_decompressor *_inflator;
+  uint8_t *_dict;
+  size_t _dict_ofs;
+  bool _done;
+};
+#endif
+
 ArduinoOTAClass::ArduinoOTAClass()
   : _port(0), _initialized(false), _rebootOnSuccess(true), _mdnsEnabled(true), _state(OTA_IDLE), _size(0), _cmd(0), _ota_port(0), _ota_timeout(1000),
-    _start_callback(NULL), _end_callback(NULL), _error_callback(NULL), _progress_callback(NULL) {}
+    _ext_requested(false), _ext(0), _patcher(NULL), _inflater(NULL), _resume_offset(0), _resume_since(0), _session_since(0), _start_callback(NULL),
+    _end_callback(NULL), _error_callback(NULL), _progress_callback(NULL) {}
 
 ArduinoOTAClass::~ArduinoOTAClass() {
   end();
@@ -162,6 +316,13 @@ void ArduinoOTAClass::begin() {
   if (_mdnsEnabled) {
     MDNS.begin(_hostname.c_str());
     MDNS.enableArduino(_port, (_password.length() > 0));
+    // Lets espota.py refuse an image built for another chip before sending it
+    MDNS.addServiceTxt("arduino", "tcp", "chip", CONFIG_IDF_TARGET);
+    // Lets espota.py tell that the device came back running the uploaded app when it rebooted without a result
+    String sha256 = _runningSHA256();
+    if (sha256.length()) {
+      MDNS.addServiceTxt("arduino", "tcp", "sha256", sha256.c_str());
+    }
   }
 #endif
   _initialized = true;
@@ -187,6 +348,187 @@ int ArduinoOTAClass::parseInt() {
   return 0;
 }
 
+void ArduinoOTAClass::_parseExtensions() {
+  // espota.py may follow the invitation with a line "EXT <feature> <feature>..." listing optional
+  // transfer features. Older firmware ignores that line, and the host falls back to a plain
+  // transfer when the answer does not contain the list of accepted features.
+  _ext_requested = false;
+  _ext = 0;
+  String line = readStringUntil('\n');
+  line.trim();
+  if (!line.startsWith("EXT")) {
+    return;
+  }
+  _ext_requested = true;
+  String session;
+  int start = 3;
+  while (start < (int)line.length()) {
+    int end = line.indexOf(' ', start + 1);
+    if (end < 0) {
+      end = line.length();
+    }
+    String feature = line.substring(start, end);
+    feature.trim();
+    if (feature == "resume") {
+      _ext |= OTA_EXT_RESUME;
+    }
+    if (feature == "more") {
+      _ext |= OTA_EXT_MORE;
+    }
+    if (feature.startsWith("session:")) {
+      session = feature.substring(8);
+    }
+#ifdef OTA_ZLIB_SUPPORTED
+    if (feature == "zlib") {
+      _ext |= OTA_EXT_ZLIB;
+    }
+#endif
+    // "delta:<sha256>" offers a patch against the app with that hash, only usable if it is the one running
+    if (_cmd == U_FLASH && feature.startsWith("delta:") && feature.substring(6).equalsIgnoreCase(_runningSHA256())) {
+      _ext |= OTA_EXT_DELTA;
+    }
+    start = end;
+  }
+  // "session:<token>" proves that the host authenticated the previous image of a multi-image session
+  if (session.length() && _session_key.length()) {
+    if (_udp_ota.remoteIP() == _session_ip && millis() - _session_since < OTA_SESSION_TIMEOUT && session.equalsIgnoreCase(_sessionToken())) {
+      _ext |= OTA_EXT_SESSION;
+    }
+    if (!(_ext & OTA_EXT_SESSION) || !(_ext & OTA_EXT_MORE)) {
+      // Every token is good for one invitation, only an image followed by more keeps the session
+      _session_key = "";
+    }
+  }
+}
+
+String ArduinoOTAClass::_sessionToken() {
+  // Bound to the image, so that a token seen on the network cannot invite the device to another one
+  SHA256Builder sha256;
+  sha256.begin();
+  sha256.add(_session_key + ":" + String(_cmd) + ":" + _md5);
+  sha256.calculate();
+  return sha256.toString();
+}
+
+String ArduinoOTAClass::_extensionsReply() {
+  if (!_ext_requested) {
+    return "";
+  }
+  String reply = " EXT";
+  if (_ext & OTA_EXT_ZLIB) {
+    reply += " zlib";
+  }
+  if (_ext & OTA_EXT_DELTA) {
+    reply += " delta";
+  }
+  if (_ext & OTA_EXT_MORE) {
+    reply += " more";
+  }
+  if (_ext & OTA_EXT_SESSION) {
+    reply += " session";
+  }
+  if (_ext & OTA_EXT_RESUME) {
+    // Tell the host where to continue, 0 unless this invitation matches the interrupted transfer
+    reply += " resume:" + String(_canResume() ? _resume_offset : 0);
+  }
+  return reply;
+}
+
+String ArduinoOTAClass::_transferKey() {
+  // Only the features shaping the payload, a session token is good for one invitation and the one resuming lacks it
+  return String(_cmd) + " " + String(_size) + " " + _md5 + " " + String(_ext & (OTA_EXT_ZLIB | OTA_EXT_DELTA));
+}
+
+bool ArduinoOTAClass::_canResume() {
+  return _resume_key.length() && (_ext & OTA_EXT_RESUME) && _resume_key == _transferKey();
+}
+
+bool ArduinoOTAClass::_ack(NetworkClient &client, uint32_t written, uint32_t received) {
+  // Bare counts run together when the host has several chunks in flight ("1001000" is 100 and 1000,
+  // or 1001 and 000). With extensions, acknowledge the total received on a line of its own instead,
+  // which the host can split and which stays the same when repeated.
+  if (_ext) {
+    return client.printf("%lu\n", (unsigned long)received);
+  }
+  return client.printf("%lu", (unsigned long)written);
+}
+
+bool ArduinoOTAClass::_suspend(uint32_t received) {
+  // Keep Update and the decoders open after the connection was lost, so that the host can resume
+  if (!(_ext & OTA_EXT_RESUME) || !Update.isRunning() || Update.hasError()) {
+    return false;
+  }
+  log_w("Connection lost after %u bytes, waiting for the upload to resume", received);
+  _resume_key = _transferKey();
+  _resume_offset = received;
+  _resume_since = millis();
+  _state = OTA_IDLE;
+  return true;
+}
+
+void ArduinoOTAClass::_dropResume() {
+  if (_resume_key.length()) {
+    log_w("Interrupted update abandoned");
+    _resume_key = "";
+    Update.abort();
+    if (_error_callback) {
+      _error_callback(OTA_RECEIVE_ERROR);
+    }
+  }
+  _endDecoders();
+}
+
+bool ArduinoOTAClass::_beginDecoders() {
+  _sink = [](uint8_t *data, size_t len) {
+    return Update.write(data, len) == len;
+  };
+  if (_ext & OTA_EXT_DELTA) {
+    _patcher = new (std::nothrow) OTAPatcher();
+    if (!_patcher || !_patcher->begin(esp_ota_get_running_partition(), _sink)) {
+      return false;
+    }
+    OTAPatcher *patcher = _patcher;
+    _sink = [patcher](uint8_t *data, size_t len) {
+      return patcher->write(data, len);
+    };
+  }
+#ifdef OTA_ZLIB_SUPPORTED
+  if (_ext & OTA_EXT_ZLIB) {
+    _inflater = new (std::nothrow) OTAInflater();
+    if (!_inflater || !_inflater->begin(_sink)) {
+      return false;
+    }
+    OTAInflater *inflater = _inflater;
+    _sink = [inflater](uint8_t *data, size_t len) {
+      return inflater->write(data, len);
+    };
+  }
+#endif
+  return true;
+}
+
+void ArduinoOTAClass::_endDecoders() {
+  _sink = nullptr;
+  delete _patcher;
+  _patcher = NULL;
+#ifdef OTA_ZLIB_SUPPORTED
+  delete _inflater;
+#endif
+  _inflater = NULL;
+}
+
+String ArduinoOTAClass::_runningSHA256() {
+  // The running app does not change until reboot, hash it only once
+  if (!_running_sha256.length()) {
+    uint8_t sha256[32];
+    const esp_partition_t *running = esp_ota_get_running_partition();
+    if (running && esp_partition_get_sha256(running, sha256) == ESP_OK) {
+      _running_sha256 = HEXBuilder::bytes2hex(sha256, sizeof(sha256));
+    }
+  }
+  return _running_sha256;
+}
+
 String ArduinoOTAClass::readStringUntil(char end) {
   String res = "";
   int value;
@@ -216,8 +558,9 @@ void ArduinoOTAClass::_onRx() {
       log_e("bad md5 length");
       return;
     }
+    _parseExtensions();
 
-    if (_password.length()) {
+    if (_password.length() && !(_ext & OTA_EXT_SESSION)) {
       // Generate a random challenge (nonce)
       SHA256Builder nonce_sha256;
       nonce_sha256.begin();
@@ -226,19 +569,34 @@ void ArduinoOTAClass::_onRx() {
       _nonce = nonce_sha256.toString();
 
       _udp_ota.beginPacket(_udp_ota.remoteIP(), _udp_ota.remotePort());
-      _udp_ota.printf("AUTH %s", _nonce.c_str());
+      _udp_ota.printf("AUTH %s%s", _nonce.c_str(), _extensionsReply().c_str());
       _udp_ota.endPacket();
       _state = OTA_WAITAUTH;
       return;
     } else {
       _udp_ota.beginPacket(_udp_ota.remoteIP(), _udp_ota.remotePort());
       _udp_ota.print("OK");
+      _udp_ota.print(_extensionsReply());
       _udp_ota.endPacket();
       _ota_ip = _udp_ota.remoteIP();
       _state = OTA_RUNUPDATE;
     }
   } else if (_state == OTA_WAITAUTH) {
     int cmd = parseInt();
+    if (cmd == _cmd) {
+      // The host repeats the invitation when the challenge got lost, answer it with the same nonce
+      int port = parseInt();
+      int size = parseInt();
+      _udp_ota.read();
+      String md5 = readStringUntil('\n');
+      md5.trim();
+      if (port == _ota_port && size == _size && md5 == _md5) {
+        _udp_ota.beginPacket(_udp_ota.remoteIP(), _udp_ota.remotePort());
+        _udp_ota.printf("AUTH %s%s", _nonce.c_str(), _extensionsReply().c_str());
+        _udp_ota.endPacket();
+        return;
+      }
+    }
     if (cmd != U_AUTH) {
       log_e("%d was expected. got %d instead", U_AUTH, cmd);
       _state = OTA_IDLE;
@@ -282,6 +640,12 @@ void ArduinoOTAClass::_onRx() {
       _udp_ota.print("OK");
       _udp_ota.endPacket();
       _ota_ip = _udp_ota.remoteIP();
+      if (_ext & OTA_EXT_MORE) {
+        // The host can authenticate the next image with a token made from the derived key, which never went over the air
+        _session_key = derived_key;
+        _session_ip = _ota_ip;
+        _session_since = millis();
+      }
       _state = OTA_RUNUPDATE;
     } else {
       _udp_ota.beginPacket(_udp_ota.remoteIP(), _udp_ota.remotePort());
@@ -298,24 +662,44 @@ void ArduinoOTAClass::_onRx() {
 
 void ArduinoOTAClass::_runUpdate() {
   const char *partition_label = _partition_label.length() ? _partition_label.c_str() : NULL;
-  if (!Update.begin(_size, _cmd, -1, LOW, partition_label)) {
+  // Payload bytes received so far, acknowledged to the host and where a resumed transfer continues
+  uint32_t received = 0;
+  if (_canResume()) {
+    received = _resume_offset;
+    _resume_key = "";
+    log_i("Resuming update at %u", received);
+  } else {
+    _dropResume();
+    // With extensions, the payload goes through the inflater and/or the patcher before reaching Update
+    if (!_beginDecoders()) {
+      log_e("Begin ERROR: not enough memory to decode the update");
+      _endDecoders();
+      if (_error_callback) {
+        _error_callback(OTA_BEGIN_ERROR);
+      }
+      _state = OTA_IDLE;
+      return;
+    }
+    if (!Update.begin(_size, _cmd, -1, LOW, partition_label)) {
 
-    log_e("Begin ERROR: %s", Update.errorString());
+      log_e("Begin ERROR: %s", Update.errorString());
 
-    if (_error_callback) {
-      _error_callback(OTA_BEGIN_ERROR);
+      _endDecoders();
+      if (_error_callback) {
+        _error_callback(OTA_BEGIN_ERROR);
+      }
+      _state = OTA_IDLE;
+      return;
     }
-    _state = OTA_IDLE;
-    return;
-  }
 
-  Update.setMD5(_md5.c_str());  // Note: Update library still uses MD5 for firmware integrity, this is separate from authentication
+    Update.setMD5(_md5.c_str());  // Note: Update library still uses MD5 for firmware integrity, this is separate from authentication
 
-  if (_start_callback) {
-    _start_callback();
-  }
-  if (_progress_callback) {
-    _progress_callback(0, _size);
+    if (_start_callback) {
+      _start_callback();
+    }
+    if (_progress_callback) {
+      _progress_callback(0, _size);
+    }
   }
 
   NetworkClient client;
@@ -339,7 +723,7 @@ void ArduinoOTAClass::_runUpdate() {
     if (!waited) {
       if (written && tried++ < 3) {
         log_i("Try[%u]: %u", tried, written);
-        if (!client.printf("%lu", written)) {
+        if (!_ack(client, written, received)) {
           log_e("failed to respond");
           _state = OTA_IDLE;
           break;
@@ -347,11 +731,15 @@ void ArduinoOTAClass::_runUpdate() {
         continue;
       }
       log_e("Receive Failed");
+      if (_suspend(received)) {
+        return;
+      }
       if (_error_callback) {
         _error_callback(OTA_RECEIVE_ERROR);
       }
       _state = OTA_IDLE;
       Update.abort();
+      _endDecoders();
       return;
     }
     if (!available) {
@@ -373,15 +761,27 @@ void ArduinoOTAClass::_runUpdate() {
       }
     }
 
-    written = Update.write(buf, r);
+    if (_ext) {
+      // Acknowledge the encoded bytes consumed, the host tracks its window on the wire
+      if (!_sink(buf, r)) {
+        if (!Update.hasError()) {
+          Update.abort();
+        }
+        break;
+      }
+      written = r;
+      received += r;
+    } else {
+      written = Update.write(buf, r);
+    }
     if (written > 0) {
       if (written != r) {
         log_w("didn't write enough! %u != %u", written, r);
       }
-      if (!client.printf("%lu", written)) {
+      if (!_ack(client, written, received)) {
         log_w("failed to respond");
       }
-      total += written;
+      total = Update.progress();
       if (_progress_callback) {
         _progress_callback(total, _size);
       }
@@ -390,6 +790,11 @@ void ArduinoOTAClass::_runUpdate() {
     }
   }
 
+  if (!Update.isFinished() && _suspend(received)) {
+    return;
+  }
+  _endDecoders();
+
   if (Update.end()) {
     client.print("OK");
     client.stop();
@@ -397,7 +802,11 @@ void ArduinoOTAClass::_runUpdate() {
     if (_end_callback) {
       _end_callback();
     }
-    if (_rebootOnSuccess) {
+    if (_ext & OTA_EXT_MORE) {
+      // Another image follows in the same session, reboot after that one
+      _session_since = millis();
+      log_i("Update done, waiting for the next image");
+    } else if (_rebootOnSuccess) {
       //let serial/network finish tasks that might be given in _end_callback
       delay(100);
       ESP.restart();
@@ -408,6 +817,7 @@ void ArduinoOTAClass::_runUpdate() {
     }
     Update.printError(client);
     client.stop();
+    _session_key = "";
     delay(10);
     log_e("Update ERROR: %s", Update.errorString());
     _state = OTA_IDLE;
@@ -416,6 +826,8 @@ void ArduinoOTAClass::_runUpdate() {
 
 void ArduinoOTAClass::end() {
   _initialized = false;
+  _dropResume();
+  _session_key = "";
   _udp_ota.stop();
 #ifdef CONFIG_MDNS_MAX_INTERFACES
   if (_mdnsEnabled) {
@@ -434,6 +846,12 @@ void ArduinoOTAClass::handle() {
     _runUpdate();
     _state = OTA_IDLE;
   }
+  if (_resume_key.length() && _state == OTA_IDLE && millis() - _resume_since > OTA_RESUME_TIMEOUT) {
+    _dropResume();
+  }
+  if (_session_key.length() && _state == OTA_IDLE && millis() - _session_since > OTA_SESSION_TIMEOUT) {
+    _session_key = "";
+  }
   if (_udp_ota.parsePacket()) {
     _onRx();
   }
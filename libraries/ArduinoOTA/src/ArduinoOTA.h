@@ -21,6 +21,21 @@
 
 #define INT_BUFFER_SIZE 16
 
+// Optional transfer features negotiated with espota.py through the "EXT" line of the invitation
+#define OTA_EXT_ZLIB    (1 << 0)  // The payload is a zlib stream, inflated on the fly into Update
+#define OTA_EXT_DELTA   (1 << 1)  // The payload is a patch against the running app, see OTAPatcher
+#define OTA_EXT_RESUME  (1 << 2)  // An interrupted transfer can be resumed with a new invitation
+#define OTA_EXT_MORE    (1 << 3)  // Another image follows: no reboot, the next invitation may use the session
+#define OTA_EXT_SESSION (1 << 4)  // Authenticated by the session of the previous image instead of a challenge
+
+// How long an interrupted transfer is kept open waiting for the host to resume it
+#define OTA_RESUME_TIMEOUT 60000
+// How long the session of an image sent with "more" stays valid for the next image
+#define OTA_SESSION_TIMEOUT 60000
+
+class OTAPatcher;
+class OTAInflater;
+
 typedef enum {
   OTA_IDLE,
   OTA_WAITAUTH,
@@ -110,6 +125,22 @@ private:
   int _ota_timeout;
   IPAddress _ota_ip;
   String _md5;
+  bool _ext_requested;
+  uint32_t _ext;
+  String _running_sha256;
+
+  // Decoders of the payload, kept with Update across connections while a transfer can be resumed
+  OTAPatcher *_patcher;
+  OTAInflater *_inflater;
+  std::function<bool(uint8_t *, size_t)> _sink;
+  String _resume_key;
+  uint32_t _resume_offset;
+  unsigned long _resume_since;
+
+  // Key derived during the authentication of a multi-image session, see _sessionToken()
+  String _session_key;
+  IPAddress _session_ip;
+  unsigned long _session_since;
 
   THandlerFunction _start_callback;
   THandlerFunction _end_callback;
@@ -120,6 +151,17 @@ private:
   void _onRx(void);
   int parseInt(void);
   String readStringUntil(char end);
+  void _parseExtensions(void);
+  String _extensionsReply(void);
+  String _runningSHA256(void);
+  String _transferKey(void);
+  bool _canResume(void);
+  bool _ack(NetworkClient &client, uint32_t written, uint32_t received);
+  bool _suspend(uint32_t received);
+  void _dropResume(void);
+  String _sessionToken(void);
+  bool _beginDecoders(void);
+  void _endDecoders(void);
 };
 
 #if !defined(NO_GLOBAL_INSTANCES) && !defined(NO_GLOBAL_ARDUINOOTA)
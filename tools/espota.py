@@ -49,16 +49,51 @@
 # Changes
 # 2025-10-07:
 # - Fixed authentication when images might use old MD5 hashes stored in the firmware
+#
+# Changes
+# 2026-10-18:
+# - Added pipelined upload that keeps several chunks in flight (-W/--window) with firmware that negotiates EXT
+# - Kept the stop-and-wait upload for old firmware and --window 1
+# - Report the measured transfer throughput after the upload
+# - Added concurrent fleet updates (-i repeated or --ip-file, -j/--jobs) sharing one image read
+# - Moved the OTA logic into the importable OTAClient/OTASession classes, without module globals
+# - Hash the image in a single streaming pass, cache the MD5 per user and send it with sendfile()
+# - Remember per device which password hash was accepted and try it first (--auth-cache)
+# - Negotiate optional transfer features with an "EXT" invitation line, starting with zlib compression
+# - Send app images as a patch against the build the device runs (--delta-base or opt-in --image-cache)
+# - Record the time to first byte and the acknowledgment time of every chunk in OTAMetrics
+# - Resume uploads interrupted by a dropped connection where the device stopped (--resume-attempts)
+# - Repeat invitations with exponential backoff on one socket until a deadline (--invitation-deadline)
+# - Find devices with mDNS queries, unicast to a target list or multicast (--discover, --skip-offline)
+# - Wait for the update result until a deadline, fail on Update errors and detect reboots (--result-timeout)
+# - Confirm a reboot without a result by the SHA256 of the app the device announces over mDNS
+# - Report the steps of every upload as JSON lines (--telemetry, JSONLinesTelemetry)
+# - Send the filesystem and the app in one session with a single authentication (--fs-file, upload_images())
+# - Size chunks from the TCP MSS up while the ack latency stays flat (--chunk-size, --send-buffer)
+# - Derive the authentication keys of concurrent uploads in worker processes (--auth-workers)
+# - Check app images before inviting the device: header, chip, length, checksum and SHA256 (--chip, --no-validate)
 
 
 from __future__ import print_function
 import socket
 import sys
-import os
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
+import os
 import hashlib
+import json
 import random
+import select
+import shutil
+import struct
+import threading
+import time
+import zlib
 
 # Commands
 FLASH = 0
@@ -67,11 +102,69 @@ AUTH = 200
 
 # Constants
 PROGRESS_BAR_LENGTH = 60
+CHUNK_SIZE = 1024
+DEVICE_BUFFER_SIZE = 1460  # Size of the receive buffer used by ArduinoOTA
+DEFAULT_WINDOW = 8  # Chunks in flight during a pipelined upload
+MAX_CHUNK_SIZE = 8 * DEVICE_BUFFER_SIZE  # Largest chunk the automatic sizing grows to
+TUNING_SAMPLES = 16  # Acknowledged chunks of one size compared before growing further
+TUNING_TOLERANCE = 1.25  # How much the median RTT may rise over the best one and still count as flat
+TUNING_SLACK = 0.001  # Seconds of RTT noise ignored on fast links
+DEFAULT_RESUME_ATTEMPTS = 3  # Re-invitations after the connection dropped during a transfer
+DEFAULT_RESULT_TIMEOUT = 60  # For the device to answer after the last chunk or come back after a reboot
+REBOOT_PROBE_INTERVAL = 1.0
+MDNS_SILENCE_TIMEOUT = 15  # Without any mDNS answer by then, the device is taken not to run mDNS at all
+INVITATION_RETRY = 1.0  # First interval between invitations, doubled up to the timeout after every attempt
+DEFAULT_INVITATION_DEADLINE = 30
+ACK_TIMEOUT = 10
+HASH_BLOCK_SIZE = 64 * 1024
+DEFAULT_IMAGE_CACHE_SIZE = 64  # MB of images kept as delta bases, the least recently used are evicted beyond
+PBKDF2_ITERATIONS = 10000  # Must match ArduinoOTA
+DELTA_BLOCK_SIZE = 32  # Granularity of the matches between the running image and the new one
+FLASH_MIN_WRITE_RATE = 64 * 1024  # Slowest expected rebuild rate of a delta update on the device, bytes/s
+ESP_IMAGE_MAGIC = 0xE9
+ESP_IMAGE_HEADER_SIZE = 24
+ESP_IMAGE_MAX_SEGMENTS = 16
+ESP_CHECKSUM_MAGIC = 0xEF
+MAX_VALIDATIONS = 256  # Images remembered by ValidationCache
+
+# Chip IDs of the extended app image header (esp_chip_id_t)
+ESP_CHIP_IDS = {
+    "esp32": 0x0000,
+    "esp32s2": 0x0002,
+    "esp32c3": 0x0005,
+    "esp32s3": 0x0009,
+    "esp32c2": 0x000C,
+    "esp32c6": 0x000D,
+    "esp32h2": 0x0010,
+    "esp32p4": 0x0012,
+    "esp32c61": 0x0014,
+    "esp32c5": 0x0017,
+}
+ESP_CHIP_NAMES = {chip_id: name for name, chip_id in ESP_CHIP_IDS.items()}
+
+# Upper bounds of the acknowledgment RTT histogram buckets, in seconds
+RTT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# mDNS discovery of the "_arduino._tcp" service announced by ArduinoOTA
+MDNS_ADDRESS = "224.0.0.251"
+MDNS_PORT = 5353
+MDNS_SERVICE = "_arduino._tcp.local"
+DNS_A = 1
+DNS_PTR = 12
+DNS_TXT = 16
+DNS_SRV = 33
+DISCOVERY_RETRY = 0.1  # First interval between queries, doubled after every attempt
+DISCOVERY_MAX_RETRY = 1.0
+DEFAULT_DISCOVERY_DEADLINE = 3.0
+
+# Delta patch operations, see make_patch()
+PATCH_COPY = 0x01
+PATCH_DATA = 0x02
 
 
 # update_progress(): Displays or updates a console progress bar
-def update_progress(progress):
-    if PROGRESS:
+def update_progress(progress, out=sys.stderr, bar=True):
+    if bar:
         status = ""
         if isinstance(progress, int):
             progress = float(progress)
@@ -88,390 +181,1901 @@ def update_progress(progress):
         text = "\rUploading: [{0}] {1}% {2}".format(
             "=" * block + " " * (PROGRESS_BAR_LENGTH - block), int(progress * 100), status
         )
-        sys.stderr.write(text)
-        sys.stderr.flush()
+        out.write(text)
+        out.flush()
     else:
-        sys.stderr.write(".")
-        sys.stderr.flush()
+        out.write(".")
+        out.flush()
+
 
+class NullOutput(object):
+    """Discard console output, e.g. when several sessions run concurrently."""
 
-def send_invitation_and_get_auth_challenge(remote_addr, remote_port, message):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class ChunkTuner(object):
     """
-    Send invitation to ESP device and get authentication challenge.
-    Returns (success, auth_data, error_message) tuple.
+    Pick the chunk size of a pipelined transfer.
+
+    Starts at `start` bytes, the TCP MSS the device drains in one read, and doubles
+    the size after every TUNING_SAMPLES acknowledged chunks as long as their median
+    round trip time stays flat, i.e. within TUNING_TOLERANCE of the best median seen.
+    Larger chunks mean more bytes in flight, which only pays while the link and the
+    device keep up; once the RTT rises, the previous size is kept for the rest of the
+    transfer. Sizes stay multiples of `start`, so segments and device reads line up.
     """
-    remote_address = (remote_addr, int(remote_port))
-    inv_tries = 0
-    data = ""
 
-    msg = "Sending invitation to %s " % remote_addr
-    sys.stderr.write(msg)
-    sys.stderr.flush()
+    def __init__(self, start, maximum=MAX_CHUNK_SIZE):
+        self.size = start
+        self.maximum = maximum
+        self.done = start * 2 > maximum
+        self._previous = start
+        self._best = None
+        self._rtts = []
+
+    def add(self, size, rtt):
+        """Account the round trip time of an acknowledged chunk of `size` bytes."""
+        if self.done or size != self.size:
+            # Only full chunks of the current size tell anything about it
+            return
+        self._rtts.append(rtt)
+        if len(self._rtts) < TUNING_SAMPLES:
+            return
+        median = sorted(self._rtts)[len(self._rtts) // 2]
+        self._rtts = []
+        if self._best is not None and median > self._best * TUNING_TOLERANCE + TUNING_SLACK:
+            logging.debug("Chunk RTT rose to %.1f ms, keeping %d byte chunks", median * 1000, self._previous)
+            self.size = self._previous
+            self.done = True
+            return
+        self._best = median if self._best is None else min(self._best, median)
+        self._previous = self.size
+        self.size *= 2
+        self.done = self.size * 2 > self.maximum
+        logging.debug("Chunk RTT %.1f ms, trying %d byte chunks", median * 1000, self.size)
+
+
+def _mss(connection):
+    """Maximum segment size of a TCP connection, DEVICE_BUFFER_SIZE if the system does not tell."""
+    try:
+        mss = connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG)
+    except (AttributeError, OSError):
+        return DEVICE_BUFFER_SIZE
+    return mss if mss > 0 else DEVICE_BUFFER_SIZE
 
-    while inv_tries < 10:
-        inv_tries += 1
-        sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            sent = sock2.sendto(message.encode(), remote_address)  # noqa: F841
-        except:  # noqa: E722
-            sys.stderr.write("failed\n")
-            sys.stderr.flush()
-            sock2.close()
-            return False, None, "Host %s Not Found" % remote_addr
 
-        sock2.settimeout(TIMEOUT)
-        try:
-            # Try to read up to 69 bytes for new protocol (SHA256)
-            # If device sends less (37 bytes), it's using old MD5 protocol
-            data = sock2.recv(69).decode()
-            sock2.close()
+class AckParser(object):
+    """
+    Read the acknowledgments the device sends while it receives the payload.
+
+    Without transfer features, ArduinoOTA answers every read with the number of
+    bytes written, printed as a bare decimal without separator. Acks that arrive
+    together ("1001000" for 100 and 1000, or a 1460 byte chunk acked as 1436 and
+    24) cannot be told apart, so these are only skipped and the transfer stays
+    stop-and-wait. With features (`delimited`), every ack is the total of payload
+    bytes received so far on a line of its own, and a repeated ack repeats the
+    same total: `acked` is the highest one. "OK" ends a successful update,
+    anything else (an Update error message) is collected in `text`.
+    """
+
+    def __init__(self, delimited=True):
+        self.delimited = delimited
+        self.acked = 0
+        self.ok = False
+        self.text = ""
+        self._pending = ""
+
+    def feed(self, data):
+        if self.text:
+            self.text += data.decode(errors="replace")
+            return
+        s = self._pending + data.decode(errors="replace")
+        if self.delimited:
+            *lines, s = s.split("\n")
+            for i, line in enumerate(lines):
+                line = line.strip()
+                if line.isdigit():
+                    self.acked = max(self.acked, int(line))
+                elif line:
+                    # Only complete lines are acks, the rest is the answer of the device
+                    s = "\n".join(lines[i:] + [s])
+                    break
+            else:
+                if s.strip().isdigit():
+                    # The end of the line is in the next segment
+                    self._pending = s
+                    return
+        else:
+            s = s.lstrip("0123456789 \t\r\n")
+        s = s.lstrip()
+        if s.startswith("OK"):
+            self.ok = True
+            s = s[2:].strip()
+        if s and s != "O":
+            self.text = s
+            s = ""
+        self._pending = s
+
+
+def _match_length(a, a_start, b, b_start):
+    """Length of the common prefix of a[a_start:] and b[b_start:], compared in shrinking slices."""
+    limit = min(len(a) - a_start, len(b) - b_start)
+    length = 0
+    step = 4096
+    while step:
+        while (
+            length + step <= limit
+            and a[a_start + length : a_start + length + step] == b[b_start + length : b_start + length + step]
+        ):
+            length += step
+        step //= 2
+    return length
+
+
+def make_patch(base, new, block_size=DELTA_BLOCK_SIZE):
+    """
+    Encode `new` as a patch against `base`, which the device rebuilds from the image it runs.
+
+    The patch is a sequence of operations, integers being little endian uint32:
+      0x01 <offset> <length>   copy `length` bytes at `offset` of the running image
+      0x02 <length> <data>     insert `length` bytes of literal data
+    Matches are found on `block_size` aligned blocks of `base` and then grown in both
+    directions, so code and data that merely moved between builds are found too.
+    """
+    index = {}
+    for offset in range(len(base) - block_size - (len(base) % block_size), -1, -block_size):
+        index[base[offset : offset + block_size]] = offset
+    patch = bytearray()
+    literal_start = pos = 0
+    while pos <= len(new) - block_size:
+        offset = index.get(new[pos : pos + block_size])
+        if offset is None:
+            pos += 1
+            continue
+        start = pos
+        while start > literal_start and offset > 0 and new[start - 1] == base[offset - 1]:
+            start -= 1
+            offset -= 1
+        length = pos + block_size - start
+        length += _match_length(new, start + length, base, offset + length)
+        if start > literal_start:
+            patch += struct.pack("<BI", PATCH_DATA, start - literal_start)
+            patch += new[literal_start:start]
+        patch += struct.pack("<BII", PATCH_COPY, offset, length)
+        pos = literal_start = start + length
+    if literal_start < len(new):
+        patch += struct.pack("<BI", PATCH_DATA, len(new) - literal_start)
+        patch += new[literal_start:]
+    return bytes(patch)
+
+
+def _mdns_query(name, qtype):
+    """An mDNS query for `name`, asking for a unicast answer."""
+    question = b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\0"
+    return struct.pack("!HHHHHH", 0, 0, 1, 0, 0, 0) + question + struct.pack("!HH", qtype, 0x8001)
+
+
+def _read_dns_name(data, offset):
+    """Return the (possibly compressed) name at `offset` and the offset following it."""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if not length:
             break
-        except:  # noqa: E722
-            sys.stderr.write(".")
-            sys.stderr.flush()
-            sock2.close()
+        labels.append(data[offset : offset + length].decode(errors="replace"))
+        offset += length
+    return ".".join(labels), end if end is not None else offset
+
+
+def parse_mdns_response(data):
+    """Return the A, PTR, SRV and TXT records of an mDNS response as (name, type, value) tuples."""
+    _, _, questions, answers, authorities, additional = struct.unpack_from("!HHHHHH", data)
+    offset = 12
+    for _ in range(questions):
+        offset = _read_dns_name(data, offset)[1] + 4
+    records = []
+    for _ in range(answers + authorities + additional):
+        name, offset = _read_dns_name(data, offset)
+        rtype, _, _, length = struct.unpack_from("!HHIH", data, offset)
+        start = offset + 10
+        offset = start + length
+        if rtype == DNS_A and length == 4:
+            value = socket.inet_ntoa(data[start:offset])
+        elif rtype == DNS_PTR:
+            value = _read_dns_name(data, start)[0]
+        elif rtype == DNS_SRV:
+            value = (struct.unpack_from("!H", data, start + 4)[0], _read_dns_name(data, start + 6)[0])
+        elif rtype == DNS_TXT:
+            value = {}
+            while start < offset:
+                item = data[start + 1 : start + 1 + data[start]].decode(errors="replace")
+                start += 1 + data[start]
+                key, _, item_value = item.partition("=")
+                value[key] = item_value
+        else:
+            continue
+        records.append((name, rtype, value))
+    return records
 
-    sys.stderr.write("\n")
-    sys.stderr.flush()
 
-    if inv_tries == 10:
-        return False, None, "No response from the ESP"
+class DiscoveredDevice(object):
+    """A device that answered discover(), with what it announces and how fast it answered."""
+
+    def __init__(self, address, rtt):
+        self.address = address
+        self.rtt = rtt
+        self.hostname = None
+        self.port = None
+        self.txt = {}
+
+    @property
+    def name(self):
+        return "%s:%d" % (self.address, self.port) if self.port else self.address
 
-    return True, data, None
+    @property
+    def auth(self):
+        """True if the device requires a password."""
+        return self.txt.get("auth_upload") == "yes"
 
+    def update(self, records):
+        for name, rtype, value in records:
+            if rtype == DNS_SRV and name.endswith(MDNS_SERVICE):
+                self.port, self.hostname = value
+            elif rtype == DNS_TXT and name.endswith(MDNS_SERVICE):
+                self.txt.update(value)
 
-def authenticate(
-    remote_addr, remote_port, password, use_md5_password, use_old_protocol, filename, content_size, file_md5, nonce
-):
+    def as_dict(self):
+        return dict(self.__dict__, auth=self.auth)
+
+
+def discover(targets=None, deadline=DEFAULT_DISCOVERY_DEADLINE):
     """
-    Perform authentication with the ESP device.
+    Find ArduinoOTA devices with mDNS queries for the _arduino._tcp service.
+
+    With `targets`, a list of addresses, every target is queried directly (so it also
+    works across subnets) and the query is repeated with exponential backoff to the
+    targets that did not answer yet, until all answered or `deadline` seconds passed.
+    Without targets the query is multicast and answers are collected until the deadline.
+    Unlike an invitation, the query does not disturb the OTA service of the device.
+    Returns the DiscoveredDevice objects in the order they answered.
+    """
+    query = _mdns_query(MDNS_SERVICE, DNS_PTR)
+    pending = list(dict.fromkeys(targets)) if targets else [MDNS_ADDRESS]
+    found = collections.OrderedDict()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        start = time.time()
+        next_query = start
+        interval = DISCOVERY_RETRY
+        while pending:
+            now = time.time()
+            if now >= start + deadline:
+                break
+            if now >= next_query:
+                for address in pending:
+                    try:
+                        sock.sendto(query, (address, MDNS_PORT))
+                    except OSError as e:
+                        logging.debug("Could not query %s: %s", address, str(e))
+                next_query = now + interval
+                interval = min(interval * 2, DISCOVERY_MAX_RETRY)
+            readable, _, _ = select.select([sock], [], [], max(min(next_query, start + deadline) - now, 0))
+            if not readable:
+                continue
+            try:
+                data, remote = sock.recvfrom(9000)
+                records = parse_mdns_response(data)
+            except (OSError, ValueError, IndexError, struct.error):
+                continue
+            if not any(rtype == DNS_PTR and name == MDNS_SERVICE for name, rtype, _ in records):
+                continue
+            address = remote[0]
+            if address not in found:
+                found[address] = DiscoveredDevice(address, time.time() - start)
+                logging.debug("%s answered in %.0f ms", address, found[address].rtt * 1000)
+            found[address].update(records)
+            if targets and address in pending:
+                pending.remove(address)
+    finally:
+        sock.close()
+    return list(found.values())
 
-    Args:
-        use_md5_password: If True, hash password with MD5 instead of SHA256
-        use_old_protocol: If True, use old MD5 challenge/response protocol (pre-3.3.1)
 
-    Returns (success, error_message) tuple.
+class OTAMetrics(object):
     """
-    cnonce_text = "%s%u%s%s" % (filename, content_size, file_md5, remote_addr)
-    remote_address = (remote_addr, int(remote_port))
+    Timings (in seconds) and byte counters collected during one upload session.
 
-    if use_old_protocol:
-        # Generate client nonce (cnonce)
-        cnonce = hashlib.md5(cnonce_text.encode()).hexdigest()
+    first_byte_time is the time from the start of the session to the first byte of
+    payload sent, chunk_rtts the time between sending each chunk and its acknowledgment,
+    result_time the time from the last acknowledgment to the result of the update,
+    chunk_size the size of the chunks the transfer settled on and key_time the time
+    spent deriving authentication keys, waiting for a worker included.
+    """
 
-        # Old MD5 challenge/response protocol (pre-3.3.1)
-        # 1. Hash the password with MD5
-        password_hash = hashlib.md5(password.encode()).hexdigest()
+    def __init__(self):
+        self.invitation_time = None
+        self.auth_time = None
+        self.transfer_time = None
+        self.total_time = None
+        self.bytes_sent = 0
+        self.bytes_acked = 0
+        self.encoding = "raw"
+        self.payload_size = 0
+        self.start_time = None
+        self.first_byte_time = None
+        self.chunk_rtts = []
+        self.resumes = 0
+        self.result_time = None
+        self.chunk_size = None
+        self.key_time = None
+
+    def throughput(self):
+        """Transfer rate in bytes per second, 0 if no data has been transferred."""
+        if not self.transfer_time:
+            return 0
+        return self.bytes_sent / self.transfer_time
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def rtt_histogram(rtts, buckets=RTT_BUCKETS):
+    """
+    Count round trip times into buckets: counts[i] is the number of RTTs up to buckets[i],
+    the extra last count those above all bounds. Bounds are reported in milliseconds.
+    """
+    counts = [0] * (len(buckets) + 1)
+    for rtt in rtts:
+        index = 0
+        while index < len(buckets) and rtt > buckets[index]:
+            index += 1
+        counts[index] += 1
+    return {"le_ms": [bound * 1000 for bound in buckets], "counts": counts}
+
+
+class JSONLinesTelemetry(object):
+    """
+    Write the events of OTA sessions to `stream` as JSON lines, for dashboards.
+
+    Pass an instance as the telemetry of an OTAClient. Every line is an object with
+    "time" (Unix time), "event", "device" and the fields of the event:
+
+    - start: command, size, md5
+    - invitation: attempt, latency, features (accepted by the device)
+    - auth: protocol ("none", "md5", "sha256" or "session"), password_hash, duration, key_time
+    - resume: attempt, offset
+    - transfer: encoding, bytes_sent, payload_size, duration, throughput, first_byte_time,
+      chunk_size (the one the transfer settled on), window, ack_rtt (see rtt_histogram())
+    - result: status ("ok", "unconfirmed" or "failed"), error (or why the success is unconfirmed), error_class,
+      bytes_sent, total_time, result_time
+
+    error_class is the step that failed: "listen", "invitation", "auth", "connect",
+    "transfer", "result", "update" (the device rejected the image), "image" (refused
+    before the invitation, see check_app_image()) or "offline".
+    Lines of concurrent sessions do not interleave.
+    """
 
-        # 2. Create challenge response
-        challenge = "%s:%s:%s" % (password_hash, nonce, cnonce)
-        response = hashlib.md5(challenge.encode()).hexdigest()
-        expected_response_length = 32
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, session, event, fields):
+        record = collections.OrderedDict([("time", round(time.time(), 3)), ("event", event), ("device", session.name)])
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def _xor_bytes(data):
+    """XOR of all the bytes of `data`, folded as one big integer instead of byte by byte."""
+    length = len(data)
+    value = int.from_bytes(data, "little")
+    while length > 1:
+        half = (length + 1) // 2
+        value = (value & ((1 << (8 * half)) - 1)) ^ (value >> (8 * half))
+        length = half
+    return value & 0xFF
+
+
+def check_app_image(f):
+    """
+    Check the app image in the open file `f` the way the bootloader will: magic byte, segment
+    count, segment lengths against the file length, checksum and the appended SHA256.
+
+    Returns a dict with "error" (None if the image is valid), "chip" (name, or the hex ID
+    if unknown), "chip_id", "segments", "image_size" (without any signature block) and
+    "hash_appended".
+    """
+    info = {"error": None, "chip": None, "chip_id": None, "segments": 0, "image_size": 0, "hash_appended": False}
+    header = f.read(ESP_IMAGE_HEADER_SIZE)
+    if len(header) < ESP_IMAGE_HEADER_SIZE or header[0] != ESP_IMAGE_MAGIC:
+        info["error"] = "Not an app image, no 0x%02X magic byte" % ESP_IMAGE_MAGIC
+        return info
+    chip_id = struct.unpack_from("<H", header, 12)[0]
+    info.update(
+        chip_id=chip_id,
+        chip=ESP_CHIP_NAMES.get(chip_id, "0x%04x" % chip_id),
+        segments=header[1],
+        hash_appended=header[23] == 1,
+    )
+    if not 0 < header[1] <= ESP_IMAGE_MAX_SEGMENTS:
+        info["error"] = "Invalid segment count %d" % header[1]
+        return info
+
+    sha256 = hashlib.sha256(header)
+    checksum = ESP_CHECKSUM_MAGIC
+    offset = ESP_IMAGE_HEADER_SIZE
+    for index in range(header[1]):
+        segment = f.read(8)
+        if len(segment) < 8:
+            info["error"] = "Truncated in the header of segment %d" % index
+            return info
+        sha256.update(segment)
+        remaining = struct.unpack_from("<I", segment, 4)[0]
+        offset += 8 + remaining
+        while remaining:
+            block = f.read(min(remaining, HASH_BLOCK_SIZE))
+            if not block:
+                info["error"] = "Truncated in segment %d, %d bytes missing" % (index, remaining)
+                return info
+            sha256.update(block)
+            checksum ^= _xor_bytes(block)
+            remaining -= len(block)
+    # The checksum byte ends the image on a 16 byte boundary
+    padding = 16 - offset % 16
+    tail = f.read(padding)
+    offset += padding
+    if len(tail) < padding:
+        info["error"] = "Truncated before the checksum"
+        return info
+    sha256.update(tail)
+    if tail[-1] != checksum:
+        info["error"] = "Checksum mismatch, 0x%02X instead of 0x%02X" % (tail[-1], checksum)
+        return info
+    if info["hash_appended"]:
+        digest = f.read(32)
+        offset += 32
+        if len(digest) < 32:
+            info["error"] = "Truncated in the appended SHA256"
+            return info
+        if digest != sha256.digest():
+            info["error"] = "SHA256 mismatch"
+            return info
+    info["image_size"] = offset
+    return info
+
+
+class OTAImage(object):
+    """
+    An image file to upload.
+
+    The file is hashed once, block by block, and never loaded whole in memory:
+    every session opens its own handle and sends it with socket.sendfile(), so
+    concurrent sessions share the OS page cache instead of private copies.
+    With use_cache, the MD5 is kept in the espota cache directory (see md5_cache_filename())
+    for the path, size, mtime, ctime and inode of the file, so repeated pushes of the same
+    build skip hashing altogether, and rewriting the file, even keeping its size and mtime,
+    changes its ctime and invalidates the entry.
+
+    When the device accepts it, the image is sent as a zlib stream instead,
+    compressed once in memory (see compressed()), or as a patch against the
+    image the device runs (see delta()).
+    """
+
+    def __init__(self, filename, use_cache=True):
+        self.filename = filename
+        st = os.stat(filename)
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self._stat_key = "%d %d %d %d" % (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+        self._lock = threading.Lock()
+        self._compressed = None
+        self._digest = None
+        self._patches = {}
+        self._validation = None
+        self.md5 = self._read_cached_md5() if use_cache else None
+        if self.md5 is None:
+            self.md5 = self._hash()
+            if use_cache:
+                self._write_cached_md5()
+
+    @property
+    def cache_filename(self):
+        return md5_cache_filename(self.filename)
+
+    def _hash(self):
+        md5 = hashlib.md5()
+        buf = bytearray(HASH_BLOCK_SIZE)
+        view = memoryview(buf)
+        with open(self.filename, "rb") as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                md5.update(view[:n])
+        return md5.hexdigest()
+
+    def _read_cached_md5(self):
+        try:
+            with open(self.cache_filename, "r") as f:
+                stat_key, md5 = f.read().rsplit(" ", 1)
+            md5 = md5.strip()
+            if stat_key == self._stat_key and len(md5) == 32:
+                logging.debug("Using cached MD5 from %s", self.cache_filename)
+                return md5
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _write_cached_md5(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_filename), exist_ok=True)
+            tmp_filename = "%s.%d.tmp" % (self.cache_filename, os.getpid())
+            with open(tmp_filename, "w") as f:
+                f.write("%s %s\n" % (self._stat_key, self.md5))
+            os.replace(tmp_filename, self.cache_filename)
+        except OSError as e:
+            logging.debug("Could not write MD5 cache %s: %s", self.cache_filename, str(e))
+
+    def open(self):
+        return open(self.filename, "rb")
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    def validate(self, cache=None):
+        """
+        check_app_image() of this image, done once and shared by all sessions. `cache`,
+        a ValidationCache, keeps the result across runs so the file is not read again.
+        """
+        with self._lock:
+            if self._validation is None:
+                self._validation = cache.get(self.md5) if cache is not None else None
+                if self._validation is None:
+                    with self.open() as f:
+                        self._validation = check_app_image(f)
+                    if cache is not None:
+                        cache.set(self.md5, self._validation)
+            return self._validation
+
+    def digest(self):
+        """
+        SHA256 the device reports for this app image once it runs it (esp_partition_get_sha256):
+        the hash esptool appended to the image if its extended header says so, or else the
+        SHA256 of the whole file.
+        """
+        with self._lock:
+            if self._digest is None:
+                self._digest = self._compute_digest()
+            return self._digest
+
+    def _compute_digest(self):
+        with self.open() as f:
+            header = f.read(24)
+            if len(header) == 24 and header[0] == ESP_IMAGE_MAGIC and header[23] == 1 and self.size >= 24 + 32:
+                f.seek(-32, os.SEEK_END)
+                return f.read(32).hex()
+            f.seek(0)
+            sha256 = hashlib.sha256()
+            for block in iter(functools.partial(f.read, HASH_BLOCK_SIZE), b""):
+                sha256.update(block)
+            return sha256.hexdigest()
+
+    def delta(self, base, compressed=False):
+        """
+        Return a patch rebuilding this image from `base`, an OTAImage of the build the device
+        runs, zlib compressed if asked. Returns None if the patch is not smaller than the image.
+        Computed once per base and shared by all sessions.
+        """
+        key = base.digest()
+        with self._lock:
+            if key not in self._patches:
+                patch = make_patch(base.read(), self.read())
+                logging.debug("Patch against %s: %d bytes for a %d bytes image", key[:16], len(patch), self.size)
+                self._patches[key] = (patch, zlib.compress(patch, 9)) if len(patch) < self.size else None
+            patches = self._patches[key]
+        if patches is None:
+            return None
+        return patches[1] if compressed else patches[0]
+
+    def compressed(self):
+        """
+        Return the image as a zlib stream for devices that accept compressed transfers,
+        or None if it does not compress. Computed once and shared by all sessions.
+        """
+        with self._lock:
+            if self._compressed is None:
+                compressor = zlib.compressobj(9)
+                parts = []
+                with self.open() as f:
+                    for block in iter(functools.partial(f.read, HASH_BLOCK_SIZE), b""):
+                        parts.append(compressor.compress(block))
+                parts.append(compressor.flush())
+                self._compressed = b"".join(parts)
+                logging.debug("Compressed image from %d to %d bytes", self.size, len(self._compressed))
+            if len(self._compressed) >= self.size:
+                return None
+            return self._compressed
+
+
+def default_cache_dir():
+    """Per-user directory where espota keeps its caches."""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
     else:
-        # Generate client nonce (cnonce) using SHA256 for new protocol
-        cnonce = hashlib.sha256(cnonce_text.encode()).hexdigest()
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "espota")
 
-        # New PBKDF2-HMAC-SHA256 challenge/response protocol (3.3.1+)
-        # The password can be hashed with either MD5 or SHA256
-        if use_md5_password:
-            # Use MD5 for password hash (for devices that stored MD5 hashes)
-            logging.warning(
-                "Using insecure MD5 hash for password due to legacy device support. "
-                "Please upgrade devices to ESP32 Arduino Core 3.3.1+ for improved security."
-            )
-            password_hash = hashlib.md5(password.encode()).hexdigest()
-        else:
-            # Use SHA256 for password hash (recommended)
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
 
-        # 2. Derive key using PBKDF2-HMAC-SHA256 with the password hash
-        salt = nonce + ":" + cnonce
-        derived_key = hashlib.pbkdf2_hmac("sha256", password_hash.encode(), salt.encode(), 10000)
-        derived_key_hex = derived_key.hex()
+def md5_cache_filename(filename):
+    """Where OTAImage caches the MD5 of the image in `filename`, one entry per absolute path."""
+    key = hashlib.sha256(os.path.abspath(filename).encode(errors="surrogateescape")).hexdigest()
+    return os.path.join(default_cache_dir(), "md5", key)
 
-        # 3. Create challenge response
-        challenge = derived_key_hex + ":" + nonce + ":" + cnonce
-        response = hashlib.sha256(challenge.encode()).hexdigest()
-        expected_response_length = 64
 
-    # Send authentication response
-    sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        message = "%d %s %s\n" % (AUTH, cnonce, response)
-        sock2.sendto(message.encode(), remote_address)
-        sock2.settimeout(10)
+def _write_json(filename, data):
+    """Replace `filename` atomically with `data` as JSON."""
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_filename, filename)
+
+
+class AuthCache(object):
+    """
+    Remember which authentication variant last succeeded for each device.
+
+    Entries are keyed by "address:port" and stored as JSON, for example
+    {"192.168.1.10:3232": {"protocol": "sha256", "password_hash": "md5"}}.
+    Trying the remembered password hash first saves a failed attempt, a new
+    invitation and a second PBKDF2 derivation on devices that still store an
+    MD5 password hash. The cache is safe to share between concurrent sessions.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
         try:
-            data = sock2.recv(expected_response_length).decode()
-        except:  # noqa: E722
-            sock2.close()
-            return False, "No Answer to our Authentication"
+            with open(filename, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self._entries = entries
+        except (OSError, ValueError):
+            pass
+
+    def get(self, device):
+        with self._lock:
+            return dict(self._entries.get(device, {}))
+
+    def set(self, device, protocol, password_hash):
+        entry = {"protocol": protocol, "password_hash": password_hash}
+        with self._lock:
+            if self._entries.get(device) == entry:
+                return
+            self._entries[device] = entry
+            try:
+                _write_json(self.filename, self._entries)
+            except OSError as e:
+                logging.debug("Could not write authentication cache %s: %s", self.filename, str(e))
+
+
+class ValidationCache(object):
+    """
+    Remember the check_app_image() result of every image, keyed by its MD5.
 
-        if data != "OK":
-            sock2.close()
-            return False, data
-
-        sock2.close()
-        return True, None
-    except Exception as e:
-        sock2.close()
-        return False, str(e)
-
-
-def serve(  # noqa: C901
-    remote_addr, local_addr, remote_port, local_port, password, md5_target, filename, command=FLASH
-):
-    # Create a TCP/IP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = (local_addr, local_port)
-    logging.info("Starting on %s:%s", str(server_address[0]), str(server_address[1]))
-    try:
-        sock.bind(server_address)
-        sock.listen(1)
-    except Exception as e:
-        logging.error("Listen Failed: %s", str(e))
-        return 1
+    Stored as JSON, for example {"<md5>": {"error": null, "chip": "esp32s3", ..., "checked": <time>}}.
+    Only the MAX_VALIDATIONS images checked last are kept. The cache is safe to share
+    between concurrent sessions.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(filename, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self._entries = {md5: entry for md5, entry in entries.items() if isinstance(entry, dict)}
+        except (OSError, ValueError):
+            pass
+
+    def get(self, md5):
+        with self._lock:
+            entry = self._entries.get(md5)
+            return dict(entry) if entry is not None else None
+
+    def set(self, md5, info):
+        entry = dict(info, checked=round(time.time(), 3))
+        with self._lock:
+            self._entries[md5] = entry
+            for old in sorted(self._entries, key=lambda key: self._entries[key].get("checked", 0))[:-MAX_VALIDATIONS]:
+                del self._entries[old]
+            try:
+                _write_json(self.filename, self._entries)
+            except OSError as e:
+                logging.debug("Could not write validation cache %s: %s", self.filename, str(e))
+
+
+class ImageCache(object):
+    """
+    Keep a copy of the last app image pushed to each device, used as base of the next delta update.
+
+    Images are stored once as "<digest>.bin", where digest is OTAImage.digest(), and
+    devices.json maps every "address:port" to the digest of the image it was sent.
+    Images no device refers to any more are removed, and the least recently used ones
+    when they take more than max_size bytes, forgetting the devices that ran them. The
+    device checks that it really runs the proposed base before accepting a patch, so a
+    stale or evicted entry only costs a full transfer.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_IMAGE_CACHE_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._devices = {}
+        try:
+            with open(self.index_filename, "r") as f:
+                devices = json.load(f)
+            if isinstance(devices, dict):
+                self._devices = devices
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, "devices.json")
+
+    def _image_filename(self, digest):
+        return os.path.join(self.directory, digest + ".bin")
+
+    def digest_for(self, device):
+        """Return the digest of the image last pushed to `device`, or None."""
+        with self._lock:
+            return self._devices.get(device)
+
+    def base_for(self, device):
+        """Return the OTAImage last pushed to `device`, or None."""
+        digest = self.digest_for(device)
+        if digest is None:
+            return None
+        try:
+            os.utime(self._image_filename(digest))
+            return OTAImage(self._image_filename(digest))
+        except OSError:
+            return None
+
+    def remember(self, device, image):
+        digest = image.digest()
+        with self._lock:
+            if self._devices.get(device) == digest:
+                return
+            try:
+                filename = self._image_filename(digest)
+                if not os.path.exists(filename):
+                    os.makedirs(self.directory, exist_ok=True)
+                    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+                    shutil.copyfile(image.filename, tmp_filename)
+                    os.replace(tmp_filename, filename)
+                self._devices[device] = digest
+                self._prune(digest)
+                _write_json(self.index_filename, self._devices)
+            except OSError as e:
+                logging.debug("Could not update image cache %s: %s", self.directory, str(e))
+
+    def _prune(self, keep):
+        """Remove the images no device refers to, then the least recently used ones but `keep` over max_size."""
+        in_use = set(self._devices.values())
+        images = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            digest = name[: -len(".bin")]
+            if digest not in in_use:
+                self._remove(digest)
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            images.append((st.st_mtime, st.st_size, digest))
+        total = sum(size for _, size, _ in images)
+        for _, size, digest in sorted(images):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            self._remove(digest)
+            self._devices = {device: d for device, d in self._devices.items() if d != digest}
+            total -= size
+
+    def _remove(self, digest):
+        for filename in (self._image_filename(digest), md5_cache_filename(self._image_filename(digest))):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class OTAClient(object):
+    """
+    Configuration shared by OTA upload sessions.
+
+    The client holds everything that does not depend on the target device
+    (host address, password, timeouts, transfer window, console output and
+    progress callback) and creates one OTASession per upload. Nothing is kept
+    in module globals, so a single client can drive many sessions from threads
+    or from asyncio.
+
+    progress_callback, if set, is called as progress_callback(session, done, total)
+    every time a chunk has been sent. auth_cache, if set, is an AuthCache used
+    to try the authentication variant that worked last time first. With
+    compress, the image is sent zlib compressed to devices that support it.
+
+    App images are sent as a patch to devices that run delta_base, an OTAImage
+    of the previous build, or else the image image_cache (an ImageCache) says
+    was last pushed to them.
+
+    If the connection drops during the transfer, devices that support it are
+    invited again up to resume_attempts times and the upload continues where
+    the device stopped receiving.
+
+    Invitations are repeated with growing intervals up to timeout for at most
+    invitation_deadline seconds. After the transfer the device has result_timeout
+    seconds to report the result, or to reboot if it closes the connection first.
+
+    telemetry, if set, is called as telemetry(session, event, fields) at every
+    step of a session, see JSONLinesTelemetry for the events.
+
+    chunk_size fixes the size of the chunks written to the socket, by default (0)
+    pipelined transfers pick it with a ChunkTuner. send_buffer sets SO_SNDBUF of
+    the data connection, by default the system sizes it.
+
+    key_executor, if set, is a concurrent.futures executor the PBKDF2 key derivations
+    run in instead of the session thread, e.g. a ProcessPoolExecutor shared by a fleet
+    push, so that they run in parallel where hashlib holds the GIL while deriving.
+
+    With validate, app images are checked with check_app_image() before the device
+    is invited, and refused if broken or built for another chip than `chip` (or the
+    chip a device announced over mDNS). validation_cache, if set, is a ValidationCache
+    that spares reading the same image again on the next runs.
+    """
 
-    content_size = os.path.getsize(filename)
-    with open(filename, "rb") as f:
-        file_md5 = hashlib.md5(f.read()).hexdigest()
-    logging.info("Upload size: %d", content_size)
-    message = "%d %d %d %s\n" % (command, local_port, content_size, file_md5)
+    def __init__(
+        self,
+        host_ip="0.0.0.0",
+        host_port=0,
+        password="",
+        md5_target=False,
+        timeout=10,
+        window=DEFAULT_WINDOW,
+        progress_bar=False,
+        out=None,
+        progress_callback=None,
+        auth_cache=None,
+        compress=True,
+        delta_base=None,
+        image_cache=None,
+        resume_attempts=DEFAULT_RESUME_ATTEMPTS,
+        invitation_deadline=DEFAULT_INVITATION_DEADLINE,
+        discovery_deadline=DEFAULT_DISCOVERY_DEADLINE,
+        result_timeout=DEFAULT_RESULT_TIMEOUT,
+        telemetry=None,
+        chunk_size=0,
+        send_buffer=0,
+        key_executor=None,
+        validate=True,
+        chip=None,
+        validation_cache=None,
+    ):
+        self.host_ip = host_ip
+        self.host_port = host_port
+        self.password = password
+        self.md5_target = md5_target
+        self.timeout = timeout
+        self.window = max(window, 1)
+        self.progress_bar = progress_bar
+        self.out = out if out is not None else NullOutput()
+        self.progress_callback = progress_callback
+        self.auth_cache = auth_cache
+        self.compress = compress
+        self.delta_base = delta_base
+        self.image_cache = image_cache
+        self.resume_attempts = max(resume_attempts, 0)
+        self.invitation_deadline = invitation_deadline
+        self.discovery_deadline = discovery_deadline
+        self.result_timeout = result_timeout
+        self.telemetry = telemetry
+        self.chunk_size = chunk_size
+        self.send_buffer = send_buffer
+        self.key_executor = key_executor
+        self.validate = validate
+        self.chip = chip
+        self.validation_cache = validation_cache
+
+    def listen(self, host_port):
+        """Open the TCP socket devices connect to for the transfer, on host_port or any free port if 0."""
+        # Create a TCP/IP socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_address = (self.host_ip, host_port)
+        logging.info("Starting on %s:%s", str(server_address[0]), str(server_address[1]))
+        try:
+            sock.bind(server_address)
+            sock.listen(1)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def session(self, remote_addr, image, remote_port=3232, command=FLASH, host_port=None):
+        """Create an upload session for one device. `image` is an OTAImage."""
+        if host_port is None:
+            host_port = self.host_port
+        return OTASession(self, remote_addr, remote_port, image, command, host_port)
+
+    def upload(self, remote_addr, image, remote_port=3232, command=FLASH, host_port=None):
+        """Upload an image to one device. Returns the finished OTASession."""
+        session = self.session(remote_addr, image, remote_port, command, host_port)
+        session.run()
+        return session
+
+    def upload_images(self, remote_addr, images, remote_port=3232, host_port=None):
+        """
+        Upload several images to one device in a single session, e.g. the filesystem and then the app.
+
+        `images` is a list of (command, OTAImage) tuples, sent in that order. Every image
+        but the last asks the device not to reboot, and devices that agree let the next
+        image in with a token derived from the first authentication instead of a new
+        challenge. Others reboot after each image, which is waited for. All transfers
+        use the same listening socket. Stops at the first failure.
+        Returns the finished sessions.
+        """
+        if host_port is None:
+            host_port = self.host_port
+        sessions = []
+        try:
+            listener = self.listen(host_port)
+        except Exception as e:
+            logging.error("Listen Failed: %s", str(e))
+            session = self.session(remote_addr, images[0][1], remote_port, images[0][0], host_port)
+            return [session.skip("Listen Failed: %s" % str(e), "listen")]
+        try:
+            previous = None
+            for index, (command, image) in enumerate(images):
+                session = self.session(remote_addr, image, remote_port, command, host_port)
+                session.more = index < len(images) - 1
+                if previous is not None:
+                    if "more" in previous.features:
+                        session.session_key = previous.derived_key or previous.session_key
+                    else:
+                        logging.info("Device did not accept more images, waiting for it to reboot")
+                        previous.wait_for_reboot(time.time() + self.result_timeout)
+                sessions.append(session)
+                if session.run(listener):
+                    break
+                previous = session
+        finally:
+            listener.close()
+        return sessions
+
+    async def upload_async(self, remote_addr, image, remote_port=3232, command=FLASH, host_port=None):
+        """Same as upload(), running the blocking session in the default executor of the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.upload, remote_addr, image, remote_port, command, host_port)
+        )
 
-    # Send invitation and get authentication challenge
-    success, data, error = send_invitation_and_get_auth_challenge(remote_addr, remote_port, message)
-    if not success:
-        logging.error(error)
+    def upload_many(self, targets, image, command=FLASH, jobs=8, skip_offline=False):
+        """
+        Upload the same image to many devices concurrently.
+
+        `targets` is a list of (address, port) tuples. Up to `jobs` sessions run
+        at once, each one listening on its own host port (host_port + index, or a
+        free port picked by the OS if host_port is 0). With skip_offline, targets
+        that do not answer discover() within discovery_deadline are not invited, and
+        the others are checked against the chip they announce.
+        Returns the finished sessions in target order.
+        """
+        online = None
+        if skip_offline:
+            online = {device.address: device for device in discover([t[0] for t in targets], self.discovery_deadline)}
+
+        def push(index, target):
+            threading.current_thread().name = "%s:%d" % target
+            host_port = self.host_port + index if self.host_port else 0
+            session = self.session(target[0], image, target[1], command, host_port)
+            if online is None:
+                session.run()
+            elif target[0] not in online:
+                session.skip("Offline")
+            else:
+                # Firmware announcing its chip lets an image for another one be refused right away
+                session.chip = online[target[0]].txt.get("chip")
+                session.run()
+            return session
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [executor.submit(push, index, target) for index, target in enumerate(targets)]
+            return [future.result() for future in futures]
+
+
+class OTASession(object):
+    """
+    One OTA upload of an image to a single device.
+
+    run() goes through the invitation, authentication and transfer steps and
+    returns 0 on success or 1 on failure. The return code is also kept in
+    `result`, the failure reason in `error` and timings and byte counts in
+    `metrics`.
+    """
+
+    def __init__(self, client, remote_addr, remote_port, image, command=FLASH, host_port=0):
+        self.client = client
+        self.remote_addr = remote_addr
+        self.remote_port = int(remote_port)
+        self.image = image
+        self.content_size = image.size
+        self.file_md5 = image.md5
+        self.payload_size = image.size
+        self.base = None
+        self.ack_timeout = ACK_TIMEOUT
+        self.acks = None  # AckParser of the last transfer, wait_for_result() continues with it
+        self.connection_error = None  # Why the connection broke after the last chunk was sent
+        self.command = command
+        self.host_port = host_port
+        self.out = client.out
+        self.more = False  # Another image follows, ask the device not to reboot after this one
+        self.session_key = None  # Derived key of the previous image of a multi-image session
+        self.derived_key = None
+        self.features = {}  # Features the device accepted, by name
+        self.chip = None  # Chip of the device if known, e.g. from the mDNS TXT record
+        self.result = None
+        self.error = None
+        self.error_class = None
+        self.unconfirmed = None  # Why a success is only presumed, the device closed the connection without a result
+        self.step = None  # Step the session is in, the error class if it fails
+        self.auth_protocol = None
+        self.password_hash = None
+        self.metrics = OTAMetrics()
+
+    @property
+    def name(self):
+        return "%s:%d" % (self.remote_addr, self.remote_port)
+
+    def skip(self, reason, error_class="offline"):
+        """Mark the session failed without running it. Returns self."""
+        self.result = 1
+        self.error = reason
+        self.error_class = error_class
+        self.metrics.total_time = 0
+        self._emit_result()
+        return self
+
+    def _write(self, text):
+        self.out.write(text)
+        self.out.flush()
+
+    def _fail(self, message, *args, error_class=None):
+        self.error = message % args if args else message
+        self.error_class = error_class or self.step
+        logging.error(message, *args)
         return 1
 
-    if data != "OK":
-        if data.startswith("AUTH"):
-            nonce = data.split()[1]
-            nonce_length = len(nonce)
-
-            # Detect protocol version based on nonce length:
-            # - 32 chars = Old MD5 protocol (pre-3.3.1)
-            # - 64 chars = New SHA256 protocol (3.3.1+)
-
-            if nonce_length == 32:
-                # Scenario 1: Old device (pre-3.3.1) using MD5 protocol
-                logging.info("Detected old MD5 protocol (pre-3.3.1)")
-                sys.stderr.write("Authenticating (MD5 protocol)...")
-                sys.stderr.flush()
-                auth_success, auth_error = authenticate(
-                    remote_addr,
-                    remote_port,
-                    password,
-                    use_md5_password=True,
-                    use_old_protocol=True,
-                    filename=filename,
-                    content_size=content_size,
-                    file_md5=file_md5,
-                    nonce=nonce,
+    def _unconfirmed(self, message, *args):
+        self.unconfirmed = message % args if args else message
+        logging.warning("Update not confirmed: " + message, *args)
+        return 0
+
+    def _emit(self, event, **fields):
+        if self.client.telemetry:
+            self.client.telemetry(self, event, fields)
+
+    def _emit_result(self):
+        self._emit(
+            "result",
+            status="failed" if self.result else "unconfirmed" if self.unconfirmed else "ok",
+            error=self.error or self.unconfirmed,
+            error_class=self.error_class,
+            bytes_sent=self.metrics.bytes_sent,
+            total_time=self.metrics.total_time,
+            result_time=self.metrics.result_time,
+        )
+
+    def _progress(self, done):
+        update_progress(done / float(self.payload_size), self.out, self.client.progress_bar)
+        if self.client.progress_callback:
+            self.client.progress_callback(self, done, self.payload_size)
+
+    def _cached_auth(self):
+        if self.client.auth_cache is None:
+            return {}
+        return self.client.auth_cache.get(self.name)
+
+    def _remember_auth(self, protocol, password_hash):
+        self.auth_protocol = protocol
+        self.password_hash = password_hash
+        if self.client.auth_cache is not None:
+            self.client.auth_cache.set(self.name, protocol, password_hash)
+
+    def send_invitation(self, message):
+        """
+        Send invitation to ESP device and get authentication challenge.
+
+        The invitation is repeated with exponential backoff, from INVITATION_RETRY up to
+        the client timeout between attempts, until the device answers or the invitation
+        deadline passed. All attempts use the same socket, so a late answer still counts.
+        Returns (success, auth_data, error_message) tuple.
+        """
+        remote_address = (self.remote_addr, self.remote_port)
+        self._write("Sending invitation to %s " % self.remote_addr)
+
+        sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            deadline = time.time() + self.client.invitation_deadline
+            interval = min(INVITATION_RETRY, self.client.timeout)
+            while True:
+                try:
+                    sock2.sendto(message.encode(), remote_address)
+                except:  # noqa: E722
+                    self._write("failed\n")
+                    return False, None, "Host %s Not Found" % self.remote_addr
+
+                wait = min(interval, deadline - time.time())
+                attempt_end = time.time() + wait
+                readable, _, _ = select.select([sock2], [], [], max(wait, 0))
+                if readable:
+                    try:
+                        # The new protocol (SHA256) sends 69 bytes, the old MD5 protocol 37 bytes.
+                        # Devices that understand the EXT line append the features they accept.
+                        data = sock2.recv(256).decode()
+                        self._write("\n")
+                        return True, data, None
+                    except OSError:
+                        # Some systems report an ICMP port unreachable here, wait as if nothing came
+                        time.sleep(max(attempt_end - time.time(), 0))
+                if time.time() >= deadline:
+                    break
+                self._write(".")
+                interval = min(interval * 2, self.client.timeout)
+        finally:
+            sock2.close()
+
+        self._write("\n")
+        return False, None, "No response from the ESP"
+
+    def _derive_key(self, password_hash, salt):
+        """derive_key() in the key executor of the client if any, else in this thread."""
+        start = time.time()
+        derived_key = None
+        executor = self.client.key_executor
+        if executor is not None:
+            try:
+                # The device gives up on the challenge after a while, do not wait for a stuck pool
+                derived_key = executor.submit(derive_key, password_hash, salt).result(self.client.timeout)
+            except (concurrent.futures.TimeoutError, concurrent.futures.BrokenExecutor, RuntimeError) as e:
+                logging.warning("Key derivation worker failed (%s), deriving here", str(e) or type(e).__name__)
+        if derived_key is None:
+            derived_key = derive_key(password_hash, salt)
+        self.metrics.key_time = (self.metrics.key_time or 0) + time.time() - start
+        logging.debug("Derived the authentication key in %.1f ms", (time.time() - start) * 1000)
+        return derived_key
+
+    def send_auth_response(self, use_md5_password, use_old_protocol, nonce):
+        """
+        Answer the authentication challenge of the ESP device.
+
+        Args:
+            use_md5_password: If True, hash password with MD5 instead of SHA256
+            use_old_protocol: If True, use old MD5 challenge/response protocol (pre-3.3.1)
+
+        Returns (success, error_message) tuple.
+        """
+        password = self.client.password
+        cnonce_text = "%s%u%s%s" % (self.image.filename, self.content_size, self.file_md5, self.remote_addr)
+        remote_address = (self.remote_addr, self.remote_port)
+
+        if use_old_protocol:
+            # Generate client nonce (cnonce)
+            cnonce = hashlib.md5(cnonce_text.encode()).hexdigest()
+
+            # Old MD5 challenge/response protocol (pre-3.3.1)
+            # 1. Hash the password with MD5
+            password_hash = hashlib.md5(password.encode()).hexdigest()
+
+            # 2. Create challenge response
+            challenge = "%s:%s:%s" % (password_hash, nonce, cnonce)
+            response = hashlib.md5(challenge.encode()).hexdigest()
+            expected_response_length = 32
+        else:
+            # Generate client nonce (cnonce) using SHA256 for new protocol
+            cnonce = hashlib.sha256(cnonce_text.encode()).hexdigest()
+
+            # New PBKDF2-HMAC-SHA256 challenge/response protocol (3.3.1+)
+            # The password can be hashed with either MD5 or SHA256
+            if use_md5_password:
+                # Use MD5 for password hash (for devices that stored MD5 hashes)
+                logging.warning(
+                    "Using insecure MD5 hash for password due to legacy device support. "
+                    "Please upgrade devices to ESP32 Arduino Core 3.3.1+ for improved security."
                 )
+                password_hash = hashlib.md5(password.encode()).hexdigest()
+            else:
+                # Use SHA256 for password hash (recommended)
+                password_hash = hashlib.sha256(password.encode()).hexdigest()
 
-                if not auth_success:
-                    sys.stderr.write("FAIL\n")
-                    logging.error("Authentication Failed: %s", auth_error)
-                    return 1
-
-                sys.stderr.write("OK\n")
-                logging.warning("====================================================================")
-                logging.warning("WARNING: Device is using old MD5 authentication protocol (pre-3.3.1)")
-                logging.warning("Please update to ESP32 Arduino Core 3.3.1+ for improved security.")
-                logging.warning("======================================================================")
-
-            elif nonce_length == 64:
-                # New protocol (3.3.1+) - try SHA256 password first, then MD5 if it fails
-
-                # Scenario 2: Try SHA256 password hash first (recommended for new devices)
-                if md5_target:
-                    # User explicitly requested MD5 password hash
-                    logging.info("Using MD5 password hash as requested")
-                    sys.stderr.write("Authenticating (SHA256 protocol with MD5 password)...")
-                    sys.stderr.flush()
-                    auth_success, auth_error = authenticate(
-                        remote_addr,
-                        remote_port,
-                        password,
-                        use_md5_password=True,
-                        use_old_protocol=False,
-                        filename=filename,
-                        content_size=content_size,
-                        file_md5=file_md5,
-                        nonce=nonce,
-                    )
+            # 2. Derive key using PBKDF2-HMAC-SHA256 with the password hash
+            salt = nonce + ":" + cnonce
+            derived_key_hex = self._derive_key(password_hash, salt)
+
+            # 3. Create challenge response
+            challenge = derived_key_hex + ":" + nonce + ":" + cnonce
+            response = hashlib.sha256(challenge.encode()).hexdigest()
+            expected_response_length = 64
+
+        # Send authentication response
+        sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            message = "%d %s %s\n" % (AUTH, cnonce, response)
+            sock2.sendto(message.encode(), remote_address)
+            sock2.settimeout(10)
+            try:
+                data = sock2.recv(expected_response_length).decode()
+            except:  # noqa: E722
+                sock2.close()
+                return False, "No Answer to our Authentication"
+
+            if data != "OK":
+                sock2.close()
+                return False, data
+
+            sock2.close()
+            if not use_old_protocol:
+                # Secret shared with the device, authenticates the next image of a multi-image session
+                self.derived_key = derived_key_hex
+            return True, None
+        except Exception as e:
+            sock2.close()
+            return False, str(e)
+
+    def authenticate(self, data, message):  # noqa: C901
+        """
+        Handle the answer to the invitation, authenticating if the device sent a challenge.
+        Returns 0 if the device is ready to receive the image, 1 otherwise.
+        """
+        if data == "OK":
+            return 0
+        if not data.startswith("AUTH"):
+            return self._fail("Bad Answer: %s", data)
+
+        nonce = data.split()[1]
+        nonce_length = len(nonce)
+
+        # Detect protocol version based on nonce length:
+        # - 32 chars = Old MD5 protocol (pre-3.3.1)
+        # - 64 chars = New SHA256 protocol (3.3.1+)
+
+        if nonce_length == 32:
+            # Scenario 1: Old device (pre-3.3.1) using MD5 protocol
+            logging.info("Detected old MD5 protocol (pre-3.3.1)")
+            self._write("Authenticating (MD5 protocol)...")
+            auth_success, auth_error = self.send_auth_response(
+                use_md5_password=True, use_old_protocol=True, nonce=nonce
+            )
+
+            if not auth_success:
+                self._write("FAIL\n")
+                return self._fail("Authentication Failed: %s", auth_error)
+
+            self._write("OK\n")
+            self._remember_auth("md5", "md5")
+            logging.warning("====================================================================")
+            logging.warning("WARNING: Device is using old MD5 authentication protocol (pre-3.3.1)")
+            logging.warning("Please update to ESP32 Arduino Core 3.3.1+ for improved security.")
+            logging.warning("======================================================================")
+
+        elif nonce_length == 64:
+            # New protocol (3.3.1+) - try SHA256 password first, then MD5 if it fails
+
+            # Scenario 2: Try SHA256 password hash first (recommended for new devices)
+            if self.client.md5_target:
+                # User explicitly requested MD5 password hash
+                logging.info("Using MD5 password hash as requested")
+                self._write("Authenticating (SHA256 protocol with MD5 password)...")
+                use_md5_password = True
+                auth_success, auth_error = self.send_auth_response(
+                    use_md5_password=True, use_old_protocol=False, nonce=nonce
+                )
+            else:
+                # Start with the password hash that worked last time for this device, SHA256 if unknown
+                use_md5_password = self._cached_auth().get("password_hash") == "md5"
+                if use_md5_password:
+                    logging.info("Using MD5 password hash remembered for %s", self.name)
+                    self._write("Authenticating (SHA256 protocol with MD5 password)...")
                 else:
-                    # Try SHA256 password hash first
-                    sys.stderr.write("Authenticating...")
-                    sys.stderr.flush()
-                    auth_success, auth_error = authenticate(
-                        remote_addr,
-                        remote_port,
-                        password,
-                        use_md5_password=False,
-                        use_old_protocol=False,
-                        filename=filename,
-                        content_size=content_size,
-                        file_md5=file_md5,
-                        nonce=nonce,
+                    self._write("Authenticating...")
+                auth_success, auth_error = self.send_auth_response(
+                    use_md5_password=use_md5_password, use_old_protocol=False, nonce=nonce
+                )
+
+                # Scenario 3: If the first hash fails, try the other one (for devices with stored MD5 passwords)
+                if not auth_success:
+                    failed_hash = "MD5" if use_md5_password else "SHA256"
+                    use_md5_password = not use_md5_password
+                    retry_hash = "MD5" if use_md5_password else "SHA256"
+                    logging.info("%s password failed, trying %s password hash", failed_hash, retry_hash)
+                    self._write("Retrying with %s password..." % retry_hash)
+
+                    # Device is back in OTA_IDLE after auth failure, need to send new invitation
+                    success, data, error = self.send_invitation(message)
+                    if not success:
+                        self._write("FAIL\n")
+                        return self._fail("Failed to get new challenge for %s retry: %s", retry_hash, error)
+
+                    if not data.startswith("AUTH"):
+                        self._write("FAIL\n")
+                        return self._fail("Expected AUTH challenge for %s retry, got: %s", retry_hash, data)
+
+                    # Get new nonce for second attempt
+                    nonce = data.split()[1]
+
+                    auth_success, auth_error = self.send_auth_response(
+                        use_md5_password=use_md5_password, use_old_protocol=False, nonce=nonce
                     )
 
-                    # Scenario 3: If SHA256 fails, try MD5 password hash (for devices with stored MD5 passwords)
-                    if not auth_success:
-                        logging.info("SHA256 password failed, trying MD5 password hash")
-                        sys.stderr.write("Retrying with MD5 password...")
-                        sys.stderr.flush()
-
-                        # Device is back in OTA_IDLE after auth failure, need to send new invitation
-                        success, data, error = send_invitation_and_get_auth_challenge(remote_addr, remote_port, message)
-                        if not success:
-                            sys.stderr.write("FAIL\n")
-                            logging.error("Failed to get new challenge for MD5 retry: %s", error)
-                            return 1
-
-                        if not data.startswith("AUTH"):
-                            sys.stderr.write("FAIL\n")
-                            logging.error("Expected AUTH challenge for MD5 retry, got: %s", data)
-                            return 1
-
-                        # Get new nonce for second attempt
-                        nonce = data.split()[1]
-
-                        auth_success, auth_error = authenticate(
-                            remote_addr,
-                            remote_port,
-                            password,
-                            use_md5_password=True,
-                            use_old_protocol=False,
-                            filename=filename,
-                            content_size=content_size,
-                            file_md5=file_md5,
-                            nonce=nonce,
-                        )
-
-                        if auth_success:
-                            logging.warning("====================================================================")
-                            logging.warning("WARNING: Device authenticated with MD5 password hash (deprecated)")
-                            logging.warning("MD5 is cryptographically broken and should not be used.")
-                            logging.warning(
-                                "Please update your sketch to use either setPassword() or setPasswordHash()"
-                            )
-                            logging.warning(
-                                "with SHA256, then upload again to migrate to the new secure SHA256 protocol."
-                            )
-                            logging.warning("======================================================================")
+                if auth_success and use_md5_password:
+                    logging.warning("====================================================================")
+                    logging.warning("WARNING: Device authenticated with MD5 password hash (deprecated)")
+                    logging.warning("MD5 is cryptographically broken and should not be used.")
+                    logging.warning("Please update your sketch to use either setPassword() or setPasswordHash()")
+                    logging.warning("with SHA256, then upload again to migrate to the new secure SHA256 protocol.")
+                    logging.warning("======================================================================")
 
-                if not auth_success:
-                    sys.stderr.write("FAIL\n")
-                    logging.error("Authentication Failed: %s", auth_error)
-                    return 1
+            if not auth_success:
+                self._write("FAIL\n")
+                return self._fail("Authentication Failed: %s", auth_error)
 
-                sys.stderr.write("OK\n")
-            else:
-                logging.error("Invalid nonce length: %d (expected 32 or 64)", nonce_length)
-                return 1
+            self._write("OK\n")
+            self._remember_auth("sha256", "md5" if use_md5_password else "sha256")
+        else:
+            return self._fail("Invalid nonce length: %d (expected 32 or 64)", nonce_length)
+        return 0
+
+    def _send_chunk(self, connection, source, offset, size):
+        """Send `size` payload bytes from `offset`, out of memory or straight from the file with sendfile()."""
+        if isinstance(source, memoryview):
+            connection.sendall(source[offset : offset + size])
+        elif connection.sendfile(source, offset, size) != size:
+            raise IOError("Image file is shorter than expected")
+
+    def upload_stop_and_wait(self, connection, source):
+        """
+        Legacy transfer: wait for the device to acknowledge every chunk before sending the next one.
+        Returns True if the last acknowledgment already contained "OK".
+        """
+        last_response_contained_ok = False
+        # Every chunk must fit in one read of the device, which acknowledges each read
+        self.metrics.chunk_size = min(self.client.chunk_size or CHUNK_SIZE, DEVICE_BUFFER_SIZE)
+        while True:
+            chunk_size = min(self.metrics.chunk_size, self.payload_size - self.metrics.bytes_sent)
+            if chunk_size <= 0:
+                break
+            connection.settimeout(self.ack_timeout)
+            sent_time = time.time()
+            self._send_chunk(connection, source, self.metrics.bytes_sent, chunk_size)
+            self.metrics.bytes_sent += chunk_size
+            self._progress(self.metrics.bytes_sent)
+            res = connection.recv(10)
+            self.metrics.chunk_rtts.append(time.time() - sent_time)
+            response_text = res.decode().strip()
+            last_response_contained_ok = "OK" in response_text
+            self.acks = AckParser(delimited=bool(self.features))
+            self.acks.feed(res)
+            self.metrics.bytes_acked = self.metrics.bytes_sent
+            logging.debug("Chunk response: '%s'", response_text)
+        return last_response_contained_ok
+
+    def upload_streaming(self, connection, source):
+        """
+        Pipelined transfer: keep up to `window` chunks in flight and drain the
+        acknowledgments as they arrive instead of waiting for each one.
+        Returns True if the device already answered "OK".
+        """
+        acks = self.acks = AckParser()
+        in_flight = collections.deque()  # (end offset, send time, size) of the chunks not acknowledged yet
+        if self.client.chunk_size:
+            tuner = ChunkTuner(self.client.chunk_size, self.client.chunk_size)
         else:
-            logging.error("Bad Answer: %s", data)
+            tuner = ChunkTuner(min(_mss(connection), DEVICE_BUFFER_SIZE))
+        content_size = self.payload_size
+        metrics = self.metrics
+        connection.settimeout(self.ack_timeout)
+        while not acks.ok:
+            sent = metrics.bytes_sent
+            can_send = sent < content_size and sent - metrics.bytes_acked < self.client.window * tuner.size
+            readable, writable, _ = select.select([connection], [connection] if can_send else [], [], self.ack_timeout)
+            if not readable and not writable:
+                if sent < content_size:
+                    raise socket.timeout("No acknowledgment from device (%d/%d bytes acked)" % (acks.acked, sent))
+                break
+            if readable:
+                try:
+                    data = connection.recv(256)
+                except OSError as e:
+                    if sent < content_size:
+                        raise
+                    # The device may reset the connection when it reboots, wait_for_result() sorts it out
+                    self.connection_error = "Connection reset (%s)" % str(e)
+                    break
+                if not data:
+                    if sent < content_size:
+                        raise ConnectionError("Connection closed by device")
+                    break
+                acks.feed(data)
+                # The device acknowledges its total, counted from the start of the payload when resuming
+                metrics.bytes_acked = min(max(acks.acked, metrics.bytes_acked), sent)
+                now = time.time()
+                while in_flight and in_flight[0][0] <= metrics.bytes_acked:
+                    _, sent_time, size = in_flight.popleft()
+                    metrics.chunk_rtts.append(now - sent_time)
+                    tuner.add(size, now - sent_time)
+                logging.debug("Acked %d/%d bytes", metrics.bytes_acked, sent)
+                if acks.text:
+                    logging.debug("Device response: '%s'", acks.text.strip())
+                    break
+                if metrics.bytes_acked >= content_size:
+                    # All acknowledged, the result of the update follows
+                    break
+            if writable and can_send:
+                chunk_size = min(tuner.size, content_size - sent)
+                metrics.chunk_size = tuner.size
+                in_flight.append((sent + chunk_size, time.time(), chunk_size))
+                self._send_chunk(connection, source, sent, chunk_size)
+                metrics.bytes_sent += chunk_size
+                self._progress(metrics.bytes_sent)
+        return acks.ok
+
+    def wait_for_result(self, connection):
+        """
+        Wait for the device to report the result of the update after the last chunk.
+
+        Returns as soon as the outcome is known: "OK" or an Update error message
+        from the device, or, if the connection is closed or reset without an answer,
+        the device going down and announcing its OTA service again, as it does when
+        it reboots. That is a success only if the SHA256 of the app it announces is
+        the one of the image. Without it, or if the device does not answer mDNS
+        queries at all, the session succeeds with `unconfirmed` set to the reason.
+        Gives up after the client's result_timeout.
+        """
+        logging.info("Waiting for result...")
+        step_start = time.time()
+        deadline = step_start + self.client.result_timeout
+        acks = self.acks or AckParser(delimited=bool(self.features))
+        closed = self.connection_error
+        while not acks.ok and closed is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([connection], [], [], remaining)
+            if not readable:
+                break
+            try:
+                data = connection.recv(256)
+            except OSError as e:
+                closed = "Connection reset (%s)" % str(e)
+                break
+            if not data:
+                closed = "Connection closed"
+            acks.feed(data)
+        self.metrics.result_time = time.time() - step_start
+
+        if acks.ok:
+            logging.info("Success")
+            return 0
+        if acks.text.strip():
+            return self._fail("Update failed: %s", acks.text.strip(), error_class="update")
+        if closed is None:
+            return self._fail("No result from device within %d s", self.client.result_timeout)
+
+        logging.info("%s without a result, waiting for the device to reboot", closed)
+        answered, device = self.wait_for_reboot(deadline)
+        self.metrics.result_time = time.time() - step_start
+        if device is None and answered:
+            return self._fail("%s without a result and the device did not come back", closed)
+        if device is None:
+            return self._unconfirmed("%s without a result and the device does not answer mDNS queries", closed)
+        running = device.txt.get("sha256", "").lower()
+        if self.command != FLASH or not running:
+            return self._unconfirmed("%s without a result, the device rebooted but does not tell what it runs", closed)
+        if running != self.image.digest():
+            return self._fail(
+                "%s without a result and the device rebooted into another app (SHA256 %s)",
+                closed,
+                running[:16],
+                error_class="update",
+            )
+        logging.info("Device rebooted into the new app")
+        return 0
+
+    def wait_for_reboot(self, deadline):
+        """
+        Probe the device with discover() until it has stopped answering and answers
+        again, i.e. rebooted. Returns (answered, device): whether the device answered
+        any probe, and the DiscoveredDevice that answered after the reboot, or None if
+        that did not happen before `deadline`. A device that answers no probe for
+        MDNS_SILENCE_TIMEOUT, long enough to reboot, is given up on earlier.
+        """
+        went_down = False
+        answered = False
+        silence_deadline = min(time.time() + MDNS_SILENCE_TIMEOUT, deadline)
+        while True:
+            probe_end = min(time.time() + REBOOT_PROBE_INTERVAL, deadline if answered else silence_deadline)
+            if probe_end <= time.time():
+                return answered, None
+            found = discover([self.remote_addr], probe_end - time.time())
+            if not found:
+                went_down = True
+            elif went_down:
+                return True, found[0]
+            else:
+                answered = True
+                time.sleep(max(probe_end - time.time(), 0))
+
+    def run(self, listener=None):
+        """
+        Run the whole update. Returns 0 on success, 1 on failure.
+        `listener` is a listening TCP socket to use instead of opening one.
+        """
+        self.metrics.start_time = time.time()
+        self._emit("start", command=self.command, size=self.content_size, md5=self.file_md5)
+        try:
+            self.result = self._run(listener)
+        finally:
+            self.metrics.total_time = time.time() - self.metrics.start_time
+        self._emit_result()
+        if self.result == 0 and self.command == FLASH and self.client.image_cache is not None:
+            self.client.image_cache.remember(self.name, self.image)
+        return self.result
+
+    def _run(self, listener=None):
+        if self.command == FLASH and self.client.validate:
+            self.step = "image"
+            info = self.image.validate(self.client.validation_cache)
+            if info["error"]:
+                return self._fail("Invalid image %s: %s", self.image.filename, info["error"])
+            chip = self.chip or self.client.chip
+            if chip and info["chip"] != chip:
+                return self._fail("Image built for %s, not %s", info["chip"], chip)
+
+        self.step = "listen"
+        if listener is not None:
+            return self._serve(listener, listener.getsockname()[1])
+        try:
+            sock = self.client.listen(self.host_port)
+        except Exception as e:
+            return self._fail("Listen Failed: %s", str(e))
+
+        try:
+            return self._serve(sock, sock.getsockname()[1])
+        finally:
+            sock.close()
+
+    def _delta_base(self):
+        if self.command != FLASH:
+            return None
+        if self.client.delta_base is not None:
+            return self.client.delta_base
+        if self.client.image_cache is not None:
+            return self.client.image_cache.base_for(self.name)
+        return None
+
+    def _requested_features(self):
+        """Map the optional features worth asking the device for to their token in the EXT line."""
+        features = {}
+        if self.client.compress and self.image.compressed() is not None:
+            features["zlib"] = "zlib"
+        self.base = self._delta_base()
+        if self.base is not None and self.image.delta(self.base) is not None:
+            # The device only accepts the patch if it runs this very base image
+            features["delta"] = "delta:" + self.base.digest()
+        if self.client.resume_attempts:
+            features["resume"] = "resume"
+        if self.more:
+            features["more"] = "more"
+        if self.session_key:
+            features["session"] = "session:" + session_token(self.session_key, self.command, self.file_md5)
+        return features
+
+    def _payload(self, features, f):
+        """Return what to send for the accepted features: the open image file or a memoryview."""
+        if "delta" in features:
+            self.metrics.encoding = "delta+zlib" if "zlib" in features else "delta"
+            return memoryview(self.image.delta(self.base, compressed="zlib" in features))
+        if "zlib" in features:
+            self.metrics.encoding = "zlib"
+            return memoryview(self.image.compressed())
+        return f
+
+    def _serve(self, sock, local_port):
+        logging.info("Upload size: %d", self.content_size)
+        message = "%d %d %d %s\n" % (self.command, local_port, self.content_size, self.file_md5)
+        requested = self._requested_features()
+        if requested:
+            # Optional second line, ignored by firmware that does not support it
+            message += "EXT %s\n" % " ".join(requested.values())
+
+        attempt = 0
+        while True:
+            result = self._transfer(sock, message, requested, attempt)
+            if result is not None:
+                return result
+            attempt += 1
+            self.metrics.resumes = attempt
+            self._emit("resume", attempt=attempt, offset=self.metrics.bytes_acked)
+            logging.warning(
+                "Connection lost after %d bytes, resuming (attempt %d/%d)",
+                self.metrics.bytes_acked,
+                attempt,
+                self.client.resume_attempts,
+            )
+
+    def _transfer(self, sock, message, requested, attempt):
+        """
+        Invite the device and send the payload, from where the device stopped if it resumes an
+        interrupted transfer. Returns 0 or 1 like run(), or None if the transfer can be resumed.
+        """
+        # Send invitation and get authentication challenge
+        self.step = "invitation"
+        step_start = time.time()
+        success, data, error = self.send_invitation(message)
+        self.metrics.invitation_time = time.time() - step_start
+        if not success:
+            return self._fail(error)
+        data, answer = parse_invitation_answer(data)
+        features = {}
+        for feature in answer or []:
+            name, _, value = feature.partition(":")
+            if name in requested:
+                features[name] = value
+        logging.debug("Device accepted features: %s", " ".join(answer or []) or "none")
+        self.features = features
+        self._emit("invitation", attempt=attempt, latency=self.metrics.invitation_time, features=answer or [])
+        if "delta" in features:
+            # A few bytes of patch can make the device copy megabytes before it acknowledges them
+            self.ack_timeout = ACK_TIMEOUT + self.content_size // FLASH_MIN_WRITE_RATE
+
+        self.step = "auth"
+        step_start = time.time()
+        if "session" in features:
+            # Authenticated by the previous image of the session, the device answered OK
+            self.auth_protocol = "session"
+        elif self.authenticate(data, message):
             return 1
+        self.metrics.auth_time = time.time() - step_start
+        self._emit(
+            "auth",
+            protocol=self.auth_protocol or "none",
+            password_hash=self.password_hash,
+            duration=self.metrics.auth_time,
+            key_time=self.metrics.key_time,
+        )
 
-    logging.info("Waiting for device...")
+        self.step = "connect"
+        logging.info("Waiting for device...")
 
-    try:
-        sock.settimeout(10)
-        connection, client_address = sock.accept()
-        sock.settimeout(None)
-        connection.settimeout(None)
-    except:  # noqa: E722
-        logging.error("No response from device")
-        sock.close()
-        return 1
+        try:
+            sock.settimeout(10)
+            connection, client_address = sock.accept()
+            sock.settimeout(None)
+            connection.settimeout(None)
+            if self.client.send_buffer:
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.client.send_buffer)
+        except:  # noqa: E722
+            return self._fail("No response from device")
 
-    try:
-        with open(filename, "rb") as f:
-            if PROGRESS:
-                update_progress(0)
-            else:
-                sys.stderr.write("Uploading")
-                sys.stderr.flush()
-            offset = 0
-            while True:
-                chunk = f.read(1024)
-                if not chunk:
-                    break
-                offset += len(chunk)
-                update_progress(offset / float(content_size))
-                connection.settimeout(10)
-                try:
-                    connection.sendall(chunk)
-                    res = connection.recv(10)
-                    response_text = res.decode().strip()
-                    last_response_contained_ok = "OK" in response_text
-                    logging.debug("Chunk response: '%s'", response_text)
-                except Exception as e:
-                    sys.stderr.write("\n")
-                    logging.error("Error Uploading: %s", str(e))
-                    connection.close()
-                    return 1
-
-            if last_response_contained_ok:
-                logging.info("Success")
-                connection.close()
-                return 0
-
-            sys.stderr.write("\n")
-            logging.info("Waiting for result...")
-            count = 0
-            received_any_response = False
-            while count < 10:  # Increased from 5 to 10 attempts
-                count += 1
-                connection.settimeout(30)  # Reduced from 60s to 30s per attempt
+        try:
+            with self.image.open() as f:
+                source = self._payload(features, f)
+                self.payload_size = len(source) if isinstance(source, memoryview) else self.content_size
+                self.metrics.payload_size = self.payload_size
+                offset = 0
+                if features.get("resume"):
+                    offset = int(features["resume"])
+                    # This may also continue a transfer started by an earlier espota run, the device
+                    # checked that the command, image and features are the same
+                    if offset > self.payload_size:
+                        return self._fail("Device resumes at %d bytes of %d", offset, self.payload_size)
+                self.metrics.bytes_sent = self.metrics.bytes_acked = offset
+                if offset:
+                    self._write("Resuming at %d bytes\n" % offset)
+                if self.client.progress_bar:
+                    update_progress(offset / float(self.payload_size), self.out)
+                elif not offset:
+                    self._write("Uploading")
+                self.step = "transfer"
+                step_start = time.time()
+                if self.metrics.first_byte_time is None:
+                    self.metrics.first_byte_time = step_start - self.metrics.start_time
                 try:
-                    data = connection.recv(32).decode().strip()
-                    received_any_response = True
-                    logging.info("Result attempt %d: '%s'", count, data)
-
-                    if "OK" in data:
-                        logging.info("Success")
-                        connection.close()
-                        return 0
-                    elif data:  # Got some response but not OK
-                        logging.warning("Unexpected response from device: '%s'", data)
-
-                except socket.timeout:
-                    logging.debug("Timeout waiting for result (attempt %d/10)", count)
-                    continue
+                    # Only acks on lines of their own can be told apart when several are in flight
+                    if self.client.window > 1 and features:
+                        last_response_contained_ok = self.upload_streaming(connection, source)
+                    else:
+                        last_response_contained_ok = self.upload_stop_and_wait(connection, source)
                 except Exception as e:
-                    logging.debug("Error receiving result (attempt %d/10): %s", count, str(e))
-                    # Don't return error here, continue trying
-                    continue
-
-            # After all attempts, provide detailed error information
-            if received_any_response:
-                logging.warning(
-                    "Upload completed but device sent unexpected response(s). This may still be successful."
+                    self._write("\n")
+                    self.metrics.transfer_time = (self.metrics.transfer_time or 0) + time.time() - step_start
+                    if "resume" in features and attempt < self.client.resume_attempts:
+                        logging.debug("Transfer interrupted: %s", str(e))
+                        return None
+                    return self._fail("Error Uploading: %s", str(e))
+                self.metrics.transfer_time = max((self.metrics.transfer_time or 0) + time.time() - step_start, 1e-6)
+                self._emit(
+                    "transfer",
+                    encoding=self.metrics.encoding,
+                    bytes_sent=self.metrics.bytes_sent,
+                    payload_size=self.payload_size,
+                    duration=self.metrics.transfer_time,
+                    throughput=self.metrics.throughput(),
+                    first_byte_time=self.metrics.first_byte_time,
+                    chunk_size=self.metrics.chunk_size,
+                    window=self.client.window,
+                    ack_rtt=rtt_histogram(self.metrics.chunk_rtts),
                 )
-                logging.warning("Device might be rebooting to apply firmware - this is normal.")
-                connection.close()
-                return 0  # Consider it successful if we got any response and upload completed
-            else:
-                logging.error("No response from device after upload completion")
-                logging.error("This could indicate device reboot (normal) or network issues")
-                connection.close()
-                return 1
-    except Exception as e:  # noqa: E722
-        logging.error("Error: %s", str(e))
-    finally:
-        connection.close()
+                self.step = "result"
+                encoding = ""
+                if self.metrics.encoding != "raw":
+                    encoding = " (%s, %d%% of %d)" % (
+                        self.metrics.encoding,
+                        100 * self.payload_size // max(self.content_size, 1),
+                        self.content_size,
+                    )
+                self._write(
+                    "%sTransferred %d bytes%s in %.2f s (%.1f KB/s)\n"
+                    % (
+                        "" if self.client.progress_bar else "\n",
+                        self.metrics.bytes_sent,
+                        encoding,
+                        self.metrics.transfer_time,
+                        self.metrics.throughput() / 1024,
+                    )
+                )
+
+                if last_response_contained_ok:
+                    logging.info("Success")
+                    return 0
+
+                return self.wait_for_result(connection)
+        except Exception as e:  # noqa: E722
+            return self._fail("Error: %s", str(e))
+        finally:
+            connection.close()
+
+
+def parse_invitation_answer(data):
+    """
+    Split the answer to an invitation into the legacy part ("OK" or "AUTH <nonce>") and the
+    list of features accepted by the device, which is None if the device ignored the EXT line.
+    """
+    words = data.split()
+    if "EXT" not in words:
+        return data, None
+    index = words.index("EXT")
+    return " ".join(words[:index]), words[index + 1 :]
 
-    sock.close()
-    return 1
+
+def derive_key(password_hash, salt):
+    """
+    PBKDF2-HMAC-SHA256 key of the authentication as hex, from the password hash and the
+    "nonce:cnonce" salt. A module function, so that a process pool can run it.
+    """
+    return hashlib.pbkdf2_hmac("sha256", password_hash.encode(), salt.encode(), PBKDF2_ITERATIONS).hex()
+
+
+def session_token(key, command, md5):
+    """
+    Token authenticating the invitation for the next image of a multi-image session.
+    `key` is the PBKDF2 key derived during the authentication of the first image,
+    which never goes over the air; the token is only good for the image with `md5`.
+    """
+    return hashlib.sha256(("%s:%d:%s" % (key, command, md5)).encode()).hexdigest()
+
+
+def parse_target(target, default_port):
+    """Split an "address[:port]" string into an (address, port) tuple."""
+    address, sep, port = target.strip().rpartition(":")
+    if not sep:
+        return target.strip(), default_port
+    return address, int(port)
+
+
+def read_targets(filename, default_port):
+    """Read device addresses from a file, one "address[:port]" per line. Lines starting with # are ignored."""
+    targets = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                targets.append(parse_target(line, default_port))
+    return targets
+
+
+def print_fleet_results(sessions, out=sys.stdout):
+    """Print a per-device result table for OTAClient.upload_many()."""
+    out.write("%-24s %-6s %8s %10s  %s\n" % ("Device", "Result", "Time", "KB/s", "Error"))
+    for session in sessions:
+        line = "%-24s %-6s %7.1fs %10.1f  %s" % (
+            session.name,
+            "FAIL" if session.result else "OK?" if session.unconfirmed else "OK",
+            session.metrics.total_time,
+            session.metrics.throughput() / 1024,
+            session.error or session.unconfirmed or "",
+        )
+        out.write(line.rstrip() + "\n")
+    failed = sum(1 for session in sessions if session.result)
+    unconfirmed = sum(1 for session in sessions if not session.result and session.unconfirmed)
+    out.write("%d/%d devices updated" % (len(sessions) - failed, len(sessions)))
+    out.write(", %d unconfirmed\n" % unconfirmed if unconfirmed else "\n")
+    out.flush()
+
+
+def print_discovered(devices, targets=None, out=sys.stdout):
+    """Print the devices found by discover(), and the targets that did not answer."""
+    out.write("%-24s %-28s %5s %-10s %8s\n" % ("Device", "Hostname", "Port", "Board", "Answer"))
+    for device in devices:
+        line = "%-24s %-28s %5s %-10s %6.0fms%s" % (
+            device.address,
+            device.hostname or "",
+            device.port or "",
+            device.txt.get("board", ""),
+            device.rtt * 1000,
+            " (password)" if device.auth else "",
+        )
+        out.write(line.rstrip() + "\n")
+    answered = {device.address for device in devices}
+    for address in targets or []:
+        if address not in answered:
+            out.write("%-24s %s\n" % (address, "no answer"))
+    out.flush()
 
 
 def parse_args(unparsed_args):
     parser = argparse.ArgumentParser(description="Transmit image over the air to the ESP32 module with OTA support.")
 
     # destination ip and port
-    parser.add_argument("-i", "--ip", dest="esp_ip", action="store", help="ESP32 IP Address.", default=False)
+    parser.add_argument(
+        "-i",
+        "--ip",
+        dest="esp_ip",
+        action="append",
+        help="ESP32 IP Address. Repeat to update several devices, optionally as address:port.",
+        default=[],
+    )
+    parser.add_argument(
+        "--ip-file",
+        dest="ip_file",
+        metavar="FILE",
+        help="File with one ESP32 address[:port] per line. All devices are updated concurrently.",
+        default=None,
+    )
     parser.add_argument("-I", "--host_ip", dest="host_ip", action="store", help="Host IP Address.", default="0.0.0.0")
     parser.add_argument("-p", "--port", dest="esp_port", type=int, help="ESP32 OTA Port. Default: 3232", default=3232)
     parser.add_argument(
@@ -497,6 +2101,21 @@ def parse_args(unparsed_args):
         default=False,
     )
 
+    parser.add_argument(
+        "--auth-cache",
+        dest="auth_cache",
+        metavar="FILE",
+        help="File remembering the authentication variant accepted by each device. Default: %(default)s",
+        default=os.path.join(default_cache_dir(), "auth.json"),
+    )
+    parser.add_argument(
+        "--no-auth-cache",
+        dest="no_auth_cache",
+        action="store_true",
+        help="Do not read or update the authentication cache.",
+        default=False,
+    )
+
     # image
     parser.add_argument("-f", "--file", dest="image", help="Image file.", metavar="FILE", default=None)
     parser.add_argument(
@@ -507,6 +2126,73 @@ def parse_args(unparsed_args):
         help="Transmit a SPIFFS image and do not flash the module.",
         default=False,
     )
+    parser.add_argument(
+        "--fs-file",
+        dest="fs_image",
+        help="Filesystem image to send before the app image (-f), in the same session.",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--no-compress",
+        dest="no_compress",
+        action="store_true",
+        help="Always send the image uncompressed, even to devices that accept zlib compressed transfers.",
+        default=False,
+    )
+    parser.add_argument(
+        "--delta-base",
+        dest="delta_base",
+        help="Previous build running on the device(s), to send only a patch against it.",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--image-cache",
+        dest="image_cache",
+        help="Keep a copy of the last image pushed to each device in this directory, the delta base when "
+        "--delta-base is not given. Default: no copies are kept.",
+        metavar="DIR",
+        default=None,
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        dest="image_cache_size",
+        type=int,
+        help="Evict the least recently used images when the image cache grows larger. Default: %d MB."
+        % DEFAULT_IMAGE_CACHE_SIZE,
+        metavar="MB",
+        default=DEFAULT_IMAGE_CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--resume-attempts",
+        dest="resume_attempts",
+        type=int,
+        help="Times to resume an upload interrupted by a dropped connection, 0 to restart from scratch. "
+        "Default %d." % DEFAULT_RESUME_ATTEMPTS,
+        default=DEFAULT_RESUME_ATTEMPTS,
+    )
+    parser.add_argument(
+        "--no-md5-cache",
+        dest="no_md5_cache",
+        action="store_true",
+        help="Always hash and check the image instead of reusing the MD5 and the validation cached in %s."
+        % default_cache_dir(),
+        default=False,
+    )
+    parser.add_argument(
+        "--chip",
+        dest="chip",
+        choices=sorted(ESP_CHIP_IDS),
+        help="Refuse app images built for another chip. Default: the chip the device announces over mDNS, if any.",
+    )
+    parser.add_argument(
+        "--no-validate",
+        dest="no_validate",
+        action="store_true",
+        help="Send the image without checking that it is a complete app image first.",
+        default=False,
+    )
 
     # output
     parser.add_argument(
@@ -525,6 +2211,47 @@ def parse_args(unparsed_args):
         help="Show progress output. Does not work for Arduino IDE.",
         default=False,
     )
+    parser.add_argument(
+        "-W",
+        "--window",
+        dest="window",
+        type=int,
+        help=(
+            "Number of chunks kept in flight during the upload. "
+            "Use 1 for the legacy stop-and-wait transfer of %d byte chunks. Default: %d" % (CHUNK_SIZE, DEFAULT_WINDOW)
+        ),
+        default=DEFAULT_WINDOW,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        help="Bytes written per chunk. Default 0: start at the TCP MSS and grow while the ack latency stays flat.",
+        default=0,
+    )
+    parser.add_argument(
+        "--send-buffer",
+        dest="send_buffer",
+        type=int,
+        help="Socket send buffer size in bytes. Default 0: sized by the system.",
+        default=0,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help="Number of devices updated concurrently when several are given. Default: 8",
+        default=8,
+    )
+    parser.add_argument(
+        "--auth-workers",
+        dest="auth_workers",
+        type=int,
+        help="Derive the authentication keys of concurrent uploads in this many processes. Default: 0, "
+        "in the upload threads.",
+        default=0,
+    )
     parser.add_argument(
         "-t",
         "--timeout",
@@ -533,6 +2260,48 @@ def parse_args(unparsed_args):
         help="Timeout to wait for the ESP32 to accept invitation.",
         default=10,
     )
+    parser.add_argument(
+        "--invitation-deadline",
+        dest="invitation_deadline",
+        type=float,
+        help="Give up on a device that did not answer the invitation after this many seconds. Default %d."
+        % DEFAULT_INVITATION_DEADLINE,
+        default=DEFAULT_INVITATION_DEADLINE,
+    )
+    parser.add_argument(
+        "--result-timeout",
+        dest="result_timeout",
+        type=float,
+        help="Time for the device to report the result after the upload, or come back after rebooting. Default %d."
+        % DEFAULT_RESULT_TIMEOUT,
+        default=DEFAULT_RESULT_TIMEOUT,
+    )
+    parser.add_argument(
+        "--telemetry",
+        dest="telemetry",
+        help="Append the events of every upload as JSON lines to this file, - for stdout.",
+    )
+    parser.add_argument(
+        "--discover",
+        dest="discover",
+        action="store_true",
+        help="Only list the devices that answer an mDNS query, the given ones or all on the local network.",
+        default=False,
+    )
+    parser.add_argument(
+        "--skip-offline",
+        dest="skip_offline",
+        action="store_true",
+        help="Query the devices with mDNS first and only update those that answer.",
+        default=False,
+    )
+    parser.add_argument(
+        "--discovery-deadline",
+        dest="discovery_deadline",
+        type=float,
+        help="Time to wait for mDNS answers in seconds. Default %.0f." % DEFAULT_DISCOVERY_DEADLINE,
+        default=DEFAULT_DISCOVERY_DEADLINE,
+    )
 
     return parser.parse_args(unparsed_args)
 
@@ -543,35 +2312,106 @@ def main(args):
     if options.debug:
         log_level = logging.DEBUG
 
-    logging.basicConfig(level=log_level, format="%(asctime)-8s [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
-    logging.debug("Options: %s", str(options))
+    targets = [parse_target(ip, options.esp_port) for ip in options.esp_ip]
+    if options.ip_file:
+        targets += read_targets(options.ip_file, options.esp_port)
+    fleet = len(targets) > 1
 
-    # check options
-    global PROGRESS
-    PROGRESS = options.progress
+    log_format = "%(asctime)-8s [%(levelname)s]: %(message)s"
+    if fleet:
+        log_format = "%(asctime)-8s [%(levelname)s] %(threadName)s: %(message)s"
+    logging.basicConfig(level=log_level, format=log_format, datefmt="%H:%M:%S")
+    logging.debug("Options: %s", str(options))
 
-    global TIMEOUT
-    TIMEOUT = options.timeout
+    if options.discover:
+        addresses = [address for address, _ in targets]
+        devices = discover(addresses, options.discovery_deadline)
+        print_discovered(devices, addresses)
+        return 0 if devices and len(devices) >= len(set(addresses)) else 1
 
-    if not options.esp_ip or not options.image:
+    if not targets or not options.image:
         logging.critical("Not enough arguments.")
         return 1
+    if options.fs_image and (options.spiffs or fleet):
+        logging.critical("--fs-file needs an app image (-f without -s) and a single device.")
+        return 1
 
     command = FLASH
     if options.spiffs:
         command = SPIFFS
 
-    return serve(
-        options.esp_ip,
-        options.host_ip,
-        options.esp_port,
-        options.host_port,
-        options.auth,
-        options.md5_target,
-        options.image,
-        command,
+    telemetry_file = None
+    if options.telemetry == "-":
+        telemetry_file = sys.stdout
+    elif options.telemetry:
+        telemetry_file = open(options.telemetry, "a")
+
+    client = OTAClient(
+        host_ip=options.host_ip,
+        host_port=options.host_port,
+        password=options.auth,
+        md5_target=options.md5_target,
+        timeout=options.timeout,
+        window=options.window,
+        progress_bar=options.progress,
+        out=NullOutput() if fleet else sys.stderr,
+        auth_cache=None if options.no_auth_cache else AuthCache(options.auth_cache),
+        compress=not options.no_compress,
+        delta_base=OTAImage(options.delta_base) if options.delta_base else None,
+        image_cache=(
+            ImageCache(options.image_cache, options.image_cache_size * 1024 * 1024) if options.image_cache else None
+        ),
+        resume_attempts=options.resume_attempts,
+        invitation_deadline=options.invitation_deadline,
+        discovery_deadline=options.discovery_deadline,
+        result_timeout=options.result_timeout,
+        telemetry=JSONLinesTelemetry(telemetry_file) if telemetry_file else None,
+        chunk_size=max(options.chunk_size, 0),
+        send_buffer=max(options.send_buffer, 0),
+        validate=not options.no_validate,
+        chip=options.chip,
+        validation_cache=(
+            None if options.no_md5_cache else ValidationCache(os.path.join(default_cache_dir(), "validation.json"))
+        ),
     )
+    if options.auth_workers > 0 and options.auth:
+        client.key_executor = concurrent.futures.ProcessPoolExecutor(max_workers=options.auth_workers)
+    image = OTAImage(options.image, use_cache=not options.no_md5_cache)
+
+    try:
+        if fleet or options.skip_offline:
+            sessions = client.upload_many(targets, image, command, options.jobs, options.skip_offline)
+            # Keep stdout machine readable when the telemetry goes there
+            print_fleet_results(sessions, sys.stderr if telemetry_file is sys.stdout else sys.stdout)
+            return 1 if any(session.result for session in sessions) else 0
+
+        if options.fs_image:
+            images = [(SPIFFS, OTAImage(options.fs_image, use_cache=not options.no_md5_cache)), (FLASH, image)]
+            start = time.time()
+            sessions = client.upload_images(targets[0][0], images, targets[0][1])
+            if not sessions[-1].result:
+                sys.stderr.write(
+                    "Updated filesystem and app in %.2f s (%s)\n"
+                    % (
+                        time.time() - start,
+                        ", ".join(
+                            "%s %.2f s"
+                            % ("app" if session.command == FLASH else "filesystem", session.metrics.total_time)
+                            for session in sessions
+                        ),
+                    )
+                )
+            return 1 if any(session.result for session in sessions) else 0
+
+        return client.upload(targets[0][0], image, targets[0][1], command).result
+    finally:
+        if client.key_executor is not None:
+            client.key_executor.shutdown()
+        if telemetry_file not in (None, sys.stdout):
+            telemetry_file.close()
 
 
 if __name__ == "__main__":
+    # In a frozen executable (espota.exe), the --auth-workers processes run their jobs here instead of main()
+    multiprocessing.freeze_support()
     sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+#
+# Benchmark of the host side of OTA updates
+#
+# Pushes images of several sizes with espota.py to simulated devices (espota_sim.py),
+# optionally through a local proxy adding latency, jitter and loss, and writes the
+# results as JSON so they can be compared across commits.
+# use it like:
+# python espota_bench.py [--sizes 100K,1M,8M] [--profiles none,wifi,edge] [--windows 1,8] [--chunk-sizes 0,1024]
+#                        [-o results.json]
+# and compare with an earlier run:
+# python espota_bench.py -o new.json --compare old.json
+#
+# Changes
+# 2026-10-18:
+# - Initial version: time to first byte, throughput, per-chunk RTT and total time per size and profile
+# - Chunk size as a case dimension (--chunk-sizes), automatic sizing by default
+
+
+from __future__ import print_function
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import espota
+
+# Network impairment profiles: one way latency and jitter in ms, fraction of lost packets
+PROFILES = collections.OrderedDict(
+    [
+        ("none", None),
+        ("lan", {"latency": 1, "jitter": 0, "loss": 0.0}),
+        ("wifi", {"latency": 5, "jitter": 3, "loss": 0.005}),
+        ("edge", {"latency": 40, "jitter": 20, "loss": 0.03}),
+    ]
+)
+RETRANSMIT_TIMEOUT = 0.2  # Extra delay of a TCP segment "lost" by the proxy, the minimum RTO of Linux
+RESULTS_VERSION = 1
+
+
+def parse_size(text):
+    """Parse a size such as "100K" or "8M" into bytes."""
+    text = text.strip().upper()
+    multiplier = {"K": 1024, "M": 1024 * 1024}.get(text[-1:], 1)
+    return int(float(text.rstrip("KM")) * multiplier)
+
+
+def make_image(filename, size, seed=0):
+    """
+    Write a reproducible test image of `size` bytes. Half of its 256 byte blocks repeat earlier
+    ones, so it compresses about as well as a typical app image.
+    """
+    rng = random.Random(seed)
+    blocks = []
+    with open(filename, "wb") as f:
+        written = 0
+        while written < size:
+            if blocks and rng.random() < 0.5:
+                block = rng.choice(blocks)
+            else:
+                block = rng.getrandbits(256 * 8).to_bytes(256, "little")
+                blocks.append(block)
+            block = block[: size - written]
+            f.write(block)
+            written += len(block)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class ImpairmentProxy(object):
+    """
+    Relay an OTA session between espota and a device, delaying and dropping traffic.
+
+    espota sends its invitation to the proxy UDP port. The proxy forwards it to the
+    device with the host port replaced by its own TCP port, so the data connection
+    of the device goes through the proxy too. Every datagram and TCP segment is
+    delayed by latency +/- jitter; lost datagrams are dropped and lost segments are
+    delivered RETRANSMIT_TIMEOUT late, as TCP would after a retransmission.
+    """
+
+    def __init__(self, device, latency=0, jitter=0, loss=0.0, seed=0):
+        self.device = device
+        self.latency = latency / 1000.0
+        self.jitter = jitter / 1000.0
+        self.loss = loss
+        self._random = random.Random(seed)
+        self._stop = threading.Event()
+        self._host = None
+        self._host_port = None
+        self._connections = []
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(("127.0.0.1", 0))
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind(("127.0.0.1", 0))
+        self._tcp.listen(4)
+        self.port = self._udp.getsockname()[1]
+        self._threads = [
+            threading.Thread(target=self._relay_datagrams, name="proxy-udp"),
+            threading.Thread(target=self._accept, name="proxy-tcp"),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        for connection in self._connections:
+            connection.close()
+        self._udp.close()
+        self._tcp.close()
+
+    def _delay(self):
+        return max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+
+    def _lost(self):
+        return self.loss and self._random.random() < self.loss
+
+    def _rewrite_invitation(self, data):
+        lines = data.split(b"\n", 1)
+        words = lines[0].split()
+        if len(words) != 4 or not words[1].isdigit():
+            return data
+        self._host_port = int(words[1])
+        words[1] = str(self._tcp.getsockname()[1]).encode()
+        return b" ".join(words) + b"\n" + (lines[1] if len(lines) > 1 else b"")
+
+    def _relay_datagrams(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._udp], [], [], 0.1)
+            if not readable:
+                continue
+            data, remote = self._udp.recvfrom(2048)
+            if remote == self.device:
+                destination = self._host
+            else:
+                self._host = remote
+                destination = self.device
+                data = self._rewrite_invitation(data)
+            if destination is None or self._lost():
+                continue
+            timer = threading.Timer(self._delay(), self._send_datagram, (data, destination))
+            timer.daemon = True
+            timer.start()
+
+    def _send_datagram(self, data, destination):
+        try:
+            self._udp.sendto(data, destination)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._tcp], [], [], 0.1)
+            if not readable:
+                continue
+            device_connection, _ = self._tcp.accept()
+            try:
+                host_connection = socket.create_connection((self._host[0], self._host_port))
+            except OSError:
+                device_connection.close()
+                continue
+            self._connections += [device_connection, host_connection]
+            for source, destination in ((device_connection, host_connection), (host_connection, device_connection)):
+                self._pipe(source, destination)
+
+    def _pipe(self, source, destination):
+        """Forward one direction of a TCP connection through a delay line."""
+        pending = queue.Queue()
+
+        def read():
+            deliver_at = 0
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                if data:
+                    deliver_at = max(deliver_at, time.time() + self._delay())
+                    if self._lost():
+                        deliver_at += RETRANSMIT_TIMEOUT
+                pending.put((deliver_at, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                deliver_at, data = pending.get()
+                time.sleep(max(deliver_at - time.time(), 0))
+                try:
+                    if not data:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        for target in (read, write):
+            thread = threading.Thread(target=target, name="proxy-pipe")
+            thread.daemon = True
+            thread.start()
+
+
+class DeviceProcess(object):
+    """espota_sim.py running in its own process, so it does not compete with espota for the GIL."""
+
+    def __init__(self, flash_rate=0):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "espota_sim.py")]
+        command += ["-p", str(self.port), "--flash-rate", str(flash_rate)]
+        self._process = subprocess.Popen(command, stderr=subprocess.PIPE, universal_newlines=True)
+        for line in self._process.stderr:
+            if "listening" in line:
+                break
+        else:
+            raise OSError("Simulated device did not start")
+        # Keep draining its log so the device never blocks on a full pipe
+        thread = threading.Thread(target=self._process.stderr.read)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def run_case(device, image, profile, window, compress, seed=0, chunk_size=0):
+    """Push `image` once and return the measurements as a dict."""
+    progress = []
+
+    def on_progress(session, done, total):
+        progress.append((time.time(), done))
+
+    proxy = None
+    port = device.port
+    if PROFILES[profile] is not None:
+        proxy = ImpairmentProxy(("127.0.0.1", device.port), seed=seed, **PROFILES[profile])
+        port = proxy.port
+    try:
+        client = espota.OTAClient(
+            host_ip="127.0.0.1",
+            window=window,
+            compress=compress,
+            progress_callback=on_progress,
+            chunk_size=chunk_size,
+            # The test images are random data, not app images
+            validate=False,
+        )
+        session = client.session("127.0.0.1", image, remote_port=port)
+        session.run()
+    finally:
+        if proxy is not None:
+            proxy.close()
+
+    metrics = session.metrics
+    total = metrics.payload_size or image.size
+    steady = [(t, done) for t, done in progress if 0.1 * total <= done <= 0.9 * total]
+    steady_throughput = None
+    if len(steady) > 1 and steady[-1][0] > steady[0][0]:
+        steady_throughput = (steady[-1][1] - steady[0][1]) / (steady[-1][0] - steady[0][0])
+    rtts = [rtt * 1000 for rtt in metrics.chunk_rtts]
+    return {
+        "profile": profile,
+        "size": image.size,
+        "window": window,
+        "chunk": chunk_size,
+        "chunk_size": metrics.chunk_size,
+        "encoding": metrics.encoding,
+        "payload_size": total,
+        "ok": session.result == 0,
+        "error": session.error,
+        "time_to_first_byte": metrics.first_byte_time,
+        "transfer_time": metrics.transfer_time,
+        "total_time": metrics.total_time,
+        "throughput": metrics.throughput(),
+        "steady_throughput": steady_throughput,
+        "chunk_rtt_ms": {
+            "count": len(rtts),
+            "min": min(rtts) if rtts else None,
+            "mean": sum(rtts) / len(rtts) if rtts else None,
+            "p50": percentile(rtts, 0.5),
+            "p90": percentile(rtts, 0.9),
+            "p99": percentile(rtts, 0.99),
+            "max": max(rtts) if rtts else None,
+        },
+    }
+
+
+def case_key(result):
+    # Results written before chunk sizes were selectable used the fixed 1024 byte chunks
+    chunk = result.get("chunk", espota.CHUNK_SIZE)
+    return (
+        result["profile"],
+        result["size"],
+        result["window"],
+        "auto" if not chunk else str(chunk),
+        result["encoding"],
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_rate(rate):
+    return "%.1f" % (rate / 1024) if rate else "-"
+
+
+def print_results(results, baseline=None, out=sys.stdout):
+    """Print one line per case, averaged over repetitions, with the change against `baseline` if given."""
+    cases = collections.OrderedDict()
+    for result in results:
+        cases.setdefault(case_key(result), []).append(result)
+    reference = {}
+    for result in baseline or []:
+        reference.setdefault(case_key(result), []).append(result)
+
+    out.write(
+        "%-7s %9s %4s %5s %-10s %8s %9s %9s %8s %8s %s\n"
+        % ("Profile", "Size", "Win", "Chunk", "Encoding", "TTFB", "KB/s", "Steady", "RTT p50", "Total", "Change")
+    )
+    for key, runs in cases.items():
+        ok = [run for run in runs if run["ok"]]
+        if not ok:
+            out.write("%-7s %9d %4d %5s %-10s FAILED: %s\n" % (key + (runs[-1]["error"],)))
+            continue
+        total = sum(run["total_time"] for run in ok) / len(ok)
+        change = ""
+        previous = [run for run in reference.get(key, []) if run["ok"]]
+        if previous:
+            previous_total = sum(run["total_time"] for run in previous) / len(previous)
+            change = "%+.0f%%" % (100 * (total - previous_total) / previous_total)
+        rtt = [run["chunk_rtt_ms"]["p50"] for run in ok if run["chunk_rtt_ms"]["p50"] is not None]
+        steady = [run["steady_throughput"] for run in ok if run["steady_throughput"]]
+        line = "%-7s %9d %4d %5s %-10s %7.3fs %9s %9s %8s %7.2fs %s" % (
+            key
+            + (
+                sum(run["time_to_first_byte"] for run in ok) / len(ok),
+                format_rate(sum(run["throughput"] for run in ok) / len(ok)),
+                format_rate(sum(steady) / len(steady) if steady else None),
+                "%.1fms" % (sum(rtt) / len(rtt)) if rtt else "-",
+                total,
+                change,
+            )
+        )
+        out.write(line.rstrip() + "\n")
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark espota.py uploads against simulated devices",
+        prog=sys.argv[0],
+    )
+    parser.add_argument(
+        "--sizes", dest="sizes", help="Comma separated image sizes (default: %(default)s).", default="100K,1M,4M,8M"
+    )
+    parser.add_argument(
+        "--profiles",
+        dest="profiles",
+        help="Comma separated impairment profiles among %s (default: %%(default)s)." % ", ".join(PROFILES),
+        default="none,lan,wifi",
+    )
+    parser.add_argument(
+        "--windows", dest="windows", help="Comma separated upload windows (default: %(default)s).", default="1,8"
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        dest="chunk_sizes",
+        help="Comma separated chunk sizes, 0 for the automatic sizing (default: %(default)s).",
+        default="0",
+    )
+    parser.add_argument("--repeat", dest="repeat", type=int, help="Runs of every case.", default=1)
+    parser.add_argument(
+        "--flash-rate",
+        dest="flash_rate",
+        type=float,
+        help="Simulated flash speed in KB/s (default: unlimited).",
+        default=0,
+    )
+    parser.add_argument(
+        "--no-compress", dest="no_compress", action="store_true", help="Send raw images.", default=False
+    )
+    parser.add_argument("-o", "--output", dest="output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", dest="compare", help="JSON results of an earlier run to compare with.")
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Show debug output.", default=False)
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    options = parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.WARNING,
+        format="%(asctime)-8s [%(levelname)s]: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    profiles = [profile for profile in options.profiles.split(",") if profile]
+    for profile in profiles:
+        if profile not in PROFILES:
+            logging.error("Unknown profile %s", profile)
+            return 1
+    sizes = [parse_size(size) for size in options.sizes.split(",") if size]
+    windows = [int(window) for window in options.windows.split(",") if window]
+    chunk_sizes = [int(chunk_size) for chunk_size in options.chunk_sizes.split(",") if chunk_size]
+
+    baseline = None
+    if options.compare:
+        with open(options.compare, "r") as f:
+            baseline = json.load(f)["results"]
+
+    results = []
+    device = DeviceProcess(options.flash_rate * 1024)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                filename = os.path.join(directory, "image_%d.bin" % size)
+                make_image(filename, size)
+                image = espota.OTAImage(filename, use_cache=False)
+                for profile in profiles:
+                    for window, chunk_size in itertools.product(windows, chunk_sizes):
+                        for repeat in range(options.repeat):
+                            result = run_case(
+                                device, image, profile, window, not options.no_compress, repeat, chunk_size
+                            )
+                            result["repeat"] = repeat
+                            results.append(result)
+                            sys.stderr.write(
+                                "%s %d bytes window %d chunk %s: %s\n"
+                                % (
+                                    profile,
+                                    size,
+                                    window,
+                                    chunk_size or "auto",
+                                    "%.2f s" % result["total_time"] if result["ok"] else "FAILED",
+                                )
+                            )
+    finally:
+        device.close()
+
+    print_results(results, baseline)
+    if options.output:
+        document = {
+            "version": RESULTS_VERSION,
+            "commit": git_commit(),
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "options": vars(options),
+            "results": results,
+        }
+        with open(options.output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.write("\n")
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+#
+# Firmware server for devices updating with the HTTPUpdate library
+#
+# Serves a directory of builds to HTTPUpdate::update(): every sub directory is a channel
+# and its newest app image is the one sent to the devices polling it, the newest
+# filesystem image to those asking for one. Devices already running the image get a
+# "304 Not Modified" from the headers they send on every poll, so polling costs one
+# dictionary lookup, and images are streamed with sendfile() with byte range support.
+# use it like:
+# python espota_httpd.py builds/ [-P 8080]
+# with builds/stable/sketch.bin polled by the devices as http://<host>:8080/stable
+# and builds/stable/littlefs.bin by httpUpdate.updateSpiffs() on the same URL.
+#
+# Changes
+# 2026-10-18:
+# - Initial version: channels, conditional responses from the device headers, ranges, sendfile
+
+
+from __future__ import print_function
+import argparse
+import asyncio
+import collections
+import email.utils
+import logging
+import os
+import posixpath
+import sys
+import urllib.parse
+
+import espota
+
+DEFAULT_PORT = 8080
+DEFAULT_RESCAN = 5.0  # Seconds between checks of the build directory for new images
+DEFAULT_IDLE_TIMEOUT = 30.0  # For the next request on a kept alive connection
+MAX_HEADER_SIZE = 16 * 1024
+ESP_APP_DESC_MAGIC = b"\x32\x54\xcd\xab"  # esp_app_desc_t at the start of the first segment of an app
+ESP_APP_DESC_OFFSET = 32  # Image header (24 bytes) and first segment header (8 bytes)
+
+# Kinds of images, named after the x-ESP32-mode header of HTTPUpdate
+SKETCH = "sketch"
+FS_KINDS = ("spiffs", "littlefs", "fatfs")
+FLASHFS = "flashfs"  # Any filesystem image
+FS_NAME_HINTS = (("spiffs", "spiffs"), ("littlefs", "littlefs"), ("fatfs", "fatfs"), ("ffat", "fatfs"))
+
+HTTP_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+Build = collections.namedtuple("Build", "path channel kind image digest")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def image_kind(filename):
+    """
+    Kind of the image in `filename`: SKETCH for an app image, the filesystem type when
+    the name says so ("littlefs.bin", "data.spiffs.bin"...), or None for anything else
+    (bootloader, partition table, merged images) that must never be sent to a device.
+    """
+    with open(filename, "rb") as f:
+        header = f.read(ESP_APP_DESC_OFFSET + len(ESP_APP_DESC_MAGIC))
+    if header[:1] == bytes([espota.ESP_IMAGE_MAGIC]) and header[ESP_APP_DESC_OFFSET:] == ESP_APP_DESC_MAGIC:
+        return SKETCH
+    name = os.path.basename(filename).lower()
+    for hint, kind in FS_NAME_HINTS:
+        if hint in name:
+            return kind
+    return None
+
+
+def parse_range(value, size):
+    """
+    Return the (start, end) bytes, end excluded, of a "Range: bytes=..." header for a file
+    of `size` bytes, or None if the header is to be ignored (other units, several ranges,
+    syntax errors). Raises RangeNotSatisfiable if the range starts after the end of the file.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - suffix, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else max(size, start + 1)
+    except ValueError:
+        return None
+    if end <= start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size)
+
+
+class FirmwareIndex(object):
+    """
+    The images of a build directory, by path relative to it and by channel and kind.
+
+    refresh() rescans the directory, which is cheap when nothing changed: images whose size
+    and mtime are the same keep their OTAImage, and the MD5 of new ones is cached per user
+    by espota.py. The lookup tables are replaced as a whole, so requests served while a
+    rescan runs in another thread see either the old or the new builds.
+    """
+
+    def __init__(self, directory, use_cache=True):
+        self.directory = os.path.realpath(directory)
+        self.use_cache = use_cache
+        self.builds = {}
+        self.targets = {}
+
+    def _scan(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".bin"):
+                    path = os.path.join(root, name)
+                    yield posixpath.join(*os.path.relpath(path, self.directory).split(os.sep)), path
+
+    def refresh(self):
+        """Rescan the directory, return True if the builds changed."""
+        builds = {}
+        for rel, path in self._scan():
+            try:
+                st = os.stat(path)
+                old = self.builds.get(rel)
+                if old is not None and old.image.size == st.st_size and old.image.mtime == st.st_mtime_ns:
+                    builds[rel] = old
+                    continue
+                kind = image_kind(path)
+                if kind is None:
+                    logging.debug("Ignoring %s: not an app or filesystem image", rel)
+                    continue
+                image = espota.OTAImage(path, use_cache=self.use_cache)
+                digest = image.digest() if kind == SKETCH else None
+            except OSError as e:
+                # Being written or removed while scanning, picked up by the next scan
+                logging.debug("Skipping %s: %s", rel, str(e))
+                continue
+            builds[rel] = Build(rel, posixpath.dirname(rel), kind, image, digest)
+            logging.info("%s image %s: %d bytes, MD5 %s", kind, rel, image.size, image.md5)
+        if builds.keys() == self.builds.keys() and all(builds[rel] is self.builds[rel] for rel in builds):
+            return False
+        targets = {}
+        for build in builds.values():
+            key = (build.channel, build.kind)
+            if key not in targets or build.image.mtime > targets[key].image.mtime:
+                targets[key] = build
+        self.builds, self.targets = builds, targets
+        return True
+
+    def lookup(self, path, mode):
+        """
+        The build to serve for a request of `path` by a device asking for `mode`: the file
+        itself if `path` names one, else the newest image of that kind in the channel.
+        """
+        rel = posixpath.normpath(path.strip("/")) if path.strip("/") else ""
+        if rel.startswith(".."):
+            return None
+        builds, targets = self.builds, self.targets
+        if rel in builds:
+            return builds[rel]
+        if mode == FLASHFS:
+            candidates = [targets[(rel, kind)] for kind in FS_KINDS if (rel, kind) in targets]
+            return max(candidates, key=lambda build: build.image.mtime) if candidates else None
+        return targets.get((rel, mode))
+
+
+class FirmwareServer(object):
+    """
+    Answers the polls of HTTPUpdate (HTTPUpdate::handleUpdate() in libraries/HTTPUpdate).
+
+    A device already running the app image of its channel, going by the x-ESP32-sketch-md5
+    or x-ESP32-sketch-sha256 header, or sending the ETag of the image in If-None-Match, gets
+    "304 Not Modified". Otherwise the image is sent with its MD5 in the x-MD5 header, which
+    HTTPUpdate checks after writing it. A retry may ask for the rest of the image with Range,
+    If-Range protecting it from an image replaced in between.
+    """
+
+    def __init__(self, index, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.index = index
+        self.idle_timeout = idle_timeout
+        self.requests = collections.Counter()
+        self.bytes_sent = 0
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        peer = "%s:%d" % peer[:2] if peer else "?"
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, 400, False)
+                    break
+                if not await self._respond(writer, peer, head):
+                    break
+        except ConnectionError as e:
+            logging.debug("%s: %s", peer, str(e))
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, peer, head):
+        """Answer the request in `head`, return True if the connection is kept alive."""
+        lines = head.decode("latin-1").split("\r\n")
+        request = lines[0].split(" ")
+        if len(request) != 3 or not request[2].startswith("HTTP/"):
+            await self._send_error(writer, 400, False)
+            return False
+        method, target, version = request
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+        if method not in ("GET", "HEAD"):
+            await self._send_error(writer, 405, keep_alive, [("Allow", "GET, HEAD")])
+            return keep_alive
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        mode = headers.get("x-esp32-mode", SKETCH).lower()
+        build = self.index.lookup(path, mode)
+        if build is None:
+            logging.debug("%s %s %s (%s): no image", peer, method, path, mode)
+            await self._send_error(writer, 404, keep_alive)
+            return keep_alive
+
+        image = build.image
+        etag = '"%s"' % image.md5
+        response = [("ETag", etag), ("x-MD5", image.md5)]
+        if self._is_current(build, headers, etag):
+            logging.debug("%s %s %s (%s): %s is current", peer, method, path, mode, build.path)
+            await self._send(writer, 304, keep_alive, response)
+            return keep_alive
+
+        status, start, end = 200, 0, image.size
+        if "range" in headers and headers.get("if-range", etag) == etag:
+            try:
+                byte_range = parse_range(headers["range"], image.size)
+            except RangeNotSatisfiable:
+                await self._send_error(writer, 416, keep_alive, [("Content-Range", "bytes */%d" % image.size)])
+                return keep_alive
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                response.append(("Content-Range", "bytes %d-%d/%d" % (start, end - 1, image.size)))
+        response += [
+            ("Content-Type", "application/octet-stream"),
+            ("Content-Length", str(end - start)),
+            ("Content-Disposition", 'attachment; filename="%s"' % posixpath.basename(build.path)),
+            ("Accept-Ranges", "bytes"),
+        ]
+        logging.info(
+            "%s %s %s (%s, %s): sending %s bytes %d-%d",
+            peer,
+            method,
+            path,
+            mode,
+            headers.get("x-esp32-version") or headers.get("x-esp32-sketch-md5") or "-",
+            build.path,
+            start,
+            end - 1,
+        )
+        await self._send(writer, status, keep_alive, response)
+        if method == "GET":
+            with image.open() as f:
+                sent = await asyncio.get_running_loop().sendfile(writer.transport, f, start, end - start)
+            self.bytes_sent += sent
+        return keep_alive
+
+    def _is_current(self, build, headers, etag):
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and (if_none_match == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+            return True
+        if build.kind != SKETCH:
+            # The sketch headers describe the running app, not the filesystem
+            return False
+        return (
+            headers.get("x-esp32-sketch-md5", "").lower() == build.image.md5
+            or headers.get("x-esp32-sketch-sha256", "").lower() == build.digest
+        )
+
+    async def _send(self, writer, status, keep_alive, headers):
+        self.requests[status] += 1
+        lines = ["HTTP/1.1 %d %s" % (status, HTTP_REASONS[status])]
+        lines += ["%s: %s" % header for header in headers]
+        if not any(name == "Content-Length" for name, _ in headers):
+            lines.append("Content-Length: 0")
+        lines += [
+            "Date: %s" % email.utils.formatdate(usegmt=True),
+            "Cache-Control: no-cache",
+            "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+            "",
+            "",
+        ]
+        writer.write("\r\n".join(lines).encode("latin-1"))
+        await writer.drain()
+
+    async def _send_error(self, writer, status, keep_alive, headers=()):
+        await self._send(writer, status, keep_alive, list(headers))
+
+
+async def _rescan(index, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await loop.run_in_executor(None, index.refresh):
+                logging.info("Builds changed: %d images", len(index.builds))
+        except OSError as e:
+            logging.error("Rescan of %s failed: %s", index.directory, str(e))
+
+
+async def serve(server, host, port, rescan=DEFAULT_RESCAN):
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER_SIZE)
+    addresses = ", ".join("%s:%d" % sock.getsockname()[:2] for sock in listener.sockets)
+    logging.warning("Serving %d images from %s on %s", len(server.index.builds), server.index.directory, addresses)
+    tasks = [asyncio.ensure_future(_rescan(server.index, rescan))] if rescan > 0 else []
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def print_index(index):
+    for (channel, kind), build in sorted(index.targets.items()):
+        print("/%-20s %-9s %-40s %10d %s" % (channel, kind, build.path, build.image.size, build.image.md5))
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(
+        description="Firmware server for HTTPUpdate clients", prog=os.path.basename(sys.argv[0])
+    )
+
+    parser.add_argument("directory", help="Build directory, every sub directory is a channel.")
+    parser.add_argument("-I", "--host_ip", dest="host_ip", action="store", help="Address to listen on.", default="")
+    parser.add_argument(
+        "-P", "--host_port", dest="host_port", type=int, help="Port. Default %d." % DEFAULT_PORT, default=DEFAULT_PORT
+    )
+    parser.add_argument(
+        "--rescan",
+        dest="rescan",
+        type=float,
+        help="Seconds between checks for new builds, 0 to never check. Default %.0f." % DEFAULT_RESCAN,
+        default=DEFAULT_RESCAN,
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        dest="idle_timeout",
+        type=float,
+        help="Close kept alive connections idle for this many seconds. Default %.0f." % DEFAULT_IDLE_TIMEOUT,
+        default=DEFAULT_IDLE_TIMEOUT,
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Do not read or write the MD5 cache of espota.py.",
+        default=True,
+    )
+    parser.add_argument(
+        "-l", "--list", dest="list", action="store_true", help="Print the served images and exit.", default=False
+    )
+    parser.add_argument(
+        "-v", "--verbose", dest="verbose", action="store_true", help="Log every request.", default=False
+    )
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Show debug output.", default=False)
+
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    options = parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO if options.verbose else logging.WARNING,
+        format="%(asctime)-8s [%(levelname)s]: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    if not os.path.isdir(options.directory):
+        logging.critical("%s is not a directory.", options.directory)
+        return 1
+    index = FirmwareIndex(options.directory, use_cache=options.use_cache)
+    index.refresh()
+    if options.list:
+        print_index(index)
+        return 0
+    server = FirmwareServer(index, idle_timeout=options.idle_timeout)
+    try:
+        asyncio.run(serve(server, options.host_ip or None, options.host_port, options.rescan))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        logging.critical("Cannot listen on port %d: %s", options.host_port, str(e))
+        return 1
+    finally:
+        logging.warning(
+            "Served %d requests (%s), %d bytes",
+            sum(server.requests.values()),
+            ", ".join("%d: %d" % item for item in sorted(server.requests.items())) or "none",
+            server.bytes_sent,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
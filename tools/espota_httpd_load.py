@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+#
+# Load generator for firmware servers polled by HTTPUpdate devices
+#
+# Emulates a fleet of devices polling an update server the way HTTPUpdate::handleUpdate()
+# does: one HTTP/1.0 connection per poll with the same headers, MD5 check of a received
+# image against x-MD5, and the new image reported on the following polls once "flashed".
+# Reports requests/s, response latency percentiles and bytes served, to size a server
+# (espota_httpd.py or any other) before a fleet wide release.
+# use it like:
+# python espota_httpd_load.py -u http://127.0.0.1:8080/stable -n 5000 --interval 60 --duration 300
+# or against a local espota_httpd.py started for the run:
+# python espota_httpd_load.py --serve builds/ -u http://127.0.0.1:8080/stable --running builds/stable/sketch.bin
+#
+# Changes
+# 2026-10-18:
+# - Initial version: device headers, poll intervals with jitter, MD5 check, latency and throughput report
+
+
+from __future__ import print_function
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import espota
+
+DEFAULT_DEVICES = 1000
+DEFAULT_INTERVAL = 60.0  # Seconds between the polls of one device
+DEFAULT_JITTER = 0.1  # Fraction of the interval every poll is moved by, at random
+DEFAULT_DURATION = 60.0
+DEFAULT_OUTDATED = 10  # Percent of the devices not running the --running image
+DEFAULT_REPORT_INTERVAL = 10.0
+HTTP_TIMEOUT = 8.0  # HTTPUpdate default, for the connection and every read
+READ_SIZE = 64 * 1024
+
+# Values reported by an ESP32 with 4 MB of flash and the default partition table
+FREE_SPACE = 0x140000
+CHIP_SIZE = 4 * 1024 * 1024
+SDK_VERSION = "v5.5"
+USER_AGENT = "ESP32-http-Update"
+
+
+class HTTPDevice(object):
+    """
+    One emulated device: its MAC address and the image it runs, as sent in the headers.
+    """
+
+    def __init__(self, number, md5, sha256, sketch_size, mode="sketch", version=""):
+        mac = [0x24, 0x0A, 0xC4, (number >> 16) & 0xFF, (number >> 8) & 0xFF, number & 0xFF]
+        self.base_mac = ":".join("%02X" % b for b in mac)
+        self.ap_mac = ":".join("%02X" % b for b in mac[:5] + [(mac[5] + 1) & 0xFF])
+        self.md5 = md5
+        self.sha256 = sha256
+        self.sketch_size = sketch_size
+        self.mode = mode
+        self.version = version
+
+    def request(self, host, port, path):
+        """The request of HTTPUpdate::handleUpdate(), header for header."""
+        lines = [
+            "GET %s HTTP/1.0" % path,
+            "Host: %s" % (host if port == 80 else "%s:%d" % (host, port)),
+            "User-Agent: %s" % USER_AGENT,
+            "Connection: close",  # HTTPClient with useHTTP10(true)
+            "Cache-Control: no-cache",
+            "x-ESP32-BASE-MAC: %s" % self.base_mac,
+            "x-ESP32-STA-MAC: %s" % self.base_mac,
+            "x-ESP32-AP-MAC: %s" % self.ap_mac,
+            "x-ESP32-free-space: %d" % FREE_SPACE,
+            "x-ESP32-sketch-size: %d" % self.sketch_size,
+            "x-ESP32-sketch-md5: %s" % self.md5,
+        ]
+        if self.sha256:
+            lines.append("x-ESP32-sketch-sha256: %s" % self.sha256)
+        lines += [
+            "x-ESP32-chip-size: %d" % CHIP_SIZE,
+            "x-ESP32-sdk-version: %s" % SDK_VERSION,
+            "x-ESP32-mode: %s" % self.mode,
+        ]
+        if self.version:
+            lines.append("x-ESP32-version: %s" % self.version)
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def flashed(self, md5, size, tail):
+        """
+        Report the image received on the next polls, as the device does after rebooting
+        into it. `tail` is the end of the image, for the SHA256 appended to app images.
+        """
+        if self.mode != "sketch":
+            # A filesystem update does not change what the device reports
+            return
+        self.md5 = md5
+        self.sketch_size = size
+        self.sha256 = tail[-32:].hex().upper() if len(tail) >= 32 else ""
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = []  # Seconds from the connection to the status line, every response
+        self.transfers = []  # Seconds from the connection to the last byte, images only
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes = 0
+        self.updates = 0
+
+    @property
+    def requests(self):
+        return sum(self.statuses.values()) + sum(self.errors.values())
+
+    def as_dict(self, elapsed):
+        return {
+            "elapsed": elapsed,
+            "requests": self.requests,
+            "rate": self.requests / elapsed if elapsed else 0,
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "errors": dict(self.errors),
+            "bytes": self.bytes,
+            "throughput": self.bytes / elapsed if elapsed else 0,
+            "updates": self.updates,
+            "latency": {
+                "p50": percentile(self.latencies, 0.5),
+                "p90": percentile(self.latencies, 0.9),
+                "p99": percentile(self.latencies, 0.99),
+                "max": max(self.latencies) if self.latencies else None,
+            },
+            "transfer": {
+                "p50": percentile(self.transfers, 0.5),
+                "p99": percentile(self.transfers, 0.99),
+            },
+        }
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def _read_response(reader, device, stats, started, verify):
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_TIMEOUT)
+    stats.latencies.append(time.monotonic() - started)
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    if status != 200:
+        return status
+    # Like HTTPUpdate, trust Content-Length and read exactly that much
+    length = int(headers.get("content-length", 0))
+    expected = headers.get("x-md5", "").lower()
+    md5 = hashlib.md5() if verify and expected else None
+    tail = b""
+    received = 0
+    while received < length:
+        data = await asyncio.wait_for(reader.read(min(READ_SIZE, length - received)), HTTP_TIMEOUT)
+        if not data:
+            raise asyncio.IncompleteReadError(b"", length - received)
+        received += len(data)
+        if md5 is not None:
+            md5.update(data)
+        tail = (tail + data)[-32:]
+    stats.bytes += received
+    stats.transfers.append(time.monotonic() - started)
+    if md5 is not None and md5.hexdigest() != expected:
+        stats.errors["md5"] += 1
+        return None
+    stats.updates += 1
+    device.flashed(expected or device.md5, length, tail)
+    return status
+
+
+async def poll(device, host, port, path, stats, verify=True):
+    """One poll of `device`, the response or error counted in `stats`."""
+    started = time.monotonic()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HTTP_TIMEOUT)
+        writer.write(device.request(host, port, path))
+        status = await _read_response(reader, device, stats, started, verify)
+        if status is not None:
+            stats.statuses[status] += 1
+    except asyncio.TimeoutError:
+        stats.errors["timeout"] += 1
+    except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+        stats.errors["reset"] += 1
+    except (ValueError, IndexError, asyncio.LimitOverrunError):
+        stats.errors["protocol"] += 1
+    except OSError as e:
+        logging.debug("%s: %s", device.base_mac, str(e))
+        stats.errors["connect"] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_device(device, url, stats, stop_at, interval, jitter, rng, verify=True):
+    # Devices boot at random times, then poll every interval, give or take the jitter
+    delay = rng.uniform(0, interval)
+    while time.monotonic() + delay < stop_at:
+        await asyncio.sleep(delay)
+        await poll(device, url.hostname, url.port or 80, url.path or "/", stats, verify)
+        delay = interval * rng.uniform(1 - jitter, 1 + jitter)
+
+
+async def _report(stats, interval):
+    last_requests, last_bytes, last_time = 0, 0, stats.started
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        requests, elapsed = stats.requests, now - last_time
+        p99 = percentile(stats.latencies[-max(requests - last_requests, 1) :], 0.99)
+        print(
+            "%6.0f s: %8.1f req/s, p99 %s, %s/s, %d errors"
+            % (
+                now - stats.started,
+                (requests - last_requests) / elapsed,
+                format_ms(p99),
+                format_bytes((stats.bytes - last_bytes) / elapsed),
+                sum(stats.errors.values()),
+            )
+        )
+        sys.stdout.flush()
+        last_requests, last_bytes, last_time = requests, stats.bytes, now
+
+
+async def run(devices, url, duration, interval, jitter, seed=0, verify=True, report_interval=DEFAULT_REPORT_INTERVAL):
+    stats = LoadStats()
+    stop_at = stats.started + duration
+    rng = random.Random(seed)
+    reporter = asyncio.ensure_future(_report(stats, report_interval)) if report_interval > 0 else None
+    try:
+        await asyncio.gather(
+            *[run_device(device, url, stats, stop_at, interval, jitter, rng, verify) for device in devices]
+        )
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+    return stats
+
+
+def make_devices(count, running=None, outdated=DEFAULT_OUTDATED, mode="sketch", version="", seed=0):
+    """
+    `count` devices running the OTAImage `running`, but for `outdated` percent of them
+    running other builds, or all running builds of their own without `running`.
+    """
+    rng = random.Random(seed)
+    devices = []
+    for number in range(count):
+        if running is not None and rng.random() * 100 >= outdated:
+            md5, sha256, size = running.md5, running.digest().upper(), running.size
+        else:
+            md5, sha256 = "%032x" % rng.getrandbits(128), "%064X" % rng.getrandbits(256)
+            size = rng.randrange(800 * 1024, 1200 * 1024, 16)
+        devices.append(HTTPDevice(number, md5, sha256, size, mode, version))
+    return devices
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else "%.1f ms" % (seconds * 1000)
+
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB"):
+        if count < 1024:
+            return "%.1f %s" % (count, unit)
+        count /= 1024.0
+    return "%.1f GB" % count
+
+
+def print_report(result, out=sys.stdout):
+    out.write("Requests:   %d in %.1f s, %.1f req/s\n" % (result["requests"], result["elapsed"], result["rate"]))
+    out.write(
+        "Responses:  %s\n" % (", ".join("%s: %d" % item for item in sorted(result["statuses"].items())) or "none")
+    )
+    out.write("Errors:     %s\n" % (", ".join("%s: %d" % item for item in sorted(result["errors"].items())) or "none"))
+    latency = result["latency"]
+    out.write(
+        "Latency:    p50 %s, p90 %s, p99 %s, max %s\n"
+        % tuple(format_ms(latency[key]) for key in ("p50", "p90", "p99", "max"))
+    )
+    out.write(
+        "Images:     %d received, %s served (%s/s), transfer p50 %s, p99 %s\n"
+        % (
+            result["updates"],
+            format_bytes(result["bytes"]),
+            format_bytes(result["throughput"]),
+            format_ms(result["transfer"]["p50"]),
+            format_ms(result["transfer"]["p99"]),
+        )
+    )
+
+
+class ServerProcess(object):
+    """espota_httpd.py running in its own process, so the load does not share its event loop."""
+
+    def __init__(self, directory, host, port):
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "espota_httpd.py")]
+        command += [directory, "-I", host, "-P", str(port), "--rescan", "0"]
+        self._process = subprocess.Popen(command, stderr=subprocess.PIPE, universal_newlines=True)
+        for line in self._process.stderr:
+            if "Serving" in line:
+                break
+        else:
+            raise OSError("Firmware server did not start")
+
+    def close(self):
+        # Interrupted rather than terminated, so that it logs its request counts on exit
+        if os.name == "nt":
+            self._process.terminate()
+        else:
+            self._process.send_signal(signal.SIGINT)
+        self._process.wait()
+        sys.stderr.write(self._process.stderr.read())
+
+
+def _raise_file_limit():
+    # Every device in a poll holds a socket
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(
+        description="Load generator emulating HTTPUpdate devices", prog=os.path.basename(sys.argv[0])
+    )
+
+    parser.add_argument("-u", "--url", dest="url", help="URL polled by the devices.", default="http://127.0.0.1:8080/")
+    parser.add_argument(
+        "-n",
+        "--devices",
+        dest="devices",
+        type=int,
+        help="Number of devices. Default %d." % DEFAULT_DEVICES,
+        default=DEFAULT_DEVICES,
+    )
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=float,
+        help="Seconds between the polls of a device. Default %.0f." % DEFAULT_INTERVAL,
+        default=DEFAULT_INTERVAL,
+    )
+    parser.add_argument(
+        "--jitter",
+        dest="jitter",
+        type=float,
+        help="Fraction of the interval polls are moved by at random. Default %.1f." % DEFAULT_JITTER,
+        default=DEFAULT_JITTER,
+    )
+    parser.add_argument(
+        "--duration",
+        dest="duration",
+        type=float,
+        help="Seconds to run. Default %.0f." % DEFAULT_DURATION,
+        default=DEFAULT_DURATION,
+    )
+    parser.add_argument(
+        "--running", dest="running", metavar="FILE", help="Image the devices run, else each runs its own build."
+    )
+    parser.add_argument(
+        "--outdated",
+        dest="outdated",
+        type=float,
+        help="Percentage of the devices not running the --running image. Default %d." % DEFAULT_OUTDATED,
+        default=DEFAULT_OUTDATED,
+    )
+    parser.add_argument(
+        "--mode",
+        dest="mode",
+        choices=("sketch", "spiffs", "fatfs", "littlefs", "flashfs"),
+        help="x-ESP32-mode of the polls. Default sketch.",
+        default="sketch",
+    )
+    parser.add_argument("--version", dest="version", help="x-ESP32-version of the polls.", default="")
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Do not check the MD5 of the received images, to save CPU on the load side.",
+        default=True,
+    )
+    parser.add_argument("--serve", dest="serve", metavar="DIR", help="Run espota_httpd.py on DIR at the URL.")
+    parser.add_argument(
+        "--report",
+        dest="report",
+        type=float,
+        help="Seconds between progress lines, 0 for none. Default %.0f." % DEFAULT_REPORT_INTERVAL,
+        default=DEFAULT_REPORT_INTERVAL,
+    )
+    parser.add_argument("--seed", dest="seed", type=int, help="Random seed. Default 0.", default=0)
+    parser.add_argument("-o", "--output", dest="output", help="Write the results as JSON to this file.")
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Show debug output.", default=False)
+
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    options = parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.WARNING,
+        format="%(asctime)-8s [%(levelname)s]: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    url = urllib.parse.urlsplit(options.url)
+    if url.scheme != "http" or not url.hostname:
+        logging.critical("Only http:// URLs are supported.")
+        return 1
+    running = espota.OTAImage(options.running) if options.running else None
+    devices = make_devices(options.devices, running, options.outdated, options.mode, options.version, options.seed)
+    _raise_file_limit()
+
+    server = ServerProcess(options.serve, url.hostname, url.port or 80) if options.serve else None
+    try:
+        stats = asyncio.run(
+            run(
+                devices,
+                url,
+                options.duration,
+                options.interval,
+                options.jitter,
+                options.seed,
+                options.verify,
+                options.report,
+            )
+        )
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        if server is not None:
+            server.close()
+    result = stats.as_dict(time.monotonic() - stats.started)
+    result.update({"url": options.url, "devices": options.devices, "interval": options.interval})
+    print_report(result)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+#
+# Staged OTA rollout to a fleet of devices with espota.py
+#
+# Pushes an image to every device of an inventory in waves: a canary wave first, then
+# batches growing by a factor, and halts when too many updates fail. Progress is kept in
+# a state file, so running the same command again continues an interrupted rollout, and
+# devices that were already sent the image are skipped.
+# use it like:
+# python espota_rollout.py --ip-file devices.txt -f <sketch.bin> [-a password] [--canary 5] [--growth 2]
+#
+# Changes
+# 2026-10-18:
+# - Initial version: canary and growing waves, per-wave jobs, failure rate halt, resumable state file
+# - Derive the authentication keys in worker processes (--auth-workers)
+# - Refuse broken app images and images for another chip before the first wave (--chip, --no-validate)
+
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import espota
+
+STATE_VERSION = 1
+DEFAULT_CANARY = 5  # Percent of the devices in the first wave
+DEFAULT_GROWTH = 2.0
+DEFAULT_MAX_FAILURE_RATE = 10  # Percent
+
+# Device states in the state file
+PENDING = "pending"
+OK = "ok"
+FAILED = "failed"
+UNCONFIRMED = "unconfirmed"  # Rebooted without reporting the result, see OTASession.unconfirmed
+OFFLINE = "offline"
+CURRENT = "current"  # Already had the image, not pushed
+
+
+def plan_waves(devices, canary=DEFAULT_CANARY, growth=DEFAULT_GROWTH):
+    """
+    Split `devices` into waves: `canary` percent of them (at least one) first, then
+    every wave `growth` times larger than the one before, until all are included.
+    """
+    waves = []
+    size = max(int(math.ceil(len(devices) * canary / 100.0)), 1)
+    start = 0
+    while start < len(devices):
+        waves.append(devices[start : start + size])
+        start += size
+        size = max(int(math.ceil(size * growth)), size + 1)
+    return waves
+
+
+class RolloutState(object):
+    """
+    The progress of a rollout, kept as JSON in `filename` and saved after every device.
+
+    It records the image being rolled out, the planned waves (lists of "address:port")
+    and for every device its status (pending, ok, failed, unconfirmed, offline or current),
+    the wave it belongs to, the error of its last attempt and the digest (OTAImage.digest())
+    of the last app image it was sent successfully, in this rollout or an earlier one.
+    `halted` is set when the rollout stopped because of the failure rate.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.image = {}
+        self.waves = []
+        self.devices = {}
+        self.halted = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the state file. Returns False if there is none or it cannot be used."""
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(data, dict) or data.get("version") != STATE_VERSION:
+            return False
+        self.image = data.get("image", {})
+        self.waves = data.get("waves", [])
+        self.devices = data.get("devices", {})
+        self.halted = data.get("halted", False)
+        return True
+
+    def save(self):
+        with self._lock:
+            data = {
+                "version": STATE_VERSION,
+                "image": self.image,
+                "waves": self.waves,
+                "devices": self.devices,
+                "halted": self.halted,
+            }
+            espota._write_json(self.filename, data)
+
+    def start(self, image, command, waves):
+        """Forget any earlier rollout but the apps the devices were sent, and plan a new one."""
+        self.image = {"filename": image.filename, "digest": image.digest(), "md5": image.md5, "command": command}
+        self.waves = waves
+        previous = self.devices
+        self.devices = {}
+        for index, wave in enumerate(waves):
+            for device in wave:
+                self.devices[device] = {"status": PENDING, "wave": index}
+                if previous.get(device, {}).get("digest"):
+                    self.devices[device]["digest"] = previous[device]["digest"]
+        self.halted = False
+
+    def add_wave(self, devices):
+        """Append a wave for devices that joined the inventory since the rollout started."""
+        for device in devices:
+            self.devices[device] = {"status": PENDING, "wave": len(self.waves)}
+        self.waves.append(devices)
+
+    def set_status(self, device, status, error=None, error_class=None, digest=None):
+        with self._lock:
+            entry = self.devices[device]
+            entry["status"] = status
+            entry["error"] = error
+            entry["error_class"] = error_class
+            entry["time"] = round(time.time(), 3)
+            if digest:
+                entry["digest"] = digest
+
+    def count(self, status):
+        with self._lock:
+            return sum(1 for entry in self.devices.values() if entry["status"] == status)
+
+    def failure_rate(self):
+        """Fraction of the pushed devices that failed, or did not confirm the update."""
+        failed = self.count(FAILED) + self.count(UNCONFIRMED)
+        pushed = failed + self.count(OK)
+        return failed / float(pushed) if pushed else 0.0
+
+
+class Rollout(object):
+    """
+    Roll `image` out to `targets`, a list of (address, port) tuples, with an espota.OTAClient.
+
+    jobs lists the number of concurrent uploads per wave, the last value applying to all
+    further waves. The rollout halts before the next wave when the failure rate of the
+    rollout exceeds max_failure_rate (0 to 1). Devices the state says were already sent
+    the image are skipped. Unconfirmed updates count as failures.
+    """
+
+    def __init__(
+        self,
+        client,
+        image,
+        targets,
+        state,
+        command=espota.FLASH,
+        canary=DEFAULT_CANARY,
+        growth=DEFAULT_GROWTH,
+        jobs=(8,),
+        max_failure_rate=DEFAULT_MAX_FAILURE_RATE / 100.0,
+        soak=0,
+        skip_offline=False,
+        retry_failed=False,
+    ):
+        self.client = client
+        self.image = image
+        self.targets = {"%s:%d" % target: target for target in targets}
+        self.state = state
+        self.command = command
+        self.canary = canary
+        self.growth = growth
+        self.jobs = list(jobs) or [8]
+        self.max_failure_rate = max_failure_rate
+        self.soak = soak
+        self.skip_offline = skip_offline
+        self.retry_failed = retry_failed
+        self.sessions = []
+        # Record every result in the state as it comes in, then pass the event on
+        self._telemetry = client.telemetry
+        client.telemetry = self._on_event
+
+    def _on_event(self, session, event, fields):
+        if event == "result" and session.name in self.state.devices:
+            digest = None
+            if fields["status"] == "ok":
+                status = OK
+                if self.command == espota.FLASH:
+                    digest = self.image.digest()
+            elif fields["status"] == "unconfirmed":
+                status = UNCONFIRMED
+            elif fields["error_class"] == "offline":
+                status = OFFLINE
+            else:
+                status = FAILED
+            self.state.set_status(session.name, status, fields["error"], fields["error_class"], digest)
+            self.state.save()
+        if self._telemetry:
+            self._telemetry(session, event, fields)
+
+    def _prepare(self):
+        """Continue the rollout in the state file if it is for the same image, else plan a new one."""
+        names = list(self.targets)
+        digest = self.image.digest()
+        resumed = self.state.load()
+        if resumed and (self.state.image.get("digest"), self.state.image.get("command")) != (digest, self.command):
+            logging.info("%s rolled out another image, starting a new rollout", self.state.filename)
+            resumed = False
+        if resumed:
+            logging.info("Continuing the rollout in %s", self.state.filename)
+            new = [name for name in names if name not in self.state.devices]
+            if new:
+                self.state.add_wave(new)
+            if self.retry_failed:
+                for name, entry in self.state.devices.items():
+                    if entry["status"] in (FAILED, UNCONFIRMED):
+                        entry["status"] = PENDING
+                self.state.halted = False
+        else:
+            self.state.start(self.image, self.command, plan_waves(names, self.canary, self.growth))
+        if self.command == espota.FLASH:
+            for name in names:
+                entry = self.state.devices[name]
+                if entry["status"] in (PENDING, OFFLINE) and entry.get("digest") == digest:
+                    entry["status"] = CURRENT
+        self.state.save()
+
+    def _halt(self):
+        rate = self.state.failure_rate()
+        halted = rate > self.max_failure_rate
+        if halted != self.state.halted:
+            self.state.halted = halted
+            self.state.save()
+        if not halted:
+            return False
+        print(
+            "Rollout halted: %.0f%% of the updates failed, more than %.0f%%" % (rate * 100, self.max_failure_rate * 100)
+        )
+        return True
+
+    def run(self):
+        """Push wave after wave. Returns 0 if all devices have the image, 1 if some failed, 2 if halted."""
+        self._prepare()
+        if self._halt():
+            return 2
+        waves = self.state.waves
+        soak = False
+        for index, wave in enumerate(waves):
+            pending = [
+                self.targets[name]
+                for name in wave
+                if name in self.targets and self.state.devices[name]["status"] in (PENDING, OFFLINE)
+            ]
+            if not pending:
+                continue
+            if soak:
+                print("Soaking for %d s" % self.soak)
+                time.sleep(self.soak)
+            jobs = self.jobs[min(index, len(self.jobs) - 1)]
+            print("Wave %d/%d: %d devices, %d at a time" % (index + 1, len(waves), len(pending), jobs))
+            sessions = self.client.upload_many(pending, self.image, self.command, jobs, self.skip_offline)
+            self.sessions += sessions
+            failed = sum(1 for session in sessions if session.result)
+            unconfirmed = sum(1 for session in sessions if not session.result and session.unconfirmed)
+            print(
+                "Wave %d/%d: %d updated, %d unconfirmed, %d failed, failure rate of the rollout %.0f%%"
+                % (
+                    index + 1,
+                    len(waves),
+                    len(sessions) - failed - unconfirmed,
+                    unconfirmed,
+                    failed,
+                    self.state.failure_rate() * 100,
+                )
+            )
+            if self._halt():
+                return 2
+            soak = self.soak > 0
+        unfinished = [name for name in self.targets if self.state.devices[name]["status"] not in (OK, CURRENT)]
+        return 1 if unfinished else 0
+
+
+def print_summary(state, targets, out=sys.stdout):
+    """Print how many devices of the inventory are in each state."""
+    counts = {}
+    for name in targets:
+        status = state.devices[name]["status"]
+        counts[status] = counts.get(status, 0) + 1
+    out.write(
+        "%d devices: %s\n" % (len(targets), ", ".join("%d %s" % (counts[status], status) for status in sorted(counts)))
+    )
+    out.flush()
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(
+        description="Staged OTA rollout to a fleet of devices", prog=os.path.basename(sys.argv[0])
+    )
+
+    parser.add_argument(
+        "-i",
+        "--ip",
+        dest="esp_ip",
+        action="append",
+        default=[],
+        help="Device address[:port]. Can be repeated.",
+    )
+    parser.add_argument("--ip-file", dest="ip_file", help="Inventory file with one device address[:port] per line.")
+    parser.add_argument("-p", "--port", dest="esp_port", type=int, help="ESP32 OTA Port. Default: 3232", default=3232)
+    parser.add_argument("-I", "--host_ip", dest="host_ip", action="store", help="Host IP Address.", default="0.0.0.0")
+    parser.add_argument("-P", "--host_port", dest="host_port", type=int, help="First host port, 0 for any.", default=0)
+    parser.add_argument("-a", "--auth", dest="auth", help="Set authentication password.", action="store", default="")
+    parser.add_argument("-f", "--file", dest="image", help="Image file.", metavar="FILE", required=True)
+    parser.add_argument(
+        "-s", "--spiffs", dest="spiffs", action="store_true", help="Roll out a filesystem image.", default=False
+    )
+    parser.add_argument(
+        "--state",
+        dest="state",
+        help="State file of the rollout. Default: the inventory file name with .rollout.json, else rollout.json.",
+    )
+    parser.add_argument(
+        "--canary",
+        dest="canary",
+        type=float,
+        help="Percentage of the devices in the first wave. Default %d." % DEFAULT_CANARY,
+        default=DEFAULT_CANARY,
+    )
+    parser.add_argument(
+        "--growth",
+        dest="growth",
+        type=float,
+        help="Size of every wave relative to the previous one. Default %.0f." % DEFAULT_GROWTH,
+        default=DEFAULT_GROWTH,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        help="Concurrent uploads per wave, comma separated, the last value applies to later waves. Default 8.",
+        default="8",
+    )
+    parser.add_argument(
+        "--max-failure-rate",
+        dest="max_failure_rate",
+        type=float,
+        help="Halt when more than this percentage of the updates failed. Default %d." % DEFAULT_MAX_FAILURE_RATE,
+        default=DEFAULT_MAX_FAILURE_RATE,
+    )
+    parser.add_argument(
+        "--auth-workers",
+        dest="auth_workers",
+        type=int,
+        help="Derive the authentication keys in this many processes. Default 0, in the upload threads.",
+        default=0,
+    )
+    parser.add_argument(
+        "--chip",
+        dest="chip",
+        choices=sorted(espota.ESP_CHIP_IDS),
+        help="Refuse an app image built for another chip. Default: the chip devices announce over mDNS, if any.",
+    )
+    parser.add_argument(
+        "--no-validate",
+        dest="no_validate",
+        action="store_true",
+        help="Roll out the image without checking that it is a complete app image first.",
+        default=False,
+    )
+    parser.add_argument("--soak", dest="soak", type=float, help="Seconds to wait between waves. Default 0.", default=0)
+    parser.add_argument(
+        "--retry-failed",
+        dest="retry_failed",
+        action="store_true",
+        help="Push again to the devices that failed or did not confirm the update, also resumes a halted rollout.",
+        default=False,
+    )
+    parser.add_argument(
+        "--skip-offline",
+        dest="skip_offline",
+        action="store_true",
+        help="Query the devices with mDNS first, those not answering are tried again on the next run.",
+        default=False,
+    )
+    parser.add_argument(
+        "--invitation-deadline",
+        dest="invitation_deadline",
+        type=float,
+        help="Give up on a device that did not answer the invitation after this many seconds. Default %d."
+        % espota.DEFAULT_INVITATION_DEADLINE,
+        default=espota.DEFAULT_INVITATION_DEADLINE,
+    )
+    parser.add_argument(
+        "--image-cache",
+        dest="image_cache",
+        help="Directory of the images last pushed to each device, shared with espota.py --image-cache, to send "
+        "deltas. Default: no cache.",
+        metavar="DIR",
+        default=None,
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        dest="image_cache_size",
+        type=int,
+        help="Evict the least recently used images when the image cache grows larger. Default: %d MB."
+        % espota.DEFAULT_IMAGE_CACHE_SIZE,
+        metavar="MB",
+        default=espota.DEFAULT_IMAGE_CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--telemetry", dest="telemetry", help="Append the events of every upload as JSON lines to this file."
+    )
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Show debug output.", default=False)
+
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    options = parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.WARNING,
+        format="%(asctime)-8s [%(levelname)s] %(threadName)s: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    targets = [espota.parse_target(ip, options.esp_port) for ip in options.esp_ip]
+    if options.ip_file:
+        targets += espota.read_targets(options.ip_file, options.esp_port)
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        logging.critical("No devices to update.")
+        return 1
+    state_filename = options.state
+    if not state_filename:
+        state_filename = os.path.splitext(options.ip_file)[0] + ".rollout.json" if options.ip_file else "rollout.json"
+
+    image = espota.OTAImage(options.image)
+    command = espota.SPIFFS if options.spiffs else espota.FLASH
+    validation_cache = espota.ValidationCache(os.path.join(espota.default_cache_dir(), "validation.json"))
+    if command == espota.FLASH and not options.no_validate:
+        # Every device would refuse it, do not let the canary wave find out
+        info = image.validate(validation_cache)
+        if info["error"] or (options.chip and info["chip"] != options.chip):
+            logging.critical("Not rolling out %s: %s", options.image, info["error"] or "built for %s" % info["chip"])
+            return 1
+
+    telemetry_file = open(options.telemetry, "a") if options.telemetry else None
+    client = espota.OTAClient(
+        host_ip=options.host_ip,
+        host_port=options.host_port,
+        password=options.auth,
+        invitation_deadline=options.invitation_deadline,
+        out=espota.NullOutput(),
+        auth_cache=espota.AuthCache(os.path.join(espota.default_cache_dir(), "auth.json")),
+        image_cache=(
+            espota.ImageCache(options.image_cache, options.image_cache_size * 1024 * 1024)
+            if options.image_cache
+            else None
+        ),
+        telemetry=espota.JSONLinesTelemetry(telemetry_file) if telemetry_file else None,
+        validate=not options.no_validate,
+        chip=options.chip,
+        validation_cache=validation_cache,
+    )
+    if options.auth_workers > 0 and options.auth:
+        client.key_executor = concurrent.futures.ProcessPoolExecutor(max_workers=options.auth_workers)
+    state = RolloutState(state_filename)
+    rollout = Rollout(
+        client,
+        image,
+        targets,
+        state,
+        command=command,
+        canary=options.canary,
+        growth=options.growth,
+        jobs=[int(jobs) for jobs in options.jobs.split(",") if jobs],
+        max_failure_rate=options.max_failure_rate / 100.0,
+        soak=options.soak,
+        skip_offline=options.skip_offline,
+        retry_failed=options.retry_failed,
+    )
+    try:
+        result = rollout.run()
+    finally:
+        if client.key_executor is not None:
+            client.key_executor.shutdown()
+        if telemetry_file:
+            telemetry_file.close()
+    if rollout.sessions:
+        espota.print_fleet_results(rollout.sessions)
+    print_summary(state, ["%s:%d" % target for target in targets])
+    return result
+
+
+if __name__ == "__main__":
+    # In a frozen executable, the --auth-workers processes run their jobs here instead of main()
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,701 @@
+#!/usr/bin/env python
+#
+# Simulated ArduinoOTA device for espota.py
+#
+# Implements the device side of the OTA protocol of libraries/ArduinoOTA (UDP invitation,
+# MD5 or PBKDF2-SHA256 authentication, TCP transfer acknowledged per read, EXT features)
+# on top of plain sockets, so espota.py can be tested and benchmarked without a board.
+# use it like:
+# python espota_sim.py -p <ESP_port> [-a password] [-n devices] [--flash-rate KB/s] [--ack-latency ms]
+# and push to it with:
+# python espota.py -i 127.0.0.1 -p <ESP_port> [-a password] -f <sketch.bin>
+#
+# Changes
+# 2026-10-18:
+# - Initial version: configurable flash write speed, ack latency, packet loss and reboot time
+# - Resume interrupted transfers, --disconnect-after to interrupt them
+# - Answer repeated invitations while waiting for authentication, --mdns to answer discovery queries
+# - Multi-image sessions: no reboot after an image sent with "more", session token instead of a challenge
+# - --chip: announced in the mDNS TXT record, app images for another chip fail to activate
+# - The SHA256 of the running app in the mDNS TXT record
+
+
+from __future__ import print_function
+import argparse
+import hashlib
+import logging
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from espota import (
+    AUTH,
+    DEVICE_BUFFER_SIZE,
+    DNS_A,
+    DNS_PTR,
+    DNS_SRV,
+    DNS_TXT,
+    ESP_CHIP_IDS,
+    ESP_IMAGE_MAGIC,
+    FLASH,
+    MDNS_PORT,
+    MDNS_SERVICE,
+    PATCH_COPY,
+    PATCH_DATA,
+    SPIFFS,
+    _read_dns_name,
+    session_token,
+)
+
+PBKDF2_ITERATIONS = 10000
+RECEIVE_TIMEOUT = 1.0  # ArduinoOTA default, see setTimeout()
+ACK_RETRIES = 3
+RESUME_TIMEOUT = 60.0  # OTA_RESUME_TIMEOUT
+SESSION_TIMEOUT = 60.0  # OTA_SESSION_TIMEOUT
+
+# Update.printError() messages of the errors the simulator can hit
+UPDATE_ERROR_SPACE = "Not Enough Space"
+UPDATE_ERROR_MD5 = "MD5 Check Failed"
+UPDATE_ERROR_ABORT = "Aborted"
+UPDATE_ERROR_STREAM = "Stream Read Timeout"
+UPDATE_ERROR_ACTIVATE = "Could Not Activate The Firmware"
+
+
+def image_digest(image):
+    """SHA256 of an app image as esp_partition_get_sha256() reports it, see espota.OTAImage.digest()."""
+    if len(image) >= 24 + 32 and image[0] == ESP_IMAGE_MAGIC and image[23] == 1:
+        return bytes(image[-32:]).hex()
+    return hashlib.sha256(image).hexdigest()
+
+
+class UpdateError(Exception):
+    pass
+
+
+class Patcher(object):
+    """Streaming decoder of espota delta patches, mirroring OTAPatcher in ArduinoOTA.cpp."""
+
+    def __init__(self, base, out):
+        self.base = base
+        self.out = out
+        self._header = bytearray()
+        self._literal = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            if self._literal:
+                n = min(len(data), self._literal)
+                self.out(data[:n])
+                data = data[n:]
+                self._literal -= n
+                continue
+            self._header.append(data[0])
+            data = data[1:]
+            op = self._header[0]
+            if op not in (PATCH_COPY, PATCH_DATA):
+                raise UpdateError("Bad patch operation: %d" % op)
+            if len(self._header) < (9 if op == PATCH_COPY else 5):
+                continue
+            if op == PATCH_DATA:
+                (self._literal,) = struct.unpack_from("<I", self._header, 1)
+            else:
+                offset, length = struct.unpack_from("<II", self._header, 1)
+                if offset + length > len(self.base):
+                    raise UpdateError("Patch copy out of range: %d + %d" % (offset, length))
+                self.out(memoryview(self.base)[offset : offset + length])
+            self._header = bytearray()
+
+
+class UpdateRecord(object):
+    """What happened during one update received by a SimulatedDevice."""
+
+    def __init__(self, command, size, md5, features):
+        self.command = command
+        self.size = size
+        self.md5 = md5
+        self.features = features
+        self.start_time = time.time()
+        self.end_time = None
+        self.bytes_received = 0
+        self.bytes_written = 0
+        self.resumes = 0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.end_time is not None and self.error is None
+
+    def as_dict(self):
+        return dict(self.__dict__, ok=self.ok)
+
+
+def transfer_key(record):
+    """What must not change for an interrupted transfer to be resumed, see ArduinoOTAClass::_transferKey()."""
+    return (record.command, record.size, record.md5, tuple(f for f in record.features if f in ("zlib", "delta")))
+
+
+def _ack(record, written, received):
+    """A bare count of the bytes read, or with features the total received on a line (ArduinoOTAClass::_ack())"""
+    if record.features:
+        return b"%d\n" % received
+    return b"%d" % written
+
+
+class Transfer(object):
+    """An update in progress: what was written so far and the decoders of the payload."""
+
+    def __init__(self, record, running_image, flash_rate):
+        self.record = record
+        self.key = transfer_key(record)
+        self.image = bytearray()
+        self.md5 = hashlib.md5()
+        self.received = 0
+        self.disconnected = False
+        self.suspended_at = None
+        self.flash_rate = flash_rate
+        self.sink = self._flash
+        if "delta" in record.features:
+            self.sink = Patcher(running_image, self.sink).write
+        if "zlib" in record.features:
+            inflater = zlib.decompressobj()
+            patcher = self.sink
+
+            def sink(data):
+                patcher(inflater.decompress(data))
+
+            self.sink = sink
+
+    def _flash(self, data):
+        if self.record.bytes_written + len(data) > self.record.size:
+            raise UpdateError(UPDATE_ERROR_SPACE)
+        if self.flash_rate:
+            time.sleep(len(data) / float(self.flash_rate))
+        self.image.extend(data)
+        self.md5.update(data)
+        self.record.bytes_written += len(data)
+
+
+def _dns_name(name):
+    return b"".join(_dns_text(label) for label in name.split(".")) + b"\0"
+
+
+def _dns_text(text):
+    return bytes([len(text)]) + text.encode()
+
+
+def _dns_record(name, rtype, data):
+    return _dns_name(name) + struct.pack("!HHIH", rtype, 1, 120, len(data)) + data
+
+
+def _questions(data):
+    """The (name, type, class) questions of a DNS query."""
+    count = struct.unpack_from("!H", data, 4)[0]
+    offset = 12
+    questions = []
+    for _ in range(count):
+        name, offset = _read_dns_name(data, offset)
+        questions.append((name,) + struct.unpack_from("!HH", data, offset))
+        offset += 4
+    return questions
+
+
+class SimulatedDevice(object):
+    """
+    A stand-in for a board running ArduinoOTA, listening for invitations on UDP `port`.
+
+    password, md5_password and legacy_auth select how the device authenticates:
+    PBKDF2-SHA256 over a SHA256 (or, with md5_password, MD5) password hash as
+    current firmware does, or the MD5 challenge of firmware older than 3.3.1.
+    features lists the EXT features the device accepts ("zlib", "delta", "resume",
+    "more"); None simulates firmware that ignores the EXT line altogether.
+    running_image is the app the device runs, the base of delta updates. With
+    "resume", a transfer interrupted by a lost connection is kept for
+    RESUME_TIMEOUT and continued when the host invites the device again for the
+    same image. With "more", the device does not reboot after an image and lets
+    the host authenticate the next one with a session token.
+
+    Impairments: flash_rate limits the write speed in bytes/s (0 for unlimited),
+    ack_latency delays every acknowledgment, loss drops that fraction of the UDP
+    datagrams, disconnect_after closes the data connection once per update after
+    receiving that many bytes and reboot_time is how long the device stays
+    offline after a successful update. Every update is recorded in `updates`.
+    With mdns, the device also answers mDNS queries for its _arduino._tcp
+    service on port 5353 of its address, as discover() sends them, with the
+    chip and the SHA256 of the running app in the TXT record. Like the
+    bootloader, the device does not boot an app image built for another chip
+    than `chip`.
+    """
+
+    def __init__(
+        self,
+        port=3232,
+        address="127.0.0.1",
+        password="",
+        md5_password=False,
+        legacy_auth=False,
+        features=("zlib", "delta", "resume", "more"),
+        running_image=b"",
+        flash_rate=0,
+        ack_latency=0.0,
+        loss=0.0,
+        disconnect_after=0,
+        reboot_time=0.0,
+        timeout=RECEIVE_TIMEOUT,
+        seed=None,
+        mdns=False,
+        chip="esp32",
+    ):
+        self.address = address
+        self.password = password
+        self.md5_password = md5_password
+        self.legacy_auth = legacy_auth
+        self.features = features
+        self.running_image = bytes(running_image)
+        self.flash_rate = flash_rate
+        self.ack_latency = ack_latency
+        self.loss = loss
+        self.disconnect_after = disconnect_after
+        self.reboot_time = reboot_time
+        self.timeout = timeout
+        self.chip = chip
+        self.updates = []
+        self._pending = None
+        self._session = None  # (derived key, host address, time) of a multi-image session
+        self._derived_key = None
+        self._offline_until = 0
+        self._random = random.Random(seed)
+        self._stop = threading.Event()
+        self._thread = None
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((address, port))
+        self.port = self._udp.getsockname()[1]
+        self._mdns = None
+        if mdns:
+            self._mdns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._mdns.bind((address, MDNS_PORT))
+
+    @property
+    def name(self):
+        return "%s:%d" % (self.address, self.port)
+
+    def _bootable(self, image):
+        """False for an app image of another chip, checked by esp_ota_set_boot_partition() on the device."""
+        if len(image) < 24 or image[0] != ESP_IMAGE_MAGIC:
+            # Not an app image at all, the tests send random data
+            return True
+        return struct.unpack_from("<H", image, 12)[0] == ESP_CHIP_IDS[self.chip]
+
+    def start(self):
+        """Serve in a background thread. Returns self."""
+        self._thread = threading.Thread(target=self.serve_forever, name="device-%d" % self.port)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._udp.close()
+        if self._mdns is not None:
+            self._mdns.close()
+
+    def serve_forever(self):
+        while not self._stop.is_set():
+            packet = self._receive(0.2)
+            if packet is None:
+                continue
+            data, remote = packet
+            try:
+                self._handle(data, remote)
+            except (OSError, UpdateError) as e:
+                logging.warning("%s: %s", self.name, str(e))
+
+    def _receive(self, timeout):
+        """Next UDP datagram as (data, remote) or None, after simulated loss. Answers mDNS queries meanwhile."""
+        sockets = [self._udp] if self._mdns is None else [self._udp, self._mdns]
+        readable, _, _ = select.select(sockets, [], [], timeout)
+        if self._mdns in readable:
+            self._answer_mdns()
+        if self._udp not in readable:
+            return None
+        data, remote = self._udp.recvfrom(1460)
+        if self.loss and self._random.random() < self.loss:
+            logging.debug("%s: dropped %d bytes from %s", self.name, len(data), remote[0])
+            return None
+        return data, remote
+
+    def _reply(self, text, remote):
+        if self.loss and self._random.random() < self.loss:
+            logging.debug("%s: dropped answer '%s'", self.name, text)
+            return
+        self._udp.sendto(text.encode(), remote)
+
+    def _answer_mdns(self):
+        """Answer an mDNS query for the _arduino._tcp service like ESPmDNS does."""
+        data, remote = self._mdns.recvfrom(1460)
+        if time.time() < self._offline_until or (self.loss and self._random.random() < self.loss):
+            return
+        try:
+            if not any(name == MDNS_SERVICE for name, _, _ in _questions(data)):
+                return
+        except (ValueError, IndexError, struct.error):
+            return
+        hostname = "esp32-%d.local" % self.port
+        instance = "esp32-%d.%s" % (self.port, MDNS_SERVICE)
+        txt = {
+            "board": "esp32",
+            "tcp_check": "no",
+            "ssh_upload": "no",
+            "auth_upload": "yes" if self.password else "no",
+            "chip": self.chip,
+        }
+        if self.running_image:
+            txt["sha256"] = image_digest(self.running_image)
+        records = [
+            _dns_record(MDNS_SERVICE, DNS_PTR, _dns_name(instance)),
+            _dns_record(instance, DNS_SRV, struct.pack("!HHH", 0, 0, self.port) + _dns_name(hostname)),
+            _dns_record(instance, DNS_TXT, b"".join(_dns_text("%s=%s" % item) for item in txt.items())),
+            _dns_record(hostname, DNS_A, socket.inet_aton(self.address)),
+        ]
+        header = struct.pack("!HHHHHH", struct.unpack_from("!H", data)[0], 0x8400, 0, 1, 0, len(records) - 1)
+        self._mdns.sendto(header + b"".join(records), remote)
+
+    def _parse_extensions(self, line, command, md5, remote):
+        accepted = []
+        session = None
+        for feature in line.split()[1:]:
+            if feature in ("zlib", "resume", "more") and feature in self.features:
+                accepted.append(feature)
+            elif feature.startswith("session:"):
+                session = feature[len("session:") :]
+            elif (
+                feature.startswith("delta:")
+                and "delta" in self.features
+                and command == FLASH
+                and self.running_image
+                and feature[len("delta:") :].lower() == image_digest(self.running_image)
+            ):
+                accepted.append("delta")
+        if session and self._session is not None:
+            key, address, since = self._session
+            if (
+                address == remote[0]
+                and time.time() - since < SESSION_TIMEOUT
+                and session.lower() == session_token(key, command, md5)
+            ):
+                accepted.append("session")
+            if "session" not in accepted or "more" not in accepted:
+                self._session = None
+        return accepted
+
+    def _handle(self, data, remote):
+        lines = data.decode(errors="replace").split("\n")
+        words = lines[0].split()
+        if len(words) != 4 or not words[0].isdigit() or int(words[0]) not in (FLASH, SPIFFS):
+            return
+        command, host_port, size, md5 = int(words[0]), int(words[1]), int(words[2]), words[3]
+        if len(md5) != 32:
+            logging.error("%s: bad md5 length", self.name)
+            return
+        features = []
+        extensions = ""
+        record = UpdateRecord(command, size, md5, features)
+        transfer = None
+        if self.features is not None and len(lines) > 1 and lines[1].startswith("EXT"):
+            record.features = features = self._parse_extensions(lines[1], command, md5, remote)
+            pending = self._pending
+            if (
+                "resume" in features
+                and pending is not None
+                and pending.key == transfer_key(record)
+                and time.time() - pending.suspended_at < RESUME_TIMEOUT
+            ):
+                transfer = pending
+            offset = transfer.received if transfer is not None else 0
+            tokens = ["resume:%d" % offset if feature == "resume" else feature for feature in features]
+            extensions = " ".join(["", "EXT"] + tokens)
+
+        if self.password and "session" not in features:
+            if not self._authenticate(remote, extensions):
+                return
+            if "more" in features and self._derived_key:
+                self._session = (self._derived_key, remote[0], time.time())
+        else:
+            self._reply("OK" + extensions, remote)
+        self._pending = None
+        if transfer is None:
+            self.updates.append(record)
+            transfer = Transfer(record, self.running_image, self.flash_rate)
+        else:
+            transfer.record.resumes += 1
+            logging.info("%s: resuming update at %d bytes", self.name, transfer.received)
+        self._run_update(remote[0], host_port, transfer)
+
+    def _authenticate(self, remote, extensions):
+        if self.legacy_auth:
+            nonce = hashlib.md5(("%f%d" % (time.time(), self._random.random() * 1e6)).encode()).hexdigest()
+        else:
+            nonce = hashlib.sha256(("%f%d" % (time.time(), self._random.random() * 1e6)).encode()).hexdigest()
+        challenge = "AUTH %s%s" % (nonce, extensions)
+        self._reply(challenge, remote)
+
+        deadline = time.time() + self.timeout * 10
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            packet = self._receive(remaining)
+            if packet is None:
+                continue
+            words = packet[0].decode(errors="replace").split()
+            if words and words[0] in (str(FLASH), str(SPIFFS)) and packet[1] == remote:
+                # The host repeated the invitation as the challenge got lost, answer it again
+                self._reply(challenge, remote)
+                continue
+            break
+        if len(words) != 3 or words[0] != str(AUTH):
+            logging.error("%s: %d was expected. got %s instead", self.name, AUTH, words[0] if words else "nothing")
+            return False
+        cnonce, response = words[1], words[2]
+        self._derived_key = None
+        if self.legacy_auth:
+            password_hash = hashlib.md5(self.password.encode()).hexdigest()
+            expected = hashlib.md5(("%s:%s:%s" % (password_hash, nonce, cnonce)).encode()).hexdigest()
+        else:
+            if self.md5_password:
+                password_hash = hashlib.md5(self.password.encode()).hexdigest()
+            else:
+                password_hash = hashlib.sha256(self.password.encode()).hexdigest()
+            salt = nonce + ":" + cnonce
+            derived_key = hashlib.pbkdf2_hmac("sha256", password_hash.encode(), salt.encode(), PBKDF2_ITERATIONS)
+            expected = hashlib.sha256(("%s:%s:%s" % (derived_key.hex(), nonce, cnonce)).encode()).hexdigest()
+            self._derived_key = derived_key.hex()
+        if response != expected:
+            logging.warning("%s: Authentication Failed", self.name)
+            self._reply("Authentication Failed", packet[1])
+            return False
+        self._reply("OK", packet[1])
+        return True
+
+    def _suspend(self, transfer):
+        """Keep an interrupted transfer for the host to resume it, if it asked for that."""
+        if "resume" not in transfer.record.features or transfer.record.error is not None:
+            return False
+        logging.warning(
+            "%s: connection lost after %d bytes, waiting for the upload to resume", self.name, transfer.received
+        )
+        transfer.suspended_at = time.time()
+        self._pending = transfer
+        return True
+
+    def _run_update(self, host, host_port, transfer):
+        record = transfer.record
+        connection = socket.create_connection((host, host_port), timeout=10)
+        try:
+            written = tried = 0
+            while record.bytes_written < record.size:
+                readable, _, _ = select.select([connection], [], [], self.timeout)
+                if not readable:
+                    if written and tried < ACK_RETRIES:
+                        tried += 1
+                        logging.info("%s: Try[%d]: %d", self.name, tried, written)
+                        connection.sendall(_ack(record, written, transfer.received))
+                        continue
+                    logging.error("%s: Receive Failed", self.name)
+                    if not self._suspend(transfer):
+                        # The firmware aborts without reporting anything to the host
+                        record.error = UPDATE_ERROR_STREAM
+                    return
+                data = connection.recv(DEVICE_BUFFER_SIZE)
+                if not data:
+                    break
+                tried = 0
+                record.bytes_received += len(data)
+                try:
+                    transfer.sink(data)
+                except (UpdateError, zlib.error) as e:
+                    logging.error("%s: %s", self.name, str(e))
+                    record.error = str(e) if isinstance(e, UpdateError) else UPDATE_ERROR_ABORT
+                    break
+                transfer.received += len(data)
+                if self.ack_latency:
+                    time.sleep(self.ack_latency)
+                written = len(data)
+                connection.sendall(_ack(record, written, transfer.received))
+                if self.disconnect_after and not transfer.disconnected and transfer.received >= self.disconnect_after:
+                    logging.info("%s: dropping the connection after %d bytes", self.name, transfer.received)
+                    transfer.disconnected = True
+                    break
+
+            if record.error is None and record.bytes_written < record.size:
+                if self._suspend(transfer):
+                    return
+                record.error = UPDATE_ERROR_ABORT
+            if record.error is None and transfer.md5.hexdigest() != record.md5:
+                record.error = UPDATE_ERROR_MD5
+            if record.error is None and record.command == FLASH and not self._bootable(transfer.image):
+                record.error = UPDATE_ERROR_ACTIVATE
+            record.end_time = time.time()
+            if record.error is not None:
+                self._session = None
+                connection.sendall((record.error + "\r\n").encode())
+                logging.error("%s: Update ERROR: %s", self.name, record.error)
+                return
+            connection.sendall(b"OK")
+        except OSError as e:
+            if not self._suspend(transfer):
+                if record.error is None:
+                    record.error = str(e)
+                raise
+        finally:
+            connection.close()
+
+        logging.info(
+            "%s: update of %d bytes done in %.2f s", self.name, record.size, record.end_time - record.start_time
+        )
+        if record.command == FLASH:
+            self.running_image = bytes(transfer.image)
+        if "more" in record.features:
+            # Another image follows in the same session, reboot after that one
+            if self._session is not None:
+                self._session = self._session[:2] + (time.time(),)
+        elif self.reboot_time:
+            self._reboot()
+
+    def _reboot(self):
+        """Stay deaf to invitations for reboot_time, as a board restarting into the new app."""
+        deadline = self._offline_until = time.time() + self.reboot_time
+        while not self._stop.is_set() and time.time() < deadline:
+            self._receive(min(0.2, max(deadline - time.time(), 0)))
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(
+        description="Simulate ArduinoOTA devices to test espota.py without hardware",
+        prog=sys.argv[0],
+    )
+    parser.add_argument("-I", "--ip", dest="address", help="Address to listen on.", default="127.0.0.1")
+    parser.add_argument("-p", "--port", dest="port", type=int, help="UDP port of the first device.", default=3232)
+    parser.add_argument(
+        "-n", "--devices", dest="devices", type=int, help="Number of devices, on consecutive ports.", default=1
+    )
+    parser.add_argument("-a", "--auth", dest="password", help="Password of the devices.", default="")
+    parser.add_argument(
+        "--md5-password",
+        dest="md5_password",
+        action="store_true",
+        help="Store the password as MD5 hash, like setPasswordHash() with 32 characters.",
+        default=False,
+    )
+    parser.add_argument(
+        "--legacy-auth",
+        dest="legacy_auth",
+        action="store_true",
+        help="Use the MD5 challenge of firmware older than 3.3.1.",
+        default=False,
+    )
+    parser.add_argument(
+        "--features",
+        dest="features",
+        help="Comma separated EXT features accepted by the devices (default: %(default)s).",
+        default="zlib,delta,resume,more",
+    )
+    parser.add_argument(
+        "--no-ext",
+        dest="no_ext",
+        action="store_true",
+        help="Simulate firmware that ignores the EXT line of the invitation.",
+        default=False,
+    )
+    parser.add_argument("--running", dest="running", help="App image the devices run, for delta updates.")
+    parser.add_argument(
+        "--flash-rate", dest="flash_rate", type=float, help="Flash write speed in KB/s (default: unlimited).", default=0
+    )
+    parser.add_argument(
+        "--ack-latency", dest="ack_latency", type=float, help="Delay before every acknowledgment in ms.", default=0
+    )
+    parser.add_argument("--loss", dest="loss", type=float, help="Fraction of UDP datagrams lost, 0 to 1.", default=0)
+    parser.add_argument(
+        "--disconnect-after",
+        dest="disconnect_after",
+        type=int,
+        help="Drop the data connection once per update after receiving this many bytes.",
+        default=0,
+    )
+    parser.add_argument(
+        "--reboot-time", dest="reboot_time", type=float, help="Seconds offline after an update.", default=0
+    )
+    parser.add_argument(
+        "--mdns",
+        dest="mdns",
+        action="store_true",
+        help="Answer mDNS queries on port 5353 of the address (only the first device).",
+        default=False,
+    )
+    parser.add_argument(
+        "--chip",
+        dest="chip",
+        choices=sorted(ESP_CHIP_IDS),
+        help="Chip of the devices, announced over mDNS (default: esp32).",
+        default="esp32",
+    )
+    parser.add_argument("--seed", dest="seed", type=int, help="Seed of the simulated packet loss.")
+    parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Show debug output.", default=False)
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    options = parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO,
+        format="%(asctime)-8s [%(levelname)s]: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    running_image = b""
+    if options.running:
+        with open(options.running, "rb") as f:
+            running_image = f.read()
+    devices = []
+    try:
+        for index in range(options.devices):
+            device = SimulatedDevice(
+                port=options.port + index,
+                address=options.address,
+                password=options.password,
+                md5_password=options.md5_password,
+                legacy_auth=options.legacy_auth,
+                features=None if options.no_ext else [f for f in options.features.split(",") if f],
+                running_image=running_image,
+                flash_rate=options.flash_rate * 1024,
+                ack_latency=options.ack_latency / 1000.0,
+                loss=options.loss,
+                disconnect_after=options.disconnect_after,
+                reboot_time=options.reboot_time,
+                seed=None if options.seed is None else options.seed + index,
+                mdns=options.mdns and index == 0,
+                chip=options.chip,
+            )
+            devices.append(device.start())
+            logging.info("Device listening on %s", device.name)
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        logging.error("Could not start device: %s", str(e))
+        return 1
+    finally:
+        for device in devices:
+            device.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
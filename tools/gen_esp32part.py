@@ -11,12 +11,19 @@
 # SPDX-License-Identifier: Apache-2.0
 import argparse
 import binascii
+import concurrent.futures
+import copy
 import errno
 import hashlib
+import io
+import json
+import multiprocessing
 import os
 import re
+import shlex
 import struct
 import sys
+import threading
 
 MAX_PARTITION_LENGTH = 0xC00  # 3K for partition data (96 entries) leaves 1K in a 4K sector for signature
 MD5_PARTITION_BEGIN = b"\xeb\xeb" + b"\xff" * 14  # The first 2 bytes are like magic numbers for MD5 sum
@@ -91,10 +98,11 @@ SUBTYPES = {
 }
 
 
-def get_subtype_as_int(ptype, subtype):
+def get_subtype_as_int(ptype, subtype, options=None):
     """Convert a string which might be numeric or the name of a partition subtype to an integer"""
+    subtypes = SUBTYPES if options is None else options.subtypes
     try:
-        return SUBTYPES[get_ptype_as_int(ptype)][subtype]
+        return subtypes[get_ptype_as_int(ptype)][subtype]
     except KeyError:
         try:
             return int(subtype, 0)
@@ -114,13 +122,14 @@ def get_alignment_offset_for_type(ptype):
     return ALIGNMENT.get(ptype, ALIGNMENT[DATA_TYPE])
 
 
-def get_alignment_size_for_type(ptype):
+def get_alignment_size_for_type(ptype, options=None):
+    secure_boot = secure if options is None else options.secure
     if ptype == APP_TYPE:
-        if secure == SECURE_V1:
+        if secure_boot == SECURE_V1:
             # For secure boot v1 case, app partition must be 64K aligned
             # signature block (68 bytes) lies at the very end of 64K block
             return 0x10000
-        elif secure == SECURE_V2:
+        elif secure_boot == SECURE_V2:
             # For secure boot v2 case, app partition must be 4K aligned
             # signature block (4K) is kept after padding the unsigned image to 64K boundary
             return 0x1000
@@ -143,14 +152,16 @@ def get_partition_type(ptype):
     raise InputError("Invalid partition type")
 
 
-def add_extra_subtypes(csv):
+def add_extra_subtypes(csv, subtypes=None):
+    if subtypes is None:
+        subtypes = SUBTYPES
     for line_no in csv:
         try:
             fields = [line.strip() for line in line_no.split(",")]
-            for subtype, subtype_values in SUBTYPES.items():
+            for subtype, subtype_values in subtypes.items():
                 if int(fields[2], 16) in subtype_values.values() and subtype == get_partition_type(fields[0]):
                     raise ValueError("Found duplicate value in partition subtype")
-            SUBTYPES[TYPES[fields[0]]][fields[1]] = int(fields[2], 16)
+            subtypes[TYPES[fields[0]]][fields[1]] = int(fields[2], 16)
         except InputError as err:
             raise InputError("Error parsing custom subtypes: %s" % err)
 
@@ -162,6 +173,10 @@ offset_part_table = 0
 primary_bootloader_offset = None
 recovery_bootloader_offset = None
 
+# Shared cache of converted tables, see TableCache
+CACHE_DIR_ENV = "GEN_ESP32PART_CACHE_DIR"
+DEFAULT_CACHE_SIZE = 4 * 1024 * 1024
+
 
 def status(msg):
     """Print status message to stderr"""
@@ -175,25 +190,80 @@ def critical(msg):
     sys.stderr.write("\n")
 
 
+class Options(object):
+    """The settings a table is parsed, verified and generated with. Tables and partitions
+    created with their own Options can be processed concurrently, in threads as well.
+    Without Options, the module globals of the same names apply, as they always did.
+    If `warnings` is a list, the warnings printed about the table are appended to it."""
+
+    def __init__(
+        self,
+        quiet=False,
+        md5sum=True,
+        secure=SECURE_NONE,
+        offset_part_table=0,
+        primary_bootloader_offset=None,
+        recovery_bootloader_offset=None,
+        subtypes=None,
+        warnings=None,
+    ):
+        self.quiet = quiet
+        self.md5sum = md5sum
+        self.secure = secure
+        self.offset_part_table = offset_part_table
+        self.primary_bootloader_offset = primary_bootloader_offset
+        self.recovery_bootloader_offset = recovery_bootloader_offset
+        # Shared until add_extra_subtypes() copies them, so it only affects the tables of these options
+        self.subtypes = SUBTYPES if subtypes is None else subtypes
+        self._own_subtypes = False
+        self.warnings = warnings
+
+    @classmethod
+    def from_globals(cls):
+        return cls(
+            quiet, md5sum, secure, offset_part_table, primary_bootloader_offset, recovery_bootloader_offset, SUBTYPES
+        )
+
+    def add_extra_subtypes(self, csv):
+        if not self._own_subtypes:
+            self.subtypes = copy.deepcopy(self.subtypes)
+            self._own_subtypes = True
+        add_extra_subtypes(csv, self.subtypes)
+
+    def status(self, msg):
+        """Print status message to stderr"""
+        if not self.quiet:
+            critical(msg)
+
+    def warning(self, msg):
+        """Print a warning to stderr, and collect it in `warnings`"""
+        critical(msg)
+        if self.warnings is not None:
+            self.warnings.append(msg)
+
+
 class PartitionTable(list):
-    def __init__(self):
+    def __init__(self, options=None):
         super(PartitionTable, self).__init__(self)
+        self.options = options or Options.from_globals()
 
     @classmethod
-    def from_file(cls, f):
+    def from_file(cls, f, options=None):
+        options = options or Options.from_globals()
         data = f.read()
         data_is_binary = data[0:2] == PartitionDefinition.MAGIC_BYTES
         if data_is_binary:
-            status("Parsing binary partition input...")
-            return cls.from_binary(data), True
+            options.status("Parsing binary partition input...")
+            return cls.from_binary(data, options), True
 
         data = data.decode()
-        status("Parsing CSV input...")
-        return cls.from_csv(data), False
+        options.status("Parsing CSV input...")
+        return cls.from_csv(data, options), False
 
     @classmethod
-    def from_csv(cls, csv_contents):
-        res = PartitionTable()
+    def from_csv(cls, csv_contents, options=None):
+        options = options or Options.from_globals()
+        res = cls(options)
         lines = csv_contents.splitlines()
 
         def expand_vars(f):
@@ -208,7 +278,7 @@ class PartitionTable(list):
             if line.startswith("#") or len(line) == 0:
                 continue
             try:
-                res.append(PartitionDefinition.from_csv(line, line_no + 1))
+                res.append(PartitionDefinition.from_csv(line, line_no + 1, options))
             except InputError as err:
                 raise InputError(
                     "Error at line %d: %s\nPlease check extra_partition_subtypes.inc file in build/config directory"
@@ -219,10 +289,11 @@ class PartitionTable(list):
                 raise
 
         # fix up missing offsets & negative sizes
-        last_end = offset_part_table + PARTITION_TABLE_SIZE  # first offset after partition table
+        last_end = options.offset_part_table + PARTITION_TABLE_SIZE  # first offset after partition table
+        subtypes = options.subtypes
         for e in res:
-            is_primary_bootloader = e.type == BOOTLOADER_TYPE and e.subtype == SUBTYPES[e.type]["primary"]
-            is_primary_partition_table = e.type == PARTITION_TABLE_TYPE and e.subtype == SUBTYPES[e.type]["primary"]
+            is_primary_bootloader = e.type == BOOTLOADER_TYPE and e.subtype == subtypes[e.type]["primary"]
+            is_primary_partition_table = e.type == PARTITION_TABLE_TYPE and e.subtype == subtypes[e.type]["primary"]
             if is_primary_bootloader or is_primary_partition_table:
                 # They do not participate in the restoration of missing offsets
                 continue
@@ -231,7 +302,7 @@ class PartitionTable(list):
                     raise InputError(
                         "CSV Error at line %d: Partitions overlap. Partition sets offset 0x%x. "
                         "But partition table occupies the whole sector 0x%x. "
-                        "Use a free offset 0x%x or higher." % (e.line_no, e.offset, offset_part_table, last_end)
+                        "Use a free offset 0x%x or higher." % (e.line_no, e.offset, options.offset_part_table, last_end)
                     )
                 else:
                     raise InputError(
@@ -265,7 +336,7 @@ class PartitionTable(list):
         None if not found"""
         # convert ptype & subtypes names (if supplied this way) to integer values
         ptype = get_ptype_as_int(ptype)
-        subtype = get_subtype_as_int(ptype, subtype)
+        subtype = get_subtype_as_int(ptype, subtype, self.options)
 
         for p in self:
             if p.type == ptype and p.subtype == subtype:
@@ -279,6 +350,8 @@ class PartitionTable(list):
         return None
 
     def verify(self):
+        offset_part_table = self.options.offset_part_table
+        subtypes = self.options.subtypes
         # verify each partition individually
         for p in self:
             p.verify()
@@ -299,8 +372,8 @@ class PartitionTable(list):
         last = None
         for p in sorted(self, key=lambda x: x.offset):
             if p.offset < offset_part_table + PARTITION_TABLE_SIZE:
-                is_primary_bootloader = p.type == BOOTLOADER_TYPE and p.subtype == SUBTYPES[p.type]["primary"]
-                is_primary_partition_table = p.type == PARTITION_TABLE_TYPE and p.subtype == SUBTYPES[p.type]["primary"]
+                is_primary_bootloader = p.type == BOOTLOADER_TYPE and p.subtype == subtypes[p.type]["primary"]
+                is_primary_partition_table = p.type == PARTITION_TABLE_TYPE and p.subtype == subtypes[p.type]["primary"]
                 if not (is_primary_bootloader or is_primary_partition_table):
                     raise InputError(
                         "Partition offset 0x%x is below 0x%x" % (p.offset, offset_part_table + PARTITION_TABLE_SIZE)
@@ -312,7 +385,7 @@ class PartitionTable(list):
             last = p
 
         # check that otadata should be unique
-        otadata_duplicates = [p for p in self if p.type == TYPES["data"] and p.subtype == SUBTYPES[DATA_TYPE]["ota"]]
+        otadata_duplicates = [p for p in self if p.type == TYPES["data"] and p.subtype == subtypes[DATA_TYPE]["ota"]]
         if len(otadata_duplicates) > 1:
             for p in otadata_duplicates:
                 critical("%s" % (p.to_csv()))
@@ -328,7 +401,7 @@ class PartitionTable(list):
 
         # Above checks but for TEE otadata
         otadata_duplicates = [
-            p for p in self if p.type == TYPES["data"] and p.subtype == SUBTYPES[DATA_TYPE]["tee_ota"]
+            p for p in self if p.type == TYPES["data"] and p.subtype == subtypes[DATA_TYPE]["tee_ota"]
         ]
         if len(otadata_duplicates) > 1:
             for p in otadata_duplicates:
@@ -367,16 +440,17 @@ class PartitionTable(list):
             )
 
     @classmethod
-    def from_binary(cls, b):
+    def from_binary(cls, b, options=None):
+        options = options or Options.from_globals()
         md5 = hashlib.md5()
-        result = cls()
+        result = cls(options)
         for o in range(0, len(b), 32):
             data = b[o : o + 32]
             if len(data) != 32:
                 raise InputError("Partition table length must be a multiple of 32 bytes")
             if data == b"\xff" * 32:
                 return result  # got end marker
-            if md5sum and data[:2] == MD5_PARTITION_BEGIN[:2]:  # check only the magic number part
+            if options.md5sum and data[:2] == MD5_PARTITION_BEGIN[:2]:  # check only the magic number part
                 if data[16:] == md5.digest():
                     continue  # the next iteration will check for the end marker
                 else:
@@ -386,12 +460,12 @@ class PartitionTable(list):
                     )
             else:
                 md5.update(data)
-            result.append(PartitionDefinition.from_binary(data))
+            result.append(PartitionDefinition.from_binary(data, options))
         raise InputError("Partition table is missing an end-of-table marker")
 
     def to_binary(self):
         result = b"".join(e.to_binary() for e in self)
-        if md5sum:
+        if self.options.md5sum:
             result += MD5_PARTITION_BEGIN + hashlib.md5(result).digest()
         if len(result) >= MAX_PARTITION_LENGTH:
             raise InputError("Binary partition table length (%d) longer than max" % len(result))
@@ -419,7 +493,8 @@ class PartitionDefinition(object):
     for tee_slot in range(NUM_PARTITION_SUBTYPE_APP_TEE):
         SUBTYPES[TYPES["app"]]["tee_%d" % tee_slot] = MIN_PARTITION_SUBTYPE_APP_TEE + tee_slot
 
-    def __init__(self):
+    def __init__(self, options=None):
+        self.options = options or Options.from_globals()
         self.name = ""
         self.type = None
         self.subtype = None
@@ -429,12 +504,12 @@ class PartitionDefinition(object):
         self.readonly = False
 
     @classmethod
-    def from_csv(cls, line, line_no):
+    def from_csv(cls, line, line_no, options=None):
         """Parse a line from the CSV"""
         line_w_defaults = line + ",,,,"  # lazy way to support default fields
         fields = [f.strip() for f in line_w_defaults.split(",")]
 
-        res = PartitionDefinition()
+        res = PartitionDefinition(options)
         res.line_no = line_no
         res.name = fields[0]
         res.type = res.parse_type(fields[1])
@@ -507,14 +582,14 @@ class PartitionDefinition(object):
         if strval == "":
             if self.type == TYPES["app"]:
                 raise InputError("App partition cannot have an empty subtype")
-            return SUBTYPES[DATA_TYPE]["undefined"]
-        return parse_int(strval, SUBTYPES.get(self.type, {}))
+            return self.options.subtypes[DATA_TYPE]["undefined"]
+        return parse_int(strval, self.options.subtypes.get(self.type, {}))
 
     def parse_size(self, strval, ptype):
         if ptype == BOOTLOADER_TYPE:
-            if primary_bootloader_offset is None:
+            if self.options.primary_bootloader_offset is None:
                 raise InputError("Primary bootloader offset is not defined. Please use --primary-bootloader-offset")
-            return offset_part_table - primary_bootloader_offset
+            return self.options.offset_part_table - self.options.primary_bootloader_offset
         if ptype == PARTITION_TABLE_TYPE:
             return PARTITION_TABLE_SIZE
         if strval == "":
@@ -522,19 +597,20 @@ class PartitionDefinition(object):
         return parse_int(strval)
 
     def parse_address(self, strval, ptype, psubtype):
+        options = self.options
         if ptype == BOOTLOADER_TYPE:
-            if psubtype == SUBTYPES[ptype]["primary"]:
-                if primary_bootloader_offset is None:
+            if psubtype == options.subtypes[ptype]["primary"]:
+                if options.primary_bootloader_offset is None:
                     raise InputError("Primary bootloader offset is not defined. Please use --primary-bootloader-offset")
-                return primary_bootloader_offset
-            if psubtype == SUBTYPES[ptype]["recovery"]:
-                if recovery_bootloader_offset is None:
+                return options.primary_bootloader_offset
+            if psubtype == options.subtypes[ptype]["recovery"]:
+                if options.recovery_bootloader_offset is None:
                     raise InputError(
                         "Recovery bootloader offset is not defined. Please use --recovery-bootloader-offset"
                     )
-                return recovery_bootloader_offset
-        if ptype == PARTITION_TABLE_TYPE and psubtype == SUBTYPES[ptype]["primary"]:
-            return offset_part_table
+                return options.recovery_bootloader_offset
+        if ptype == PARTITION_TABLE_TYPE and psubtype == options.subtypes[ptype]["primary"]:
+            return options.offset_part_table
         if strval == "":
             return None  # PartitionTable will fill in default
         return parse_int(strval)
@@ -552,26 +628,27 @@ class PartitionDefinition(object):
         if self.offset % offset_align:
             raise ValidationError(self, "Offset 0x%x is not aligned to 0x%x" % (self.offset, offset_align))
         if self.type == APP_TYPE:
-            size_align = get_alignment_size_for_type(self.type)
+            size_align = get_alignment_size_for_type(self.type, self.options)
             if self.size % size_align:
                 raise ValidationError(self, "Size 0x%x is not aligned to 0x%x" % (self.size, size_align))
 
         if self.name in TYPES and TYPES.get(self.name, "") != self.type:
-            critical(
+            self.options.warning(
                 "WARNING: Partition has name '%s' which is a partition type, but does not match this partition's "
                 "type (0x%x). Mistake in partition table?" % (self.name, self.type)
             )
+        subtypes = self.options.subtypes
         all_subtype_names = []
-        for names in (t.keys() for t in SUBTYPES.values()):
+        for names in (t.keys() for t in subtypes.values()):
             all_subtype_names += names
-        if self.name in all_subtype_names and SUBTYPES.get(self.type, {}).get(self.name, "") != self.subtype:
-            critical(
+        if self.name in all_subtype_names and subtypes.get(self.type, {}).get(self.name, "") != self.subtype:
+            self.options.warning(
                 "WARNING: Partition has name '%s' which is a partition subtype, but this partition has "
                 "non-matching type 0x%x and subtype 0x%x. Mistake in partition table?"
                 % (self.name, self.type, self.subtype)
             )
 
-        always_rw_data_subtypes = [SUBTYPES[DATA_TYPE]["ota"], SUBTYPES[DATA_TYPE]["coredump"]]
+        always_rw_data_subtypes = [subtypes[DATA_TYPE]["ota"], subtypes[DATA_TYPE]["coredump"]]
         if self.type == TYPES["data"] and self.subtype in always_rw_data_subtypes and self.readonly is True:
             raise ValidationError(
                 self,
@@ -579,7 +656,7 @@ class PartitionDefinition(object):
                 % (self.name, self.type, self.subtype),
             )
 
-        if self.type == TYPES["data"] and self.subtype == SUBTYPES[DATA_TYPE]["nvs"]:
+        if self.type == TYPES["data"] and self.subtype == subtypes[DATA_TYPE]["nvs"]:
             if self.size < NVS_RW_MIN_PARTITION_SIZE and self.readonly is False:
                 raise ValidationError(
                     self,
@@ -591,10 +668,10 @@ class PartitionDefinition(object):
     STRUCT_FORMAT = b"<2sBBLL16sL"
 
     @classmethod
-    def from_binary(cls, b):
+    def from_binary(cls, b, options=None):
         if len(b) != 32:
             raise InputError("Partition definition length must be exactly 32 bytes. Got %d bytes." % len(b))
-        res = cls()
+        res = cls(options)
         (magic, res.type, res.subtype, res.offset, res.size, res.name, flags) = struct.unpack(cls.STRUCT_FORMAT, b)
         if b"\x00" in res.name:  # strip null byte padding from name string
             res.name = res.name[: res.name.index(b"\x00")]
@@ -606,7 +683,9 @@ class PartitionDefinition(object):
                 setattr(res, flag, True)
                 flags &= ~(1 << bit)
         if flags != 0:
-            critical("WARNING: Partition definition had unknown flag(s) 0x%08x. Newer binary format?" % flags)
+            res.options.warning(
+                "WARNING: Partition definition had unknown flag(s) 0x%08x. Newer binary format?" % flags
+            )
         return res
 
     def get_flags_list(self):
@@ -647,7 +726,7 @@ class PartitionDefinition(object):
             [
                 self.name,
                 lookup_keyword(self.type, TYPES),
-                lookup_keyword(self.subtype, SUBTYPES.get(self.type, {})),
+                lookup_keyword(self.subtype, self.options.subtypes.get(self.type, {})),
                 addr_format(self.offset, False),
                 addr_format(self.size, True),
                 generate_text_flags(),
@@ -673,14 +752,239 @@ def parse_int(v, keywords={}):
             raise InputError("Value '%s' is not valid. Known keywords: %s" % (v, ", ".join(keywords)))
 
 
-def main():
-    global quiet
-    global md5sum
-    global offset_part_table
-    global secure
-    global primary_bootloader_offset
-    global recovery_bootloader_offset
-    parser = argparse.ArgumentParser(description="ESP32 partition table utility")
+class LayoutRole(object):
+    """A line of a --layout file: a partition with a size range instead of an offset and size.
+
+    # Name,   Type, SubType,  Min,  Max, Priority, Flags
+    nvs,      data, nvs,      20K,  20K,
+    otadata,  data, ota,      8K,   8K,
+    app0,     app,  ota_0,    1M,   ,    1
+    app1,     app,  ota_1,    1M,   ,    1
+    spiffs,   data, spiffs,   1M,   ,    2
+    coredump, data, coredump, 64K,  64K,
+
+    Partitions without a priority keep their minimum size. The others grow, priority 1
+    first, up to their maximum size (no limit if empty). Partitions of the same priority
+    grow together and keep the same size.
+    """
+
+    def __init__(self, definition, min_size, max_size=None, priority=None):
+        self.definition = definition
+        self.min_size = min_size
+        self.max_size = max_size
+        self.priority = priority
+        # Flash erase size, or the secure boot size alignment of apps
+        self.step = max(0x1000, get_alignment_size_for_type(definition.type, definition.options))
+        self.offset_align = get_alignment_offset_for_type(definition.type)
+
+    @classmethod
+    def from_csv(cls, line, line_no, options=None):
+        fields = [f.strip() for f in (line + ",,,,,,").split(",")]
+        if fields[3] == "":
+            raise InputError("Field 'min' can't be left empty.")
+        # Name, type, subtype, size and flags read as in a partition table
+        definition = PartitionDefinition.from_csv(",".join(fields[0:3] + ["", fields[3], fields[6]]), line_no, options)
+        if definition.type in (BOOTLOADER_TYPE, PARTITION_TABLE_TYPE):
+            raise InputError("%s partitions have a fixed place and can't be laid out" % fields[1])
+        role = cls(
+            definition,
+            definition.size,
+            parse_int(fields[4]) if fields[4] else None,
+            parse_int(fields[5]) if fields[5] else None,
+        )
+        # Grow in whole steps: round the minimum up and the maximum down
+        role.min_size += -role.min_size % role.step
+        if role.max_size is not None:
+            role.max_size -= role.max_size % role.step
+            if role.max_size < role.min_size:
+                raise InputError("Maximum size 0x%x is below the minimum size 0x%x" % (role.max_size, role.min_size))
+        return role
+
+    def clamp(self, size):
+        """`size` rounded down to a step, within the size range"""
+        size -= size % self.step
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        return max(size, self.min_size)
+
+
+def place_roles(roles, sizes, start):
+    """Offsets of the `roles` with `sizes`, placed in order from `start`, and the end of the last one"""
+    offsets = []
+    end = start
+    for role, size in zip(roles, sizes):
+        end += -end % role.offset_align
+        offsets.append(end)
+        end += size
+    return offsets, end
+
+
+def solve_layout(layout_contents, flash_size, options=None):
+    """Lay out the partitions of a --layout file (see LayoutRole) in `flash_size` bytes.
+    Returns the verified PartitionTable.
+    """
+    options = options or Options.from_globals()
+    roles = []
+    for line_no, line in enumerate(layout_contents.splitlines(), 1):
+        line = line.strip()
+        if line.startswith("#") or len(line) == 0:
+            continue
+        try:
+            roles.append(LayoutRole.from_csv(line, line_no, options))
+        except InputError as err:
+            raise InputError("Error at line %d: %s" % (line_no, err))
+
+    start = options.offset_part_table + PARTITION_TABLE_SIZE
+
+    def fits(sizes):
+        return place_roles(roles, sizes, start)[1] <= flash_size
+
+    sizes = [role.min_size for role in roles]
+    if not fits(sizes):
+        raise InputError(
+            "The minimum sizes need 0x%x bytes of flash, more than the %dMB available"
+            % (place_roles(roles, sizes, start)[1], flash_size // (1024 * 1024))
+        )
+
+    # Grow the priorities in turn, the members of a priority to the same size
+    priorities = sorted({role.priority for role in roles if role.priority is not None})
+    for priority in priorities:
+        group = [i for i, role in enumerate(roles) if role.priority == priority]
+
+        def grown(size):
+            result = list(sizes)
+            for i in group:
+                result[i] = roles[i].clamp(size)
+            return result
+
+        low, high = 0, flash_size // 0x1000
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(grown(middle * 0x1000)):
+                low = middle
+            else:
+                high = middle - 1
+        sizes = grown(low * 0x1000)
+
+    # Alignment gaps and the rest of the flash go to the partitions growing alone
+    for priority in priorities:
+        group = [i for i, role in enumerate(roles) if role.priority == priority]
+        if len(group) != 1:
+            continue
+        i = group[0]
+        while roles[i].max_size is None or sizes[i] < roles[i].max_size:
+            sizes[i] += roles[i].step
+            if not fits(sizes):
+                sizes[i] -= roles[i].step
+                break
+
+    offsets, end = place_roles(roles, sizes, start)
+    table = PartitionTable(options)
+    for role, offset, size in zip(roles, offsets, sizes):
+        role.definition.offset = offset
+        role.definition.size = size
+        table.append(role.definition)
+    table.verify()
+    table.verify_size_fits(flash_size)
+    options.status(
+        "Laid out %d partitions, 0x%x bytes unused in alignment gaps and 0x%x at the end of the flash"
+        % (len(table), end - start - sum(sizes), flash_size - end)
+    )
+    return table
+
+
+# SUBTYPES as defined here, before any --extra-partition-subtypes
+DEFAULT_SUBTYPES = copy.deepcopy(SUBTYPES)
+
+
+def _offset_arg(value, option):
+    try:
+        return int(value, 0)
+    except ValueError:
+        raise InputError("Invalid %s value '%s'" % (option, value))
+
+
+def options_from_args(args):
+    """The Options of the parsed command line `args`"""
+    options = Options(
+        quiet=args.quiet,
+        md5sum=not args.disable_md5sum,
+        secure=args.secure,
+        offset_part_table=_offset_arg(args.offset, "--offset"),
+        subtypes=DEFAULT_SUBTYPES,
+    )
+    if args.primary_bootloader_offset is not None:
+        options.primary_bootloader_offset = _offset_arg(args.primary_bootloader_offset, "--primary-bootloader-offset")
+        if options.primary_bootloader_offset >= options.offset_part_table:
+            raise InputError(
+                f"Unsupported configuration. Primary bootloader must be below partition table. "
+                f"Check --primary-bootloader-offset={options.primary_bootloader_offset:#x} "
+                f"and --offset={options.offset_part_table:#x}"
+            )
+    if args.recovery_bootloader_offset is not None:
+        options.recovery_bootloader_offset = _offset_arg(
+            args.recovery_bootloader_offset, "--recovery-bootloader-offset"
+        )
+    if args.extra_partition_subtypes:
+        options.add_extra_subtypes(args.extra_partition_subtypes)
+    return options
+
+
+def convert(data, args, warnings=None):
+    """Convert the CSV or binary table in `data` (bytes) with the options of `args`.
+    Returns the binary table (bytes) for a CSV input, the CSV (str) for a binary one
+    or a --layout file. The warnings printed are appended to `warnings`, if a list.
+    """
+    options = options_from_args(args)
+    options.warnings = warnings
+    if args.layout:
+        if not args.flash_size:
+            raise InputError("--layout needs the --flash-size to lay out")
+        size_mb = int(args.flash_size.replace("MB", ""))
+        table = solve_layout(data.decode(), size_mb * 1024 * 1024, options)
+        return "# Laid out by gen_esp32part.py for %s of flash\n" % args.flash_size + table.to_csv()
+
+    table, input_is_binary = PartitionTable.from_file(io.BytesIO(data), options)
+
+    if not args.no_verify:
+        options.status("Verifying table...")
+        table.verify()
+
+    if args.flash_size:
+        size_mb = int(args.flash_size.replace("MB", ""))
+        table.verify_size_fits(size_mb * 1024 * 1024)
+
+    return table.to_csv() if input_is_binary else table.to_binary()
+
+
+def write_output(filename, output):
+    """Write the result of convert() to `filename`, or to stdout for "-" """
+    # Make sure that the output directory is created
+    output_dir = os.path.abspath(os.path.dirname(filename))
+
+    if not os.path.exists(output_dir):
+        try:
+            os.makedirs(output_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    if isinstance(output, str):
+        with sys.stdout if filename == "-" else open(filename, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        try:
+            stdout_binary = sys.stdout.buffer  # Python 3
+        except AttributeError:
+            stdout_binary = sys.stdout
+        with stdout_binary if filename == "-" else open(filename, "wb") as f:
+            f.write(output)
+
+
+def argument_parser(batch_entry=False):
+    """The command line parser. For a line of a batch manifest, the input is a path and
+    the output is required."""
+    parser = argparse.ArgumentParser(description="ESP32 partition table utility", prog="gen_esp32part.py")
 
     parser.add_argument(
         "--flash-size",
@@ -711,64 +1015,288 @@ def main():
         choices=[SECURE_V1, SECURE_V2],
     )
     parser.add_argument("--extra-partition-subtypes", help="Extra partition subtype entries", nargs="*")
-    parser.add_argument("input", help="Path to CSV or binary file to parse.", type=argparse.FileType("rb"))
+    parser.add_argument(
+        "--layout",
+        help="The input lists partitions with size ranges and priorities, lay them out in the --flash-size "
+        "and output the partition table CSV",
+        action="store_true",
+    )
+    if batch_entry:
+        parser.add_argument("input", help="Path to CSV or binary file to parse.")
+        parser.add_argument("output", help="Path to output converted binary or CSV file.")
+        return parser
+
+    parser.add_argument(
+        "--batch",
+        metavar="MANIFEST",
+        help="Convert every table listed in MANIFEST, one 'input output [options]' line each, - for stdin. "
+        "Relative paths are relative to the manifest.",
+    )
+    parser.add_argument(
+        "--jobs", "-j", help="Tables converted in parallel in batch mode (default: CPU count)", type=int, default=0
+    )
+    parser.add_argument(
+        "--batch-state",
+        help="Where batch mode remembers what each output was generated from, to skip unchanged ones "
+        "(default: MANIFEST.state, none for stdin)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Reuse the tables converted with the same input and options, from this shared directory "
+        "(default: $%s, no cache if unset)" % CACHE_DIR_ENV,
+        default=os.environ.get(CACHE_DIR_ENV) or None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Evict the least recently used tables when the cache grows larger (default: 4M)",
+        default="4M",
+    )
+    parser.add_argument(
+        "input", help="Path to CSV or binary file to parse.", type=argparse.FileType("rb"), nargs="?", default=None
+    )
     parser.add_argument(
         "output",
         help="Path to output converted binary or CSV file. Will use stdout if omitted.",
         nargs="?",
         default="-",
     )
+    return parser
+
+
+# The options a converted table depends on
+KEY_OPTIONS = (
+    "flash_size",
+    "disable_md5sum",
+    "no_verify",
+    "offset",
+    "primary_bootloader_offset",
+    "recovery_bootloader_offset",
+    "secure",
+    "extra_partition_subtypes",
+    "layout",
+)
+
+
+def table_key(data, args):
+    """Identify what an output is generated from: the tool version, the table and the options"""
+    if data[0:2] != PartitionDefinition.MAGIC_BYTES:
+        # Environment variables in the CSV are part of the input
+        data = os.path.expandvars(data.decode(errors="replace")).encode()
+    options = [(k, getattr(args, k)) for k in KEY_OPTIONS]
+    key = hashlib.sha256(__version__.encode())
+    key.update(repr(options).encode())
+    key.update(data)
+    return key.hexdigest()
+
+
+class TableCache(object):
+    """Converted tables by table_key() with the warnings printed while converting them,
+    shared between builds. The least recently used ones are evicted when the cache grows
+    over max_size bytes."""
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key):
+        """(output, warnings) stored for `key`, or None"""
+        for suffix, mode in ((".bin", "rb"), (".csv", "r")):
+            path = self._path(key, suffix)
+            try:
+                with open(path, mode) as f:
+                    output = f.read()
+                os.utime(path)
+            except OSError:
+                continue
+            try:
+                with open(self._path(key, ".warnings"), "r") as f:
+                    warnings = f.read().splitlines()
+                os.utime(self._path(key, ".warnings"))
+            except OSError:
+                warnings = []
+            return output, warnings
+        return None
 
-    args = parser.parse_args()
+    def put(self, key, output, warnings=()):
+        path = self._path(key, ".csv" if isinstance(output, str) else ".bin")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if warnings:
+                # Before the output, which is what readers look for
+                self._write(self._path(key, ".warnings"), "".join(w + "\n" for w in warnings))
+            self._write(path, output)
+        except OSError as e:
+            critical("Cannot store %s in the partition table cache: %s" % (path, e))
+            return
+        self.evict()
+
+    @staticmethod
+    def _write(path, data):
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "w" if isinstance(data, str) else "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # atomic, another build may be reading it
+
+    def evict(self):
+        # The output and the warnings of a table go together
+        entries = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                key = os.path.join(root, os.path.splitext(name)[0])
+                mtime, size, paths = entries.get(key, (0, 0, []))
+                entries[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [os.path.join(root, name)])
+        total = sum(size for _, size, _ in entries.values())
+        for _, size, paths in sorted(entries.values()):
+            if total <= self.max_size:
+                break
+            try:
+                for path in paths:
+                    os.remove(path)
+                if not os.listdir(os.path.dirname(paths[0])):
+                    os.rmdir(os.path.dirname(paths[0]))
+            except OSError:
+                pass
+            total -= size
+
+
+def cached_convert(data, args, cache):
+    """convert() through `cache`, if any. The warnings of the verification are stored with
+    the output and printed again when it is reused."""
+    if cache is None:
+        return convert(data, args)
+    key = table_key(data, args)
+    cached = cache.get(key)
+    if cached is not None:
+        output, warnings = cached
+        if not args.quiet:
+            critical("Using cached partition table %s" % key[:16])
+        for warning in warnings:
+            critical(warning)
+        return output
+    warnings = []
+    output = convert(data, args, warnings)
+    cache.put(key, output, warnings)
+    return output
+
+
+def _convert_batch_entry(entry):
+    """Convert one table of a batch, possibly in a worker process. Returns an error message or None."""
+    data, args, cache = entry
+    try:
+        write_output(args.output, cached_convert(data, args, cache))
+    except (InputError, OSError) as e:
+        return "%s: %s" % (args.input, e)
+    return None
 
-    quiet = args.quiet
-    md5sum = not args.disable_md5sum
-    secure = args.secure
-    offset_part_table = int(args.offset, 0)
-    if args.primary_bootloader_offset is not None:
-        primary_bootloader_offset = int(args.primary_bootloader_offset, 0)
-        if primary_bootloader_offset >= offset_part_table:
-            raise InputError(
-                f"Unsupported configuration. Primary bootloader must be below partition table. "
-                f"Check --primary-bootloader-offset={primary_bootloader_offset:#x} and --offset={offset_part_table:#x}"
-            )
-    if args.recovery_bootloader_offset is not None:
-        recovery_bootloader_offset = int(args.recovery_bootloader_offset, 0)
-    if args.extra_partition_subtypes:
-        add_extra_subtypes(args.extra_partition_subtypes)
 
-    table, input_is_binary = PartitionTable.from_file(args.input)
+def read_manifest(manifest):
+    """Parse the lines of a batch manifest into argument lists for argument_parser(batch_entry=True)"""
+    if manifest == "-":
+        lines, base = sys.stdin.read().splitlines(), os.getcwd()
+    else:
+        with open(manifest, "r", encoding="utf-8") as f:
+            lines, base = f.read().splitlines(), os.path.dirname(os.path.abspath(manifest))
+    parser = argument_parser(batch_entry=True)
+    entries = []
+    for line_no, line in enumerate(lines, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise InputError("%s line %d: invalid entry '%s'" % (manifest, line_no, line.strip()))
+        args.input = os.path.join(base, args.input)
+        args.output = os.path.join(base, args.output)
+        args.quiet = True
+        entries.append(args)
+    return entries
+
+
+def run_batch(args, cache=None):
+    """Convert the tables of the manifest args.batch. Returns the number of failed tables."""
+    entries = read_manifest(args.batch)
+    state_filename = args.batch_state or (None if args.batch == "-" else args.batch + ".state")
+    state = {}
+    if state_filename and os.path.exists(state_filename):
+        try:
+            with open(state_filename, "r") as f:
+                state = json.load(f)
+        except ValueError:
+            state = {}
 
-    if not args.no_verify:
-        status("Verifying table...")
-        table.verify()
+    pending, keys, errors = [], {}, []
+    for entry in entries:
+        try:
+            with open(entry.input, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            errors.append("%s: %s" % (entry.input, e))
+            continue
+        key = table_key(data, entry)
+        previous = state.get(entry.output)
+        if previous and previous.get("key") == key and _output_stamp(entry.output) == previous.get("stamp"):
+            continue
+        keys[entry.output] = key
+        pending.append((data, entry, cache))
+
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    if jobs > 1 and len(pending) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+            results = list(executor.map(_convert_batch_entry, pending, chunksize=max(len(pending) // (jobs * 4), 1)))
+    else:
+        results = [_convert_batch_entry(entry) for entry in pending]
+
+    failed = 0
+    for (_, entry, _), error in zip(pending, results):
+        if error:
+            errors.append(error)
+            state.pop(entry.output, None)
+            failed += 1
+        else:
+            state[entry.output] = {"key": keys[entry.output], "stamp": _output_stamp(entry.output)}
+    for error in errors:
+        critical(error)
+    if not args.quiet:
+        critical(
+            "Generated %d of %d partition tables, %d unchanged, %d failed"
+            % (len(pending) - failed, len(entries), len(entries) - len(pending) - (len(errors) - failed), len(errors))
+        )
+    if state_filename:
+        with open(state_filename, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+    return len(errors)
 
-    if args.flash_size:
-        size_mb = int(args.flash_size.replace("MB", ""))
-        table.verify_size_fits(size_mb * 1024 * 1024)
 
-    # Make sure that the output directory is created
-    output_dir = os.path.abspath(os.path.dirname(args.output))
+def _output_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
 
-    if not os.path.exists(output_dir):
-        try:
-            os.makedirs(output_dir)
-        except OSError as exc:
-            if exc.errno != errno.EEXIST:
-                raise
 
-    if input_is_binary:
-        output = table.to_csv()
-        with sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8") as f:
-            f.write(output)
-    else:
-        output = table.to_binary()
-        try:
-            stdout_binary = sys.stdout.buffer  # Python 3
-        except AttributeError:
-            stdout_binary = sys.stdout
-        with stdout_binary if args.output == "-" else open(args.output, "wb") as f:
-            f.write(output)
+def main():
+    parser = argument_parser()
+    args = parser.parse_args()
+    cache = TableCache(args.cache_dir, parse_int(args.cache_size)) if args.cache_dir else None
+    if args.batch:
+        if args.input is not None:
+            parser.error("no input file with --batch")
+        sys.exit(2 if run_batch(args, cache) else 0)
+    if args.input is None:
+        parser.error("the following arguments are required: input")
+
+    write_output(args.output, cached_convert(args.input.read(), args, cache))
 
 
 class InputError(RuntimeError):
@@ -782,6 +1310,8 @@ class ValidationError(InputError):
 
 
 if __name__ == "__main__":
+    # In a frozen executable (gen_esp32part.exe), the --batch worker processes run their jobs here instead of main()
+    multiprocessing.freeze_support()
     try:
         main()
     except InputError as e:
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# Merged flash image assembler
+#
+# Puts the bootloader, partition table, boot_app0, the app and any extra image at their
+# flash offsets in one file, after checking that no two images overlap and that each one
+# lies within the partition table, the area below it or a single partition. The
+# segments really holding data, without the erased (0xFF) sectors, can be listed in a
+# JSON manifest, and --sparse writes only those segments back to back, so a programming
+# station writes a board from one small file and skips the padding between the images.
+# use it like:
+# python gen_merged_image.py -o merged.bin --app sketch.bin 0x1000 bootloader.bin 0x8000 partitions.bin
+#     0xe000 boot_app0.bin
+#
+# Changes
+# 2026-10-18:
+# - Initial version: overlap checks against the partition table, segment manifest, sparse output
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import sys
+
+import gen_esp32part
+
+DEFAULT_PARTITION_TABLE_OFFSET = 0x8000
+FLASH_SECTOR_SIZE = 0x1000  # Erased sectors need no writing, segments are split at them
+ERASED_SECTOR = b"\xff" * FLASH_SECTOR_SIZE
+PAD_CHUNK = b"\xff" * 0x10000
+FLASH_SIZES = ["1MB", "2MB", "4MB", "8MB", "16MB", "32MB", "64MB", "128MB"]
+MANIFEST_VERSION = 1
+
+FlashImage = collections.namedtuple("FlashImage", "offset filename data")
+# A run of non erased sectors of an image, `offset` in flash
+Segment = collections.namedtuple("Segment", "offset data image partition")
+
+quiet = False
+
+
+def status(msg):
+    """Print status message to stderr"""
+    if not quiet:
+        critical(msg)
+
+
+def critical(msg):
+    """Print critical message to stderr"""
+    sys.stderr.write(msg)
+    sys.stderr.write("\n")
+
+
+class InputError(RuntimeError):
+    pass
+
+
+def read_images(pairs):
+    """FlashImages of the `offset file` pairs of the command line"""
+    if len(pairs) % 2:
+        raise InputError("Images are given as offset file pairs, '%s' has no file" % pairs[-1])
+    images = []
+    for offset, filename in zip(pairs[0::2], pairs[1::2]):
+        try:
+            offset = int(offset, 0)
+        except ValueError:
+            raise InputError("Invalid offset '%s' for %s" % (offset, filename))
+        with open(filename, "rb") as f:
+            images.append(FlashImage(offset, filename, f.read()))
+    return images
+
+
+def load_partition_table(filename, images, table_offset):
+    """The partition table in `filename` (binary or CSV), else the image at `table_offset`, or None"""
+    options = gen_esp32part.Options(quiet=True, offset_part_table=table_offset)
+    try:
+        if filename:
+            with open(filename, "rb") as f:
+                return gen_esp32part.PartitionTable.from_file(f, options)[0]
+        for image in images:
+            if image.offset == table_offset:
+                return gen_esp32part.PartitionTable.from_binary(image.data, options)
+    except gen_esp32part.InputError as e:
+        raise InputError("Invalid partition table: %s" % e)
+    return None
+
+
+def app_partition(table):
+    """The first app partition, where the build flashes the app (0x10000 with the tables of tools/partitions)"""
+    apps = [p for p in table if p.type == gen_esp32part.APP_TYPE]
+    if not apps:
+        raise InputError("The partition table has no app partition")
+    return min(apps, key=lambda p: p.offset)
+
+
+def flash_regions(table, table_offset):
+    """(start, end, name) of the places an image can be written to"""
+    regions = [(0, table_offset, "bootloader area"), (table_offset, table_offset + 0x1000, "partition table")]
+    for p in table:
+        if p.offset >= table_offset + 0x1000:
+            regions.append((p.offset, p.offset + p.size, "partition '%s'" % p.name))
+    return regions
+
+
+def validate(images, table, table_offset, flash_size, target_offset):
+    """Check that the images don't overlap, fit the flash and each lie within one region of the table.
+    Returns the name of the region of each image, by offset."""
+    last = None
+    for image in sorted(images, key=lambda i: i.offset):
+        if image.offset < target_offset:
+            raise InputError(
+                "%s at 0x%x is below the target offset 0x%x" % (image.filename, image.offset, target_offset)
+            )
+        end = image.offset + len(image.data)
+        if flash_size and end > flash_size:
+            raise InputError(
+                "%s at 0x%x-0x%x does not fit in %dMB of flash"
+                % (image.filename, image.offset, end - 1, flash_size // (1024 * 1024))
+            )
+        if last is not None and image.offset < last.offset + len(last.data):
+            raise InputError(
+                "%s at 0x%x overlaps %s at 0x%x-0x%x"
+                % (image.filename, image.offset, last.filename, last.offset, last.offset + len(last.data) - 1)
+            )
+        last = image
+
+    if table is None:
+        status("No partition table, the images are only checked against each other")
+        return {image.offset: "" for image in images}
+    if flash_size:
+        try:
+            table.verify_size_fits(flash_size)
+        except gen_esp32part.InputError as e:
+            raise InputError(str(e))
+    regions = flash_regions(table, table_offset)
+    names = {}
+    for image in images:
+        end = image.offset + len(image.data)
+        for start, region_end, name in regions:
+            if start <= image.offset < region_end:
+                if end > region_end:
+                    raise InputError(
+                        "%s at 0x%x-0x%x does not fit in the %s at 0x%x-0x%x"
+                        % (image.filename, image.offset, end - 1, name, start, region_end - 1)
+                    )
+                names[image.offset] = name
+                break
+        else:
+            raise InputError("%s at 0x%x is not in any partition" % (image.filename, image.offset))
+    return names
+
+
+def segments(images, partitions):
+    """The Segments of the images, without the erased sectors (and parts of sectors) in them"""
+    result = []
+    for image in sorted(images, key=lambda i: i.offset):
+        start = None
+        position = 0
+        while position < len(image.data):
+            # Chunks end on flash sector boundaries
+            chunk_end = min(
+                len(image.data), position + FLASH_SECTOR_SIZE - (image.offset + position) % FLASH_SECTOR_SIZE
+            )
+            erased = image.data[position:chunk_end] == ERASED_SECTOR[: chunk_end - position]
+            if erased and start is not None:
+                result.append(
+                    Segment(image.offset + start, image.data[start:position], image, partitions[image.offset])
+                )
+                start = None
+            elif not erased and start is None:
+                start = position
+            position = chunk_end
+        if start is not None:
+            result.append(Segment(image.offset + start, image.data[start:], image, partitions[image.offset]))
+    return result
+
+
+def write_raw(filename, images, target_offset, pad_to):
+    """The flash contents from `target_offset`, erased (0xFF) between the images. Returns its sha256."""
+    sha256 = hashlib.sha256()
+    with open(filename, "wb") as f:
+
+        def write(data):
+            f.write(data)
+            sha256.update(data)
+
+        position = target_offset
+        for image in sorted(images, key=lambda i: i.offset) + [FlashImage(pad_to or 0, None, b"")]:
+            # A hole in the file would read as zeros, erased flash is 0xFF
+            while position < image.offset:
+                write(PAD_CHUNK[: image.offset - position])
+                position += min(len(PAD_CHUNK), image.offset - position)
+            write(image.data)
+            position += len(image.data)
+    return sha256.hexdigest()
+
+
+def write_sparse(filename, segs):
+    """Only the segments, back to back. Returns the sha256 of the file."""
+    sha256 = hashlib.sha256()
+    with open(filename, "wb") as f:
+        for segment in segs:
+            f.write(segment.data)
+            sha256.update(segment.data)
+    return sha256.hexdigest()
+
+
+def write_manifest(filename, output, output_sha256, sparse, segs, target_offset, flash_size):
+    image_offset = 0
+    entries = []
+    for segment in segs:
+        if not sparse:
+            image_offset = segment.offset - target_offset
+        entries.append(
+            {
+                "offset": segment.offset,
+                "size": len(segment.data),
+                "image_offset": image_offset,
+                "sha256": hashlib.sha256(segment.data).hexdigest(),
+                "source": os.path.basename(segment.image.filename),
+                "partition": segment.partition,
+            }
+        )
+        image_offset += len(segment.data)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "format": "sparse" if sparse else "raw",
+        "image": os.path.basename(output),
+        "image_size": os.path.getsize(output),
+        "image_sha256": output_sha256,
+        "target_offset": target_offset,
+        "flash_size": flash_size,
+        # The flash outside the segments is expected to be erased
+        "segments": entries,
+    }
+    with open(filename, "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.write("\n")
+
+
+def parse_args(unparsed_args):
+    parser = argparse.ArgumentParser(description="Merged flash image assembler", prog="gen_merged_image.py")
+    parser.add_argument("-o", "--output", help="Merged image file", required=True)
+    parser.add_argument("--app", help="App image, written to the first app partition")
+    parser.add_argument(
+        "--partitions",
+        help="Partition table (binary or CSV) the images are checked against "
+        "(default: the image at the partition table offset)",
+    )
+    parser.add_argument(
+        "--partition-table-offset",
+        help="Offset of the partition table (default: 0x%x)" % DEFAULT_PARTITION_TABLE_OFFSET,
+        default=hex(DEFAULT_PARTITION_TABLE_OFFSET),
+    )
+    parser.add_argument("--flash-size", help="Flash size the images must fit in", choices=FLASH_SIZES)
+    parser.add_argument("--pad", help="Pad the merged image to the --flash-size", action="store_true")
+    parser.add_argument("--target-offset", help="Flash offset the merged image is written at (default: 0)", default="0")
+    parser.add_argument(
+        "--sparse",
+        help="Write only the segments holding data, without the erased padding. Needs the manifest to be "
+        "written to flash.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--manifest", help="Write the segments of the image as JSON (default with --sparse: OUTPUT.json)"
+    )
+    parser.add_argument("--quiet", "-q", help="Don't print non-critical status messages to stderr", action="store_true")
+    parser.add_argument("images", help="offset file pairs", nargs="*")
+    return parser.parse_args(unparsed_args)
+
+
+def main(args):
+    global quiet
+    quiet = args.quiet
+    table_offset = int(args.partition_table_offset, 0)
+    target_offset = int(args.target_offset, 0)
+    flash_size = int(args.flash_size.replace("MB", "")) * 1024 * 1024 if args.flash_size else None
+    if args.pad and not flash_size:
+        raise InputError("--pad needs the --flash-size")
+    if args.pad and args.sparse:
+        raise InputError("A sparse image has no padding")
+
+    images = read_images(args.images)
+    table = load_partition_table(args.partitions, images, table_offset)
+    if args.app:
+        if table is None:
+            raise InputError("The partition table is needed to find where the app goes")
+        partition = app_partition(table)
+        with open(args.app, "rb") as f:
+            images.append(FlashImage(partition.offset, args.app, f.read()))
+    if not images:
+        raise InputError("No images to merge")
+
+    partitions = validate(images, table, table_offset, flash_size, target_offset)
+    segs = segments(images, partitions)
+    if args.sparse:
+        sha256 = write_sparse(args.output, segs)
+    else:
+        sha256 = write_raw(args.output, images, target_offset, flash_size if args.pad else None)
+    manifest = args.manifest or (args.output + ".json" if args.sparse else None)
+    if manifest:
+        write_manifest(manifest, args.output, sha256, args.sparse, segs, target_offset, flash_size)
+
+    data_size = sum(len(s.data) for s in segs)
+    status(
+        "Merged %d images into %s, %d bytes in %d segments, %d bytes written"
+        % (len(images), args.output, data_size, len(segs), os.path.getsize(args.output))
+    )
+
+
+if __name__ == "__main__":
+    try:
+        main(parse_args(sys.argv[1:]))
+    except (InputError, OSError) as e:
+        critical(str(e))
+        sys.exit(2)
@@ -242,16 +242,50 @@ if partitions_name.endswith("tinyuf2.csv") or board_config.get("upload.arduino.t
 
 env.Replace(PARTITIONS_TABLE_CSV=get_partition_table_csv(variants_dir))
 
+# With PARTITIONS_CACHE_DIR set, identical tables of other boards and builds are generated once
+partitions_cache = '--cache-dir "$PARTITIONS_CACHE_DIR" ' if env.get("PARTITIONS_CACHE_DIR") else ""
+
 partition_table = env.Command(
     join("$BUILD_DIR", "partitions.bin"),
     "$PARTITIONS_TABLE_CSV",
     env.VerboseAction(
-        '"$PYTHONEXE" "%s" -q $SOURCE $TARGET' % join(FRAMEWORK_DIR, "tools", "gen_esp32part.py"),
+        '"$PYTHONEXE" "%s" -q %s$SOURCE $TARGET' % (join(FRAMEWORK_DIR, "tools", "gen_esp32part.py"), partitions_cache),
         "Generating partitions $TARGET",
     ),
 )
 env.Depends("$BUILD_DIR/$PROGNAME$PROGSUFFIX", partition_table)
 
+#
+# Merged flash image for factory programming: pio run -t merged_image
+#
+
+
+def merge_flash_images(target, source, env):
+    # FLASH_EXTRA_IMAGES as completed by the platform, at build time
+    images = " ".join('%s "%s"' % (offset, image) for offset, image in env.get("FLASH_EXTRA_IMAGES", []))
+    return env.Execute(
+        env.VerboseAction(
+            '"$PYTHONEXE" "%s" -q --flash-size %s --partition-table-offset %s --app "$BUILD_DIR/${PROGNAME}.bin" '
+            '--manifest "$BUILD_DIR/${PROGNAME}.merged.json" -o "$BUILD_DIR/${PROGNAME}.merged.bin" %s'
+            % (
+                join(FRAMEWORK_DIR, "tools", "gen_merged_image.py"),
+                board_config.get("upload.flash_size", "4MB"),
+                board_config.get("upload.arduino.partitions_bin", "0x8000"),
+                images,
+            ),
+            "Merging flash images into $BUILD_DIR/${PROGNAME}.merged.bin",
+        )
+    )
+
+
+env.AddCustomTarget(
+    name="merged_image",
+    dependencies=[join("$BUILD_DIR", "${PROGNAME}.bin"), partition_table],
+    actions=merge_flash_images,
+    title="Merged Flash Image",
+    description="Bootloader, partition table, app and extra images in one file, with a segment manifest",
+)
+
 #
 #  Adjust the `esptoolpy` command in the `ElfToBin` builder with firmware checksum offset
 #
@@ -0,0 +1,8 @@
+# Tests of the host tools in tools/, run on the host with:
+# python -m pytest tools/tests
+# (tests/ holds the sketches run on boards with pytest-embedded)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
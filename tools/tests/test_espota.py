@@ -0,0 +1,331 @@
+import hashlib
+import io
+import os
+import socket
+import struct
+import time
+
+import pytest
+
+import espota
+import espota_sim
+
+
+def feed(parser, *reads):
+    for data in reads:
+        parser.feed(data)
+    return parser
+
+
+@pytest.mark.parametrize(
+    "reads, acked",
+    [
+        ([b"100\n1100\n"], 1100),
+        # Partial reads split an ack in two
+        ([b"14", b"36\n29", b"20\n"], 2920),
+        # The re-ack of the firmware after a second without data repeats the total
+        ([b"1460\n", b"1460\n", b"1460\n"], 1460),
+        # Acks that would run together as bare counts
+        ([b"100\n1000\n"], 1000),
+        ([b"5\n1460\n"], 1460),
+        # An ack still missing its newline is not counted yet
+        ([b"1460\n29"], 1460),
+    ],
+)
+def test_delimited_acks(reads, acked):
+    acks = feed(espota.AckParser(), *reads)
+    assert acks.acked == acked
+    assert not acks.ok
+    assert acks.text == ""
+
+
+def test_delimited_result():
+    acks = feed(espota.AckParser(), b"1460\n2920\nO", b"K")
+    assert acks.acked == 2920
+    assert acks.ok
+    assert acks.text == ""
+
+
+def test_delimited_error():
+    acks = feed(espota.AckParser(), b"1460\nError[4]: End", b" Failed\n")
+    assert acks.acked == 1460
+    assert not acks.ok
+    assert acks.text == "Error[4]: End Failed\n"
+
+
+@pytest.mark.parametrize("reads", [[b"1001000"], [b"51460"], [b"14", b"36", b"24"], [b"1460", b"1460"]])
+def test_bare_acks_are_not_counted(reads):
+    # Without extensions, counts run together and only tell that the device is reading
+    acks = feed(espota.AckParser(delimited=False), *reads)
+    assert acks.acked == 0
+    assert not acks.ok
+    assert acks.text == ""
+
+
+def test_bare_result():
+    assert feed(espota.AckParser(delimited=False), b"1460", b"1460O", b"K").ok
+    acks = feed(espota.AckParser(delimited=False), b"1460Error[4]: End Failed")
+    assert not acks.ok
+    assert acks.text == "Error[4]: End Failed"
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    path = tmp_path / "image.bin"
+    path.write_bytes(os.urandom(40000))
+    return str(path)
+
+
+def upload(device, filename, window=4, **kwargs):
+    client = espota.OTAClient(host_ip="127.0.0.1", window=window, validate=False, timeout=2, **kwargs)
+    session = client.session("127.0.0.1", espota.OTAImage(filename, use_cache=False), remote_port=device.port)
+    session.run()
+    return session
+
+
+@pytest.mark.parametrize("features", [None, (), ("zlib", "resume")])
+@pytest.mark.parametrize("window", [1, 4])
+def test_upload(image_file, features, window):
+    device = espota_sim.SimulatedDevice(port=0, features=features).start()
+    try:
+        session = upload(device, image_file, window=window)
+    finally:
+        device.stop()
+    assert session.result == 0, session.error
+    assert device.updates[-1].ok
+    assert device.updates[-1].bytes_written == os.path.getsize(image_file)
+
+
+def test_resume_pipelined(image_file):
+    device = espota_sim.SimulatedDevice(port=0, features=("resume",), disconnect_after=15000).start()
+    try:
+        session = upload(device, image_file, window=4)
+    finally:
+        device.stop()
+    assert session.result == 0, session.error
+    assert device.updates[-1].resumes == 1
+    assert device.updates[-1].bytes_written == os.path.getsize(image_file)
+
+
+def test_resume_session(tmp_path, image_file):
+    # Every image of a session is interrupted once, the last one, let in with a session token, too
+    fs_file = tmp_path / "fs.bin"
+    fs_file.write_bytes(os.urandom(30000))
+    device = espota_sim.SimulatedDevice(port=0, password="secret", disconnect_after=15000).start()
+    try:
+        client = espota.OTAClient(host_ip="127.0.0.1", password="secret", validate=False, timeout=2, compress=False)
+        images = [
+            (espota.SPIFFS, espota.OTAImage(str(fs_file), use_cache=False)),
+            (espota.FLASH, espota.OTAImage(image_file, use_cache=False)),
+        ]
+        sessions = client.upload_images("127.0.0.1", images, remote_port=device.port)
+    finally:
+        device.stop()
+    assert [session.result for session in sessions] == [0, 0]
+    assert [update.resumes for update in device.updates] == [1, 1]
+    assert all(update.ok for update in device.updates)
+
+
+@pytest.fixture
+def app_image(tmp_path):
+    path = tmp_path / "app.bin"
+    path.write_bytes(os.urandom(1000))
+    return espota.OTAImage(str(path), use_cache=False)
+
+
+def announce(sha256=None):
+    device = espota.DiscoveredDevice("127.0.0.1", 0.001)
+    if sha256:
+        device.txt["sha256"] = sha256
+    return [device]
+
+
+def closed_without_result(monkeypatch, image, answers, command=espota.FLASH, result_timeout=0.5):
+    """wait_for_result() on a connection closed without a result, discover() giving `answers` in turn"""
+    answers = list(answers)
+    monkeypatch.setattr(espota, "REBOOT_PROBE_INTERVAL", 0.01)
+    monkeypatch.setattr(espota, "discover", lambda targets, deadline: answers.pop(0) if answers else [])
+    session = espota.OTAClient(result_timeout=result_timeout).session("127.0.0.1", image, command=command)
+    connection, device = socket.socketpair()
+    device.close()
+    with connection:
+        return session, session.wait_for_result(connection)
+
+
+def test_rebooted_into_new_app(monkeypatch, app_image):
+    session, result = closed_without_result(monkeypatch, app_image, [announce(), [], announce(app_image.digest())])
+    assert result == 0
+    assert session.unconfirmed is None
+
+
+def test_rebooted_into_another_app(monkeypatch, app_image):
+    session, result = closed_without_result(monkeypatch, app_image, [announce(), [], announce("00" * 32)])
+    assert result == 1
+    assert session.error_class == "update"
+
+
+def test_did_not_come_back(monkeypatch, app_image):
+    session, result = closed_without_result(monkeypatch, app_image, [announce()])
+    assert result == 1
+
+
+@pytest.mark.parametrize(
+    "answers, command",
+    [
+        # Firmware that does not announce the app it runs
+        ([announce(), [], announce()], espota.FLASH),
+        # The app hash says nothing about a filesystem image
+        ([announce(), [], announce("00" * 32)], espota.SPIFFS),
+        # No mDNS at all
+        ([], espota.FLASH),
+    ],
+)
+def test_unconfirmed(monkeypatch, app_image, answers, command):
+    session, result = closed_without_result(monkeypatch, app_image, answers, command)
+    assert result == 0
+    assert session.unconfirmed
+
+
+def test_silent_device_given_up_early(monkeypatch, app_image):
+    monkeypatch.setattr(espota, "MDNS_SILENCE_TIMEOUT", 0.1)
+    started = time.time()
+    session, result = closed_without_result(monkeypatch, app_image, [], result_timeout=60)
+    assert time.time() - started < 5
+    assert result == 0
+    assert "does not answer mDNS queries" in session.unconfirmed
+
+
+def test_rebooted_before_the_first_probe(monkeypatch, app_image):
+    # Down already, then announcing the new app before the silence timeout
+    session, result = closed_without_result(monkeypatch, app_image, [[], [], announce(app_image.digest())])
+    assert result == 0
+    assert session.unconfirmed is None
+
+
+def test_image_cache_bounded(tmp_path):
+    images = []
+    for i in range(3):
+        path = tmp_path / ("app%d.bin" % i)
+        path.write_bytes(os.urandom(1000))
+        images.append(espota.OTAImage(str(path), use_cache=False))
+    cache = espota.ImageCache(str(tmp_path / "cache"), max_size=2500)
+    cache.remember("a", images[0])
+    cache.remember("b", images[1])
+    # Using the first image as base makes the second one the least recently used
+    os.utime(str(tmp_path / "cache" / (images[1].digest() + ".bin")), (0, 0))
+    assert cache.base_for("a").md5 == images[0].md5
+    cache.remember("c", images[2])
+    assert cache.digest_for("a") == images[0].digest()
+    assert cache.digest_for("b") is None
+    assert cache.digest_for("c") == images[2].digest()
+    kept = sorted(name for name in os.listdir(str(tmp_path / "cache")) if name.endswith(".bin"))
+    assert kept == sorted([images[0].digest() + ".bin", images[2].digest() + ".bin"])
+    # The index is saved without the evicted device
+    assert espota.ImageCache(str(tmp_path / "cache")).digest_for("b") is None
+
+
+def make_app_image(chip="esp32", segments=(b"\x01" * 100, b"\x02" * 33), hash_appended=True):
+    """An app image as esptool writes it: header, segments, checksum and the SHA256 if appended"""
+    header = bytearray(espota.ESP_IMAGE_HEADER_SIZE)
+    header[0] = espota.ESP_IMAGE_MAGIC
+    header[1] = len(segments)
+    struct.pack_into("<H", header, 12, espota.ESP_CHIP_IDS[chip])
+    header[23] = 1 if hash_appended else 0
+    image = bytearray(header)
+    checksum = espota.ESP_CHECKSUM_MAGIC
+    for index, data in enumerate(segments):
+        image += struct.pack("<II", 0x3F400000 + index * 0x1000, len(data)) + data
+        for byte in data:
+            checksum ^= byte
+    image += bytes(15 - len(image) % 16) + bytes([checksum])
+    if hash_appended:
+        image += hashlib.sha256(image).digest()
+    return bytes(image)
+
+
+@pytest.mark.parametrize("chip", ["esp32", "esp32s3", "esp32c6"])
+@pytest.mark.parametrize("hash_appended", [True, False])
+def test_check_app_image(chip, hash_appended):
+    image = make_app_image(chip, hash_appended=hash_appended)
+    info = espota.check_app_image(io.BytesIO(image))
+    assert info["error"] is None
+    assert info["chip"] == chip
+    assert info["segments"] == 2
+    assert info["hash_appended"] == hash_appended
+    assert info["image_size"] == len(image)
+
+
+@pytest.mark.parametrize(
+    "image, error",
+    [
+        (b"\x00" * 64, "Not an app image"),
+        (make_app_image()[:1] + b"\x00" + make_app_image()[2:], "Invalid segment count"),
+        (make_app_image()[:60], "Truncated in segment 0"),
+        (make_app_image()[:-34], "Truncated before the checksum"),
+        (make_app_image()[:-10], "Truncated in the appended SHA256"),
+        (make_app_image()[:-33] + b"\x00" + make_app_image()[-32:], "Checksum mismatch"),
+        (make_app_image()[:-1] + b"\x00", "SHA256 mismatch"),
+        # A flipped data byte breaks the checksum first
+        (make_app_image()[:40] + b"\x00" + make_app_image()[41:], "Checksum mismatch"),
+    ],
+    ids=["magic", "segments", "segment", "checksum", "sha256", "checksum-byte", "sha256-byte", "data"],
+)
+def test_check_app_image_errors(image, error):
+    assert espota.check_app_image(io.BytesIO(image))["error"].startswith(error)
+
+
+def test_image_digest_of_app_image(tmp_path):
+    path = tmp_path / "app.bin"
+    path.write_bytes(make_app_image())
+    # The SHA256 esptool appended, the one the device reports for the running app
+    assert espota.OTAImage(str(path), use_cache=False).digest() == make_app_image()[-32:].hex()
+
+
+@pytest.fixture
+def md5_cache(tmp_path, monkeypatch):
+    """The MD5 cache in a directory of its own, and a record of the files hashed"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("LOCALAPPDATA", str(tmp_path / "cache"))
+    hashed = []
+    hash_file = espota.OTAImage._hash
+
+    def record(image):
+        hashed.append(image.filename)
+        return hash_file(image)
+
+    monkeypatch.setattr(espota.OTAImage, "_hash", record)
+    return hashed
+
+
+def test_md5_cached(tmp_path, md5_cache):
+    path = tmp_path / "build" / "app.bin"
+    path.parent.mkdir()
+    path.write_bytes(os.urandom(1000))
+    md5 = hashlib.md5(path.read_bytes()).hexdigest()
+    assert espota.OTAImage(str(path)).md5 == md5
+    assert espota.OTAImage(str(path)).md5 == md5
+    assert md5_cache == [str(path)]
+    # Nothing is written next to the image
+    assert os.listdir(str(path.parent)) == ["app.bin"]
+    assert os.path.dirname(espota.md5_cache_filename(str(path))).startswith(str(tmp_path / "cache"))
+
+
+def test_md5_cache_rebuild_keeping_size_and_mtime(tmp_path, md5_cache):
+    path = tmp_path / "app.bin"
+    path.write_bytes(os.urandom(1000))
+    st = os.stat(str(path))
+    espota.OTAImage(str(path))
+    time.sleep(0.05)
+    path.write_bytes(os.urandom(1000))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert espota.OTAImage(str(path)).md5 == hashlib.md5(path.read_bytes()).hexdigest()
+    assert len(md5_cache) == 2
+
+
+def test_md5_cache_disabled(tmp_path, md5_cache):
+    path = tmp_path / "app.bin"
+    path.write_bytes(os.urandom(1000))
+    espota.OTAImage(str(path), use_cache=False)
+    espota.OTAImage(str(path), use_cache=False)
+    assert len(md5_cache) == 2
+    assert not os.path.exists(str(tmp_path / "cache"))
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import espota
+import espota_rollout
+
+
+class FakeSession(object):
+    def __init__(self, name, result=0, unconfirmed=None, error_class=None):
+        self.name = name
+        self.result = result
+        self.unconfirmed = unconfirmed
+        self.error_class = error_class
+
+
+class FakeClient(object):
+    """upload_many() gives each device the outcome in `outcomes`, "ok" by default"""
+
+    def __init__(self, outcomes=None):
+        self.outcomes = outcomes or {}
+        self.telemetry = None
+        self.pushed = []
+
+    def upload_many(self, targets, image, command, jobs, skip_offline):
+        sessions = []
+        for target in targets:
+            name = "%s:%d" % target
+            self.pushed.append(name)
+            outcome = self.outcomes.get(name, "ok")
+            if outcome == "ok":
+                session = FakeSession(name)
+            elif outcome == "unconfirmed":
+                session = FakeSession(name, unconfirmed="does not answer mDNS queries")
+            else:
+                session = FakeSession(name, 1, error_class=outcome)
+            self.telemetry(
+                session,
+                "result",
+                {
+                    "status": "unconfirmed" if session.unconfirmed else "failed" if session.result else "ok",
+                    "error": "failed" if session.result else None,
+                    "error_class": session.error_class,
+                },
+            )
+            sessions.append(session)
+        return sessions
+
+
+TARGETS = [("10.0.0.%d" % host, 3232) for host in range(1, 5)]
+
+
+def image(tmp_path, content):
+    path = tmp_path / ("app-%d.bin" % len(os.listdir(tmp_path)))
+    path.write_bytes(content * 1000)
+    return espota.OTAImage(str(path), use_cache=False)
+
+
+def rollout(tmp_path, app, outcomes=None, **kwargs):
+    client = FakeClient(outcomes)
+    state = espota_rollout.RolloutState(str(tmp_path / "rollout.json"))
+    return client, espota_rollout.Rollout(client, app, TARGETS, state, canary=1, growth=2, **kwargs)
+
+
+def test_digest_of_the_pushed_image_recorded(tmp_path):
+    app = image(tmp_path, b"\x01")
+    client, first = rollout(tmp_path, app, {"10.0.0.4:3232": "offline"})
+    assert first.run() == 1
+    assert first.state.devices["10.0.0.1:3232"]["digest"] == app.digest()
+    assert "digest" not in first.state.devices["10.0.0.4:3232"]
+
+    # Running it again only pushes to the device that was offline
+    client, second = rollout(tmp_path, app)
+    assert second.run() == 0
+    assert client.pushed == ["10.0.0.4:3232"]
+
+
+def test_new_image_keeps_the_digests(tmp_path):
+    old, new = image(tmp_path, b"\x01"), image(tmp_path, b"\x02")
+    client, first = rollout(tmp_path, old, {"10.0.0.2:3232": "update"}, max_failure_rate=1)
+    assert first.run() == 1
+    client, second = rollout(tmp_path, new)
+    second._prepare()
+    assert second.state.devices["10.0.0.1:3232"] == {"status": "pending", "wave": 0, "digest": old.digest()}
+    assert "digest" not in second.state.devices["10.0.0.2:3232"]
+
+    # Rolling back to the old image skips the devices that still run it
+    client, back = rollout(tmp_path, old)
+    back._prepare()
+    statuses = {name: entry["status"] for name, entry in back.state.devices.items()}
+    assert statuses["10.0.0.1:3232"] == espota_rollout.CURRENT
+    assert statuses["10.0.0.2:3232"] == espota_rollout.PENDING
+
+
+def test_unconfirmed_counts_as_failed(tmp_path, capsys):
+    app = image(tmp_path, b"\x01")
+    outcomes = {"10.0.0.2:3232": "unconfirmed", "10.0.0.3:3232": "update"}
+    client, first = rollout(tmp_path, app, outcomes, max_failure_rate=1)
+    assert first.run() == 1
+    assert "Wave 2/3: 0 updated, 1 unconfirmed, 1 failed, failure rate of the rollout 67%" in capsys.readouterr().out
+    assert first.state.devices["10.0.0.2:3232"]["status"] == espota_rollout.UNCONFIRMED
+    assert "digest" not in first.state.devices["10.0.0.2:3232"]
+    assert first.state.failure_rate() == pytest.approx(2 / 4.0)
+
+    client, retry = rollout(tmp_path, app, retry_failed=True)
+    assert retry.run() == 0
+    assert sorted(client.pushed) == ["10.0.0.2:3232", "10.0.0.3:3232"]
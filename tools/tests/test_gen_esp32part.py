@@ -0,0 +1,331 @@
+import concurrent.futures
+import json
+import os
+import sys
+
+import pytest
+
+import gen_esp32part
+
+TABLE = b"""# Name,   Type, SubType, Offset,  Size, Flags
+nvs,      data, nvs,     0x9000,  0x5000,
+otadata,  data, ota,     0xe000,  0x2000,
+app0,     app,  ota_0,   0x10000, 0x140000,
+"""
+# "ota" is the name of a data subtype, which the verification warns about
+TABLE_WITH_WARNING = TABLE + b"ota,      data, spiffs,  0x150000,0x100000,\n"
+
+
+def parse_args(*argv):
+    return gen_esp32part.argument_parser().parse_args(list(argv))
+
+
+def test_cache_hit(tmp_path, capsys):
+    cache = gen_esp32part.TableCache(str(tmp_path))
+    args = parse_args("-q")
+    output = gen_esp32part.cached_convert(TABLE, args, cache)
+    assert output == gen_esp32part.convert(TABLE, args)
+    assert gen_esp32part.cached_convert(TABLE, args, cache) == output
+    # Other options make another table
+    assert gen_esp32part.cached_convert(TABLE, parse_args("-q", "--disable-md5sum"), cache) != output
+    assert len(list(tmp_path.glob("*/*.bin"))) == 2
+
+
+def test_cache_hit_replays_warnings(tmp_path, capsys):
+    cache = gen_esp32part.TableCache(str(tmp_path))
+    args = parse_args("-q")
+    output = gen_esp32part.cached_convert(TABLE_WITH_WARNING, args, cache)
+    converted = capsys.readouterr().err
+    assert "WARNING: Partition has name 'ota'" in converted
+    assert gen_esp32part.cached_convert(TABLE_WITH_WARNING, args, cache) == output
+    assert capsys.readouterr().err == converted
+
+
+def test_cache_threads(tmp_path):
+    # Tables with and without a warning, converted many times each from a thread pool
+    tables = []
+    for i in range(50):
+        size = b"0x%x" % (0x100000 + i * 0x1000)
+        tables.append((TABLE + b"ota,      data, spiffs,  0x150000," + size + b",\n", True))
+        tables.append((TABLE + b"spiffs,   data, spiffs,  0x150000," + size + b",\n", False))
+    cache = gen_esp32part.TableCache(str(tmp_path), max_size=1 << 30)
+    args = parse_args("-q")
+    stderr = sys.stderr
+    # Switch threads often, in the middle of the conversions
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            outputs = list(executor.map(lambda t: gen_esp32part.cached_convert(t[0], args, cache), tables * 20))
+    finally:
+        sys.setswitchinterval(interval)
+    assert sys.stderr is stderr
+    for (data, warned), output in zip(tables * 20, outputs):
+        assert output == gen_esp32part.convert(data, args)
+        output, warnings = cache.get(gen_esp32part.table_key(data, args))
+        assert len(warnings) == (1 if warned else 0)
+    assert len(list(tmp_path.glob("*/*.warnings"))) == 50
+    assert len(list(tmp_path.glob("*/*.bin"))) == 100
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+
+# Without offsets, which then depend on --offset
+TABLE_NO_OFFSETS = b"""nvs,      data, nvs,     ,        0x5000,
+otadata,  data, ota,     ,        0x2000,
+app0,     app,  ota_0,   ,        0x140000,
+"""
+TABLE_EXTRA_SUBTYPE = TABLE + b"custom,   data, my_data, 0x150000,0x10000,\n"
+
+
+def test_convert_threads():
+    def converted(job):
+        table, argv = job
+        try:
+            return gen_esp32part.convert(table, parse_args("-q", *argv))
+        except gen_esp32part.InputError as e:
+            return str(e)
+
+    jobs = [
+        (table, argv)
+        for table in (TABLE, TABLE_NO_OFFSETS, TABLE_EXTRA_SUBTYPE)
+        for argv in (
+            (),
+            ("--offset", "0x9000"),
+            ("--secure",),
+            ("--extra-partition-subtypes", "data, my_data, 0x41"),
+            ("--extra-partition-subtypes", "data, my_data, 0x42"),
+        )
+    ]
+    serial = [converted(job) for job in jobs]
+    # The extra subtypes only apply to the tables converted with them
+    assert "Value 'my_data' is not valid" in serial[10]
+    assert len(set(serial[13:15])) == 2
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            assert list(executor.map(converted, jobs * 10)) == serial * 10
+    finally:
+        sys.setswitchinterval(interval)
+    assert "my_data" not in gen_esp32part.SUBTYPES[gen_esp32part.DATA_TYPE]
+    assert "my_data" not in gen_esp32part.DEFAULT_SUBTYPES[gen_esp32part.DATA_TYPE]
+
+
+def test_options_copy_subtypes_on_write():
+    options = gen_esp32part.Options()
+    assert gen_esp32part.PartitionDefinition(options).options.subtypes is gen_esp32part.SUBTYPES
+    options.add_extra_subtypes(["data, my_data, 0x41"])
+    assert options.subtypes[gen_esp32part.DATA_TYPE]["my_data"] == 0x41
+    assert "my_data" not in gen_esp32part.SUBTYPES[gen_esp32part.DATA_TYPE]
+
+
+def test_cache_miss_on_error(tmp_path):
+    cache = gen_esp32part.TableCache(str(tmp_path))
+    overlapping = TABLE + b"spiffs,   data, spiffs,  0x100000,0x100000,\n"
+    for _ in range(2):
+        with pytest.raises(gen_esp32part.InputError):
+            gen_esp32part.cached_convert(overlapping, parse_args("-q"), cache)
+    assert not list(tmp_path.iterdir())
+
+
+def test_cache_evicts_output_and_warnings_together(tmp_path):
+    # Room for one binary table (0xC00 bytes)
+    cache = gen_esp32part.TableCache(str(tmp_path), max_size=0x1000)
+    gen_esp32part.cached_convert(TABLE_WITH_WARNING, parse_args("-q"), cache)
+    for path in tmp_path.glob("*/*"):
+        os.utime(str(path), (0, 0))
+    gen_esp32part.cached_convert(TABLE, parse_args("-q"), cache)
+    assert [p.suffix for p in tmp_path.glob("*/*")] == [".bin"]
+
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch):
+    """A manifest in a project directory, run from another working directory"""
+    project = tmp_path / "project"
+    (project / "tables").mkdir(parents=True)
+    (project / "tables" / "a.csv").write_bytes(TABLE)
+    (project / "tables" / "b.csv").write_bytes(TABLE_WITH_WARNING)
+    (project / "manifest").write_text(
+        "# input output [options]\n"
+        "tables/a.csv build/a.bin\n"
+        "tables/b.csv build/b.bin --flash-size 4MB --disable-md5sum\n"
+    )
+    monkeypatch.chdir(str(tmp_path))
+    return project
+
+
+def run_batch(project, *argv):
+    return gen_esp32part.run_batch(parse_args("-q", "--batch", str(project / "manifest"), *argv))
+
+
+def test_read_manifest(batch):
+    entries = gen_esp32part.read_manifest(str(batch / "manifest"))
+    # Paths are relative to the manifest, the options of a line apply to its table only
+    assert [(e.input, e.output, e.flash_size, e.disable_md5sum, e.quiet) for e in entries] == [
+        (str(batch / "tables" / "a.csv"), str(batch / "build" / "a.bin"), None, False, True),
+        (str(batch / "tables" / "b.csv"), str(batch / "build" / "b.bin"), "4MB", True, True),
+    ]
+
+
+def test_read_manifest_invalid_line(batch):
+    (batch / "manifest").write_text("tables/a.csv build/a.bin\ntables/b.csv\n")
+    with pytest.raises(gen_esp32part.InputError, match="line 2: invalid entry 'tables/b.csv'"):
+        gen_esp32part.read_manifest(str(batch / "manifest"))
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_run_batch(batch, jobs):
+    assert run_batch(batch, "--jobs", jobs) == 0
+    assert (batch / "build" / "a.bin").read_bytes() == gen_esp32part.convert(TABLE, parse_args("-q"))
+    assert (batch / "build" / "b.bin").read_bytes() == gen_esp32part.convert(
+        TABLE_WITH_WARNING, parse_args("-q", "--flash-size", "4MB", "--disable-md5sum")
+    )
+    state = json.loads((batch / "manifest.state").read_text())
+    assert sorted(state) == [str(batch / "build" / "a.bin"), str(batch / "build" / "b.bin")]
+
+
+def test_run_batch_failures(batch, capsys):
+    with (batch / "manifest").open("a") as f:
+        f.write("tables/missing.csv build/missing.bin\n")
+        f.write("tables/a.csv build/bad-offset.bin --offset zz\n")
+        f.write("tables/a.csv build/too-big.bin --flash-size 1MB\n")
+    # Every failed table is reported, the others are generated all the same
+    assert run_batch(batch, "--jobs", "2") == 3
+    errors = capsys.readouterr().err
+    assert "missing.csv" in errors
+    assert "Invalid --offset value 'zz'" in errors
+    assert "does not fit in configured flash size 1MB" in errors
+    assert sorted(os.listdir(str(batch / "build"))) == ["a.bin", "b.bin"]
+    state = json.loads((batch / "manifest.state").read_text())
+    assert sorted(state) == [str(batch / "build" / "a.bin"), str(batch / "build" / "b.bin")]
+
+
+def test_run_batch_skips_unchanged(batch, capsys):
+    assert run_batch(batch) == 0
+    a_bin = batch / "build" / "a.bin"
+    b_bin = batch / "build" / "b.bin"
+    stamps = [os.stat(str(path)).st_mtime_ns for path in (a_bin, b_bin)]
+    capsys.readouterr()
+    gen_esp32part.run_batch(parse_args("--batch", str(batch / "manifest")))
+    assert "Generated 0 of 2 partition tables, 2 unchanged, 0 failed" in capsys.readouterr().err
+    assert [os.stat(str(path)).st_mtime_ns for path in (a_bin, b_bin)] == stamps
+
+    # A changed table, a deleted output and a modified one are generated again
+    (batch / "tables" / "a.csv").write_bytes(TABLE.replace(b"0x5000", b"0x4000"))
+    b_bin.unlink()
+    assert run_batch(batch) == 0
+    assert a_bin.read_bytes() == gen_esp32part.convert(TABLE.replace(b"0x5000", b"0x4000"), parse_args("-q"))
+    assert b_bin.exists()
+    expected = b_bin.read_bytes()
+    b_bin.write_bytes(b"\xff" * len(expected))
+    capsys.readouterr()
+    gen_esp32part.run_batch(parse_args("--batch", str(batch / "manifest")))
+    assert "Generated 1 of 2 partition tables, 1 unchanged, 0 failed" in capsys.readouterr().err
+    assert b_bin.read_bytes() == expected
+
+
+LAYOUT = """# Name,   Type, SubType,  Min,  Max, Priority, Flags
+nvs,      data, nvs,      20K,  20K,
+otadata,  data, ota,      8K,   8K,
+app0,     app,  ota_0,    1M,   ,    1
+app1,     app,  ota_1,    1M,   ,    1
+spiffs,   data, spiffs,   1M,   ,    2
+coredump, data, coredump, 64K,  64K,
+"""
+
+
+def options():
+    return gen_esp32part.Options(quiet=True, offset_part_table=0x8000)
+
+
+def layout(table):
+    return [(p.name, p.offset, p.size) for p in table]
+
+
+def role(line):
+    return gen_esp32part.LayoutRole.from_csv(line, 1, options())
+
+
+def test_place_roles():
+    roles = [role("nvs, data, nvs, 20K"), role("app0, app, ota_0, 1M"), role("spiffs, data, spiffs, 4K")]
+    # Apps start on a 64K boundary
+    offsets, end = gen_esp32part.place_roles(roles, [0x5000, 0x100000, 0x1000], 0x9000)
+    assert offsets == [0x9000, 0x10000, 0x110000]
+    assert end == 0x111000
+
+
+def test_layout_role_steps():
+    spiffs = role("spiffs, data, spiffs, 5000, 0x10fff, 1")
+    # The range is rounded to whole flash sectors, inwards
+    assert (spiffs.min_size, spiffs.max_size, spiffs.priority) == (0x2000, 0x10000, 1)
+    assert spiffs.clamp(0x1000) == 0x2000
+    assert spiffs.clamp(0x5FFF) == 0x5000
+    assert spiffs.clamp(0x100000) == 0x10000
+
+
+@pytest.mark.parametrize(
+    "line, error",
+    [
+        ("spiffs, data, spiffs, , 1M", "Field 'min' can't be left empty"),
+        ("spiffs, data, spiffs, 1M, 64K", "Maximum size 0x10000 is below the minimum size 0x100000"),
+        ("pt, partition_table, primary, 4K", "partition_table partitions have a fixed place"),
+    ],
+)
+def test_layout_role_errors(line, error):
+    with pytest.raises(gen_esp32part.InputError, match=error):
+        role(line)
+
+
+@pytest.mark.parametrize(
+    "flash_size, app_size",
+    [
+        # The apps take what is left beside the minimum of the filesystem
+        (4, 0x170000),
+        (8, 0x370000),
+    ],
+)
+def test_solve_layout(flash_size, app_size):
+    table = gen_esp32part.solve_layout(LAYOUT, flash_size << 20, options())
+    assert layout(table) == [
+        ("nvs", 0x9000, 0x5000),
+        ("otadata", 0xE000, 0x2000),
+        ("app0", 0x10000, app_size),
+        ("app1", 0x10000 + app_size, app_size),
+        ("spiffs", 0x10000 + 2 * app_size, 0x100000),
+        ("coredump", (flash_size << 20) - 0x10000, 0x10000),
+    ]
+
+
+def test_solve_layout_priorities():
+    # With the apps at their maximum, the filesystem gets the rest of the flash
+    contents = LAYOUT.replace("1M,   ,    1", "1M,   1536K, 1")
+    table = gen_esp32part.solve_layout(contents, 8 << 20, options())
+    assert layout(table)[2:] == [
+        ("app0", 0x10000, 0x180000),
+        ("app1", 0x190000, 0x180000),
+        ("spiffs", 0x310000, 0x4E0000),
+        ("coredump", 0x7F0000, 0x10000),
+    ]
+
+
+def test_solve_layout_partitions_without_priority():
+    # nvs keeps its size and leaves a gap up to the 64K boundary of the app, which takes
+    # all the flash the filesystem of a later priority does not need for its minimum
+    contents = "nvs, data, nvs, 16K\nfactory, app, factory, 1M, , 1\nspiffs, data, spiffs, 4K, , 2\n"
+    table = gen_esp32part.solve_layout(contents, 2 << 20, options())
+    assert layout(table) == [("nvs", 0x9000, 0x4000), ("factory", 0x10000, 0x1EF000), ("spiffs", 0x1FF000, 0x1000)]
+
+
+def test_solve_layout_too_small():
+    with pytest.raises(gen_esp32part.InputError, match="minimum sizes need 0x320000 bytes"):
+        gen_esp32part.solve_layout(LAYOUT, 2 << 20, options())
+
+
+def test_convert_layout():
+    args = parse_args("-q", "--layout", "--flash-size", "4MB")
+    csv = gen_esp32part.convert(LAYOUT.encode(), args)
+    assert csv.startswith("# Laid out by gen_esp32part.py for 4MB of flash\n")
+    # The laid out table converts like any other
+    binary = gen_esp32part.convert(csv.encode(), parse_args("-q", "--flash-size", "4MB"))
+    table = gen_esp32part.PartitionTable.from_binary(binary, options())
+    assert layout(table) == layout(gen_esp32part.solve_layout(LAYOUT, 4 << 20, options()))
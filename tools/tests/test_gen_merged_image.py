@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import gen_esp32part
+import gen_merged_image
+from gen_merged_image import FLASH_SECTOR_SIZE, FlashImage
+
+TABLE = """nvs,      data, nvs,     0x9000,  0x5000,
+otadata,  data, ota,     0xe000,  0x2000,
+app0,     app,  ota_0,   0x10000, 0x140000,
+"""
+
+
+def table():
+    return gen_esp32part.PartitionTable.from_csv(TABLE, gen_esp32part.Options(quiet=True))
+
+
+def validate(*images, flash_size=None):
+    return gen_merged_image.validate(list(images), table(), 0x8000, flash_size, 0)
+
+
+def test_validate():
+    names = validate(
+        FlashImage(0x1000, "bootloader.bin", b"\x01" * 0x5000),
+        FlashImage(0x8000, "partitions.bin", table().to_binary()),
+        FlashImage(0x10000, "app.bin", b"\x02" * 0x2000),
+    )
+    assert names == {0x1000: "bootloader area", 0x8000: "partition table", 0x10000: "partition 'app0'"}
+
+
+@pytest.mark.parametrize(
+    "images, error",
+    [
+        (
+            [FlashImage(0x1000, "bootloader.bin", b"\x01" * 0x2000), FlashImage(0x2000, "other.bin", b"\x02")],
+            "other.bin at 0x2000 overlaps bootloader.bin at 0x1000-0x2fff",
+        ),
+        (
+            [FlashImage(0xE000, "boot_app0.bin", b"\x01" * 0x3000)],
+            "boot_app0.bin at 0xe000-0x10fff does not fit in the partition 'otadata' at 0xe000-0xffff",
+        ),
+        (
+            [FlashImage(0x1000, "bootloader.bin", b"\x01" * 0x8000)],
+            "bootloader.bin at 0x1000-0x8fff does not fit in the bootloader area at 0x0-0x7fff",
+        ),
+        ([FlashImage(0x200000, "app.bin", b"\x01")], "app.bin at 0x200000 is not in any partition"),
+    ],
+    ids=["overlap", "partition", "bootloader", "outside"],
+)
+def test_validate_errors(images, error):
+    with pytest.raises(gen_merged_image.InputError) as e:
+        validate(*images)
+    assert str(e.value) == error
+
+
+def test_segments_split_at_erased_sectors():
+    data = (
+        # To the end of the first, partial sector
+        b"\x01" * 0x800
+        + b"\xff" * FLASH_SECTOR_SIZE
+        # A sector with some data after erased bytes is written whole
+        + b"\xff" * 0x10
+        + b"\x02" * 0x10
+        + b"\xff" * (FLASH_SECTOR_SIZE - 0x20)
+        + b"\x03" * FLASH_SECTOR_SIZE
+        # Erased end, shorter than a sector
+        + b"\xff" * 0x100
+    )
+    image = FlashImage(0x10800, "app.bin", data)
+    segs = gen_merged_image.segments([image], {0x10800: "partition 'app0'"})
+    assert [(s.offset, s.data) for s in segs] == [(0x10800, data[:0x800]), (0x12000, data[0x1800:0x3800])]
+    assert all(s.image is image and s.partition == "partition 'app0'" for s in segs)
+
+
+def test_segments_of_erased_image():
+    image = FlashImage(0x9000, "nvs.bin", b"\xff" * 0x5000)
+    assert gen_merged_image.segments([image], {0x9000: "partition 'nvs'"}) == []
+
+
+@pytest.fixture
+def merge(tmp_path):
+    """Files for a merge at target offset 0x1000, main() running with the `args` given"""
+    data = os.urandom(0x3000)
+    files = {
+        "bootloader.bin": data[:0x1000] + b"\xff" * 0x1000 + data[0x1000:0x1800],
+        "partitions.bin": table().to_binary(),
+        "boot_app0.bin": b"\xff" * 0x1000 + data[0x1800:0x2000],
+        "app.bin": data[0x2000:] + b"\xff" * 0x2000 + data[0x2000:0x2800],
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+
+    def run(*args):
+        args = ["-q", "--target-offset", "0x1000", "--app", str(tmp_path / "app.bin")] + list(args)
+        for offset, name in (("0x1000", "bootloader.bin"), ("0x8000", "partitions.bin"), ("0xe000", "boot_app0.bin")):
+            args += [offset, str(tmp_path / name)]
+        gen_merged_image.main(gen_merged_image.parse_args(args))
+
+    return run
+
+
+def test_sparse_round_trip(tmp_path, merge):
+    merge("-o", str(tmp_path / "merged.bin"), "--manifest", str(tmp_path / "merged.json"))
+    merge("-o", str(tmp_path / "sparse.bin"), "--sparse")
+    raw = (tmp_path / "merged.bin").read_bytes()
+    sparse = (tmp_path / "sparse.bin").read_bytes()
+    with open(str(tmp_path / "merged.json")) as f:
+        raw_manifest = json.load(f)
+    with open(str(tmp_path / "sparse.bin.json")) as f:
+        manifest = json.load(f)
+
+    assert manifest["format"] == "sparse" and raw_manifest["format"] == "raw"
+    assert manifest["image_size"] == len(sparse) < len(raw)
+    assert [(s["offset"], s["size"], s["partition"]) for s in manifest["segments"]] == [
+        (0x1000, 0x1000, "bootloader area"),
+        (0x3000, 0x800, "bootloader area"),
+        (0x8000, 0xC00, "partition table"),
+        (0xF000, 0x800, "partition 'otadata'"),
+        (0x10000, 0x1000, "partition 'app0'"),
+        (0x13000, 0x800, "partition 'app0'"),
+    ]
+
+    # Both manifests list the same segments, only where they are in the image differs
+    def without_image_offset(entries):
+        return [{key: value for key, value in entry.items() if key != "image_offset"} for entry in entries]
+
+    assert without_image_offset(manifest["segments"]) == without_image_offset(raw_manifest["segments"])
+    for entry in raw_manifest["segments"]:
+        assert entry["image_offset"] == entry["offset"] - 0x1000
+
+    # Writing the segments of the sparse image to erased flash gives the raw image
+    flash = bytearray(b"\xff" * len(raw))
+    for entry in manifest["segments"]:
+        data = sparse[entry["image_offset"] : entry["image_offset"] + entry["size"]]
+        assert hashlib.sha256(data).hexdigest() == entry["sha256"]
+        flash[entry["offset"] - 0x1000 : entry["offset"] - 0x1000 + entry["size"]] = data
+    assert bytes(flash) == raw